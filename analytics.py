@@ -0,0 +1,443 @@
+import archive
+import booking_index
+import bookings
+import bisect
+import datetime
+import dtutils
+import logging
+import os
+import processes
+import recurring
+import rooms
+import threading
+from array import array
+from config import ANALYTICS_DIR
+from config import ANALYTICS_MAX_DAYS
+from config import ANALYTICS_FLUSH_SAMPLES
+from dtutils import DAY_IN_SECS
+from dtutils import SECONDS_IN_MIN
+
+try:
+	import numpy
+except ImportError:
+	# e.g. on the device, the array/bisect fallback is used
+	numpy = None
+
+# utilization, no-show and power stats over months of booking history and sensor samples
+# both are kept in columns, arrays of a single type, rather than in objects
+# the sensor columns have prefix sums, so the samples during any interval are
+# summed with two lookups, and a query is a few searchsorted calls over the bookings
+# vectorized with numpy if it's installed, a bisect per booking if not
+
+# sensor sample columns, one file per column in ANALYTICS_DIR
+# time is the timestamp, tod the local minute of day and weekday the local weekday
+SAMPLE_COLUMNS = (('time', 'd'), ('motion', 'B'), ('power', 'd'), ('tod', 'H'),
+	('weekday', 'B'))
+
+# prefix sums of the sample columns, sum[i] is the total of the first i samples
+# work counts the samples in working hours, work_motion those with motion
+PREFIX_SUMS = ('motion', 'power', 'work', 'work_motion')
+
+# booking history columns, in epoch minutes
+BOOKING_COLUMNS = (('start', 'i'), ('end', 'i'), ('room', 'H'))
+
+WORKING_DAYS = 5
+
+
+def is_working_time(tod, weekday):
+	return weekday < WORKING_DAYS and bookings.FIRST_SLOT_START <= tod < bookings.LAST_SLOT_START
+
+
+def working_minutes(start_date, end_date, now=None):
+	# the working minutes from start_date up to, but excluding, end_date
+	# today only counts up to now, a local datetime
+	minutes = 0
+	date = start_date
+	while date < end_date:
+		if date.weekday() < WORKING_DAYS:
+			end = bookings.LAST_SLOT_START
+			if now != None and date == now.date():
+				end = min(end, now.hour * dtutils.MINS_IN_HOUR + now.minute)
+			minutes += max(0, end - bookings.FIRST_SLOT_START)
+		date += datetime.timedelta(days=1)
+	return minutes
+
+
+class SampleColumns:
+	# the aggregated sensor samples of the room connected to the MCU, in time order
+	# a read only instance only reads the files, e.g. in a process that doesn't own the MCU
+	def __init__(self, directory=ANALYTICS_DIR, max_days=ANALYTICS_MAX_DAYS,
+		flush_every=ANALYTICS_FLUSH_SAMPLES, read_only=False):
+		self.directory = directory
+		self.read_only = read_only
+		self.max_days = max_days
+		self.flush_every = flush_every
+		self.columns = dict((name, array(code)) for name, code in SAMPLE_COLUMNS)
+		self.sums = dict((name, array('d', [0.0])) for name in PREFIX_SUMS)
+		# the number of samples that have been written to the files
+		self.flushed = 0
+		self.loaded = False
+		# changes whenever samples are added, for the numpy copies
+		self.version = 0
+		self.numpy_version = None
+		self.numpy_columns = None
+		self.lock = threading.RLock()
+
+	def __len__(self):
+		return len(self.columns['time'])
+
+	def path(self, name):
+		return os.path.join(self.directory, 'samples-%s.bin' % (name))
+
+	def _add_sums(self, motion, power, tod, weekday):
+		work = 1 if is_working_time(tod, weekday) else 0
+		self.sums['motion'].append(self.sums['motion'][-1] + motion)
+		self.sums['power'].append(self.sums['power'][-1] + power)
+		self.sums['work'].append(self.sums['work'][-1] + work)
+		self.sums['work_motion'].append(self.sums['work_motion'][-1] + work * motion)
+
+	def read_column(self, name, start=0, count=None):
+		# the values in a column's file from start, count of them or up to the end
+		column = array(dict(SAMPLE_COLUMNS)[name])
+		path = self.path(name)
+		if os.path.exists(path):
+			with open(path, 'rb') as f:
+				available = max(0, os.fstat(f.fileno()).st_size // column.itemsize - start)
+				if count == None or count > available:
+					count = available
+				f.seek(start * column.itemsize)
+				column.fromfile(f, count)
+		return column
+
+	def load(self):
+		# reads the sample files, a partly written last sample is dropped
+		columns = dict((name, self.read_column(name)) for name, code in SAMPLE_COLUMNS)
+		count = min(len(column) for column in columns.values())
+		partial = any(len(column) != count for column in columns.values())
+
+		with self.lock:
+			self.columns = columns
+			self.sums = dict((name, array('d', [0.0])) for name in PREFIX_SUMS)
+			for column in columns.values():
+				del column[count:]
+			for i in range(count):
+				self._add_sums(columns['motion'][i], columns['power'][i], columns['tod'][i],
+					columns['weekday'][i])
+			self.flushed = count
+			self.version += 1
+			self.loaded = True
+			if not self.read_only:
+				if partial:
+					self.compact()
+				self.trim(dtutils.utc_timestamp_now())
+		logging.info('Loaded %d sensor sample(s)', count)
+
+	def ensure_loaded(self):
+		if not self.loaded:
+			self.load()
+
+	def refresh(self):
+		# a read only instance adds the samples written to the files since it last
+		# read them, or reloads them if the writer has since dropped old samples
+		if not self.read_only or not self.loaded:
+			self.ensure_loaded()
+			return
+		with self.lock:
+			times = self.columns['time']
+			if len(times) and self.read_column('time', 0, 1) != times[:1]:
+				self.load()
+				return
+			start = len(times)
+			columns = dict((name, self.read_column(name, start)) for name, code in SAMPLE_COLUMNS)
+			count = min(len(column) for column in columns.values())
+			for i in range(count):
+				for name, code in SAMPLE_COLUMNS:
+					self.columns[name].append(columns[name][i])
+				self._add_sums(columns['motion'][i], columns['power'][i], columns['tod'][i],
+					columns['weekday'][i])
+			if count:
+				self.flushed = len(self)
+				self.version += 1
+
+	def add(self, ts, motion, power):
+		# adds an aggregated sample, the samples are written a few at a time
+		tod = dtutils.now_minute_of_day()
+		weekday = dtutils.local_date_now().weekday()
+		with self.lock:
+			self.ensure_loaded()
+			if len(self) and ts <= self.columns['time'][-1]:
+				# e.g. the clock was set back
+				return
+			motion = 1 if motion else 0
+			for name, value in (('time', ts), ('motion', motion), ('power', power),
+				('tod', tod), ('weekday', weekday)):
+				self.columns[name].append(value)
+			self._add_sums(motion, power, tod, weekday)
+			self.version += 1
+			if len(self) - self.flushed >= self.flush_every:
+				self.flush()
+				self.trim(ts)
+
+	def flush(self):
+		with self.lock:
+			if self.flushed == len(self):
+				return
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+			for name, code in SAMPLE_COLUMNS:
+				with open(self.path(name), 'ab') as f:
+					self.columns[name][self.flushed:].tofile(f)
+			self.flushed = len(self)
+
+	def compact(self):
+		# rewrites the files from the columns, e.g. after old samples are dropped
+		with self.lock:
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+			for name, code in SAMPLE_COLUMNS:
+				tmp_path = self.path(name) + '.tmp'
+				with open(tmp_path, 'wb') as f:
+					self.columns[name].tofile(f)
+				os.rename(tmp_path, self.path(name))
+			self.flushed = len(self)
+
+	def trim(self, now_ts):
+		# drops the samples older than max_days, once there's a day of them to drop
+		cutoff = now_ts - self.max_days * DAY_IN_SECS
+		with self.lock:
+			times = self.columns['time']
+			if not len(times) or times[0] >= cutoff - DAY_IN_SECS:
+				return
+			count = bisect.bisect_left(times, cutoff)
+			for column in self.columns.values():
+				del column[:count]
+			# only the differences between prefix sums are used, so they're still valid
+			for column in self.sums.values():
+				del column[:count]
+			self.version += 1
+			self.compact()
+			logging.info('Dropped %d old sensor sample(s)', count)
+
+	def get_numpy_columns(self):
+		# numpy copies of the time column and prefix sums, made once per change
+		with self.lock:
+			if self.numpy_version != self.version:
+				self.numpy_columns = {'time':numpy.array(self.columns['time'])}
+				for name in PREFIX_SUMS:
+					self.numpy_columns[name] = numpy.array(self.sums[name])
+				self.numpy_version = self.version
+			return self.numpy_columns
+
+	def window(self, start_ts, end_ts):
+		# (lo, hi), the indexes of the samples from start_ts up to, but excluding, end_ts
+		with self.lock:
+			times = self.columns['time']
+			return bisect.bisect_left(times, start_ts), bisect.bisect_left(times, end_ts)
+
+	def total(self, name, lo, hi):
+		return self.sums[name][hi] - self.sums[name][lo]
+
+
+class BookingColumns:
+	# the archived bookings, see archive, in archive order
+	def __init__(self, max_days=ANALYTICS_MAX_DAYS):
+		self.max_days = max_days
+		self.columns = dict((name, array(code)) for name, code in BOOKING_COLUMNS)
+		# room index -> room id
+		self.room_ids = []
+		self.loaded = False
+		self.lock = threading.RLock()
+
+	def __len__(self):
+		return len(self.columns['start'])
+
+	def room_index(self, room_id):
+		if room_id not in self.room_ids:
+			self.room_ids.append(room_id)
+		return self.room_ids.index(room_id)
+
+	def add_records(self, records):
+		# adds archived booking records, e.g. as the cleanup job archives them
+		with self.lock:
+			for record in records:
+				if record.get('kind') != archive.BOOKING or record.get('start_epoch_min') == None:
+					continue
+				self.columns['start'].append(record['start_epoch_min'])
+				self.columns['end'].append(record['end_epoch_min'])
+				self.columns['room'].append(self.room_index(record['room']))
+
+	def load(self):
+		start_date = dtutils.local_date_now() - datetime.timedelta(days=self.max_days)
+		with self.lock:
+			self.columns = dict((name, array(code)) for name, code in BOOKING_COLUMNS)
+			self.room_ids = []
+			self.add_records(archive.archive.read(start_date))
+			self.loaded = True
+		logging.info('Loaded %d archived booking(s)', len(self))
+
+	def ensure_loaded(self):
+		if not self.loaded:
+			self.load()
+
+	def select(self, room_id, start_min, end_min):
+		# (starts, ends) of the bookings in the room that start from start_min
+		# up to, but excluding, end_min
+		with self.lock:
+			self.ensure_loaded()
+			if room_id not in self.room_ids:
+				return [], []
+			room = self.room_ids.index(room_id)
+			columns = self.columns
+			if numpy != None:
+				starts = numpy.array(columns['start'], dtype=numpy.int64)
+				mask = (numpy.array(columns['room']) == room) & \
+					(starts >= start_min) & (starts < end_min)
+				return starts[mask], numpy.array(columns['end'], dtype=numpy.int64)[mask]
+			indexes = [i for i in range(len(columns['start'])) if columns['room'][i] == room and \
+				start_min <= columns['start'][i] < end_min]
+			return [columns['start'][i] for i in indexes], [columns['end'][i] for i in indexes]
+
+
+class Stats:
+	# the stats of a room over a period
+	def __init__(self, room_id, start_date, end_date):
+		self.room_id = room_id
+		self.start_date = start_date
+		self.end_date = end_date
+		self.num_bookings = 0
+		self.booked_mins = 0
+		self.working_mins = 0
+		# the rest need sensor samples, so they're None for rooms without sensors
+		self.occupancy = None
+		self.sensed_bookings = 0
+		self.no_shows = 0
+		self.avg_power = None
+
+	def get_utilization(self):
+		if self.working_mins == 0:
+			return None
+		return float(self.booked_mins) / self.working_mins
+
+	def get_no_show_rate(self):
+		if self.sensed_bookings == 0:
+			return None
+		return float(self.no_shows) / self.sensed_bookings
+
+	def __repr__(self):
+		return '<Stats %s %s-%s %d %d/%d %s %d/%d %s>' % (self.room_id, self.start_date,
+			self.end_date, self.num_bookings, self.booked_mins, self.working_mins, self.occupancy,
+			self.no_shows, self.sensed_bookings, self.avg_power)
+
+
+def booking_samples_numpy(columns, starts, ends):
+	# (sensed bookings, no-shows, mean power) of the bookings, intervals in seconds
+	times = columns['time']
+	lo = numpy.searchsorted(times, starts)
+	hi = numpy.searchsorted(times, ends)
+	counts = hi - lo
+	sensed = counts > 0
+	if not sensed.any():
+		return 0, 0, None
+	motion = columns['motion'][hi] - columns['motion'][lo]
+	power = (columns['power'][hi] - columns['power'][lo])[sensed] / counts[sensed]
+	return int(sensed.sum()), int((sensed & (motion == 0)).sum()), float(power.mean())
+
+
+def booking_samples_fallback(samples, starts, ends):
+	# the same as booking_samples_numpy, a bisect per booking
+	sensed = 0
+	no_shows = 0
+	total_power = 0.0
+	for start, end in zip(starts, ends):
+		lo, hi = samples.window(start, end)
+		if hi > lo:
+			sensed += 1
+			if samples.total('motion', lo, hi) == 0:
+				no_shows += 1
+			total_power += samples.total('power', lo, hi) / (hi - lo)
+	if sensed == 0:
+		return 0, 0, None
+	return sensed, no_shows, total_power / sensed
+
+
+def live_bookings(room_id, start_date, end_date, now_min, today):
+	# (starts, ends), in epoch minutes, of the bookings that haven't been archived yet
+	# and today's occurrences of recurring bookings, that have started before now_min
+	# the booking index only has the days that haven't been archived
+	# the recurring index doesn't know the exceptions of past days, so the past
+	# occurrences are read from the archive, see retention.archive_occurrences
+	starts = []
+	ends = []
+	days = booking_index.index.days_between(start_date, end_date, room_id)
+	day_tss = dtutils.day_timestamps(date for date, day_bookings in days if day_bookings)
+	for date, day_bookings in days:
+		for booking in day_bookings:
+			if date < today and isinstance(booking, recurring.Occurrence):
+				continue
+			start = int(day_tss[date]) // SECONDS_IN_MIN + booking.start_time
+			if start < now_min:
+				starts.append(start)
+				ends.append(start + booking.duration)
+	return starts, ends
+
+
+def compute(room_id, num_days, now=None):
+	# the stats of the room for the last num_days days, including today
+	# must be called within an app context
+	if now == None:
+		now = dtutils.local_datetime_now()
+	end_date = now.date() + datetime.timedelta(days=1)
+	start_date = end_date - datetime.timedelta(days=num_days)
+	start_min = int(dtutils.day_ts(start_date)) // SECONDS_IN_MIN
+	now_min = int(dtutils.to_timestamp(now)) // SECONDS_IN_MIN
+
+	stats = Stats(room_id, start_date, end_date)
+	stats.working_mins = working_minutes(start_date, end_date, now)
+
+	archived_starts, archived_ends = history.select(room_id, start_min, now_min)
+	starts, ends = live_bookings(room_id, start_date, end_date, now_min, now.date())
+	if numpy != None:
+		starts = numpy.concatenate((archived_starts, numpy.array(starts, dtype=numpy.int64)))
+		ends = numpy.concatenate((archived_ends, numpy.array(ends, dtype=numpy.int64)))
+		# a booking in progress only counts up to now
+		ends = numpy.minimum(ends, now_min)
+		stats.num_bookings = len(starts)
+		stats.booked_mins = int((ends - starts).sum())
+	else:
+		starts = list(archived_starts) + starts
+		ends = [min(end, now_min) for end in list(archived_ends) + ends]
+		stats.num_bookings = len(starts)
+		stats.booked_mins = sum(end - start for start, end in zip(starts, ends))
+
+	sensor_room = rooms.sensor_room()
+	if sensor_room == None or sensor_room.id != room_id:
+		return stats
+
+	samples.refresh()
+	lo, hi = samples.window(start_min * SECONDS_IN_MIN, now_min * SECONDS_IN_MIN)
+	work = samples.total('work', lo, hi)
+	if work:
+		stats.occupancy = samples.total('work_motion', lo, hi) / work
+
+	if numpy != None:
+		stats.sensed_bookings, stats.no_shows, stats.avg_power = booking_samples_numpy(
+			samples.get_numpy_columns(), starts * SECONDS_IN_MIN, ends * SECONDS_IN_MIN)
+	else:
+		stats.sensed_bookings, stats.no_shows, stats.avg_power = booking_samples_fallback(
+			samples, [s * SECONDS_IN_MIN for s in starts], [e * SECONDS_IN_MIN for e in ends])
+	return stats
+
+
+def load():
+	# reads the sample files and booking archive, e.g. at startup, rather than
+	# on the first stats command
+	samples.load()
+	history.load()
+
+
+# in a split deployment, the samples are added by the mcu process
+samples = SampleColumns(read_only=not processes.owns_mcu())
+
+history = BookingColumns()
+
+archive.archive.add_listener(history.add_records)
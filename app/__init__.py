@@ -1,5 +1,6 @@
 import logging
 import os
+import processes
 from flask import Flask
 from flask_apscheduler import APScheduler
 from flask_sqlalchemy import SQLAlchemy
@@ -20,7 +21,8 @@ db = SQLAlchemy(app)
 slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
 
 # instantiate PyMata interface to the MCU (ATmega32U4)
-mcu = PyMata("/dev/ttyS0", verbose=True)
+# in a split deployment only the mcu process opens the serial port
+mcu = PyMata("/dev/ttyS0", verbose=True) if processes.owns_mcu() else None
 
 # instantiate the scheduler
 scheduler = APScheduler()
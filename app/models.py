@@ -1,4 +1,7 @@
+import dtutils
 from app import db
+from config import DEFAULT_ROOM
+from sqlalchemy import event
 
 class ConfirmedBooking(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
@@ -11,6 +14,21 @@ class ConfirmedBooking(db.Model):
 	in_progress = db.Column(db.Boolean, default=False)
 	finished = db.Column(db.Boolean, index=True, default=False)
 	name = db.Column(db.String(40), nullable=True)
+	# absolute start and end, in minutes since the epoch (UTC), so queries can
+	# use a single range condition. Set from start_date, start_time and duration
+	start_epoch_min = db.Column(db.Integer, nullable=True)
+	end_epoch_min = db.Column(db.Integer, nullable=True)
+	room = db.Column(db.String(20), nullable=False, default=DEFAULT_ROOM,
+		server_default=DEFAULT_ROOM)
+	# the recurring booking this was an occurrence of, e.g. once it was started
+	recurring_id = db.Column(db.Integer, db.ForeignKey('recurring_booking.id'), nullable=True)
+
+	__table_args__ = (
+		db.Index('ix_confirmed_booking_finished_start', 'finished', 'start_epoch_min'),
+		db.Index('ix_confirmed_booking_booker_start', 'booker_sid', 'start_epoch_min'),
+		db.Index('ix_confirmed_booking_end', 'end_epoch_min'),
+		db.Index('ix_confirmed_booking_room_start', 'room', 'start_epoch_min'),
+	)
 
 	def __repr__(self):
 		state = 'no started'
@@ -19,8 +37,17 @@ class ConfirmedBooking(db.Model):
 		elif self.in_progress:
 			state = 'in progress'
 		
-		return '<ConfirmedBooking %r %d %d %s %s>' % \
-			(self.start_date, self.start_time, self.duration, self.booker_sid, state)
+		return '<ConfirmedBooking %s %r %d %d %s %s>' % \
+			(self.room, self.start_date, self.start_time, self.duration, self.booker_sid, state)
+
+
+def set_epoch_minutes(mapper, connection, booking):
+	# keeps the absolute start and end in step with the local date and time
+	booking.start_epoch_min = dtutils.to_epoch_minute(booking.start_date, booking.start_time)
+	booking.end_epoch_min = booking.start_epoch_min + booking.duration
+
+event.listen(ConfirmedBooking, 'before_insert', set_epoch_minutes)
+event.listen(ConfirmedBooking, 'before_update', set_epoch_minutes)
 
 
 class Reminder(db.Model):
@@ -34,6 +61,50 @@ class Reminder(db.Model):
 		return '<Reminder %d %s>' % (self.send_at, self.text)
 
 
+class RecurringBooking(db.Model):
+	# a weekly booking, its occurrences are expanded on demand rather than stored
+	id = db.Column(db.Integer, primary_key=True)
+	weekday = db.Column(db.Integer, nullable=False)
+	start_time = db.Column(db.Integer, nullable=False)
+	duration = db.Column(db.Integer, nullable=False)
+	# the first and, optionally, last day of the series
+	start_date = db.Column(db.Date, nullable=False)
+	until_date = db.Column(db.Date, nullable=True)
+	booker_sid = db.Column(db.String(10), db.ForeignKey('slack_user.sid'), nullable=False)
+	attendees = db.Column(db.Integer, nullable=False)
+	name = db.Column(db.String(40), nullable=True)
+	room = db.Column(db.String(20), nullable=False, default=DEFAULT_ROOM,
+		server_default=DEFAULT_ROOM)
+	# reminders are sent to this channel, if it's set
+	slack_channel = db.Column(db.String(10), nullable=True)
+	# the occurrences before this day have been archived by the cleanup job, all those
+	# since start_date if it isn't set
+	archived_until = db.Column(db.Date, nullable=True)
+
+	__table_args__ = (
+		db.Index('ix_recurring_booking_room_until', 'room', 'until_date'),
+	)
+
+	def __repr__(self):
+		return '<RecurringBooking %s %d %d %d %r-%r %s>' % (self.room, self.weekday,
+			self.start_time, self.duration, self.start_date, self.until_date, self.booker_sid)
+
+
+class RecurringException(db.Model):
+	# a day the recurring booking doesn't occur, e.g. it was cancelled, or the
+	# occurrence was replaced by a ConfirmedBooking when it was started
+	id = db.Column(db.Integer, primary_key=True)
+	recurring_id = db.Column(db.Integer, db.ForeignKey('recurring_booking.id'), nullable=False)
+	date = db.Column(db.Date, nullable=False)
+
+	__table_args__ = (
+		db.Index('ix_recurring_exception_recurring_date', 'recurring_id', 'date', unique=True),
+	)
+
+	def __repr__(self):
+		return '<RecurringException %d %r>' % (self.recurring_id, self.date)
+
+
 class SlackUser(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
 	sid = db.Column(db.String(10), nullable=False, unique=True)
@@ -54,6 +125,8 @@ class UnconfirmedBooking(db.Model):
 	booker_sid = db.Column(db.String(10), nullable=False)
 	booker_ref = db.Column(db.Integer, nullable=False)
 	attendees = db.Column(db.Integer, nullable=True)
+	room = db.Column(db.String(20), nullable=False, default=DEFAULT_ROOM,
+		server_default=DEFAULT_ROOM)
 
 	def __repr__(self):		
 		return '<UnconfirmedBooking %r %d %d %s>' % \
@@ -61,6 +134,7 @@ class UnconfirmedBooking(db.Model):
 
 
 class ConfirmedBookingRef(db.Model):
+	# booking is a ConfirmedBooking id, or minus a RecurringBooking id
 	id = db.Column(db.Integer, primary_key=True)
 	booker_sid = db.Column(db.String(10), db.ForeignKey('slack_user.sid'), nullable=False)
 	booker_ref = db.Column(db.Integer, nullable=False)
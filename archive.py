@@ -0,0 +1,148 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import struct
+from config import ARCHIVE_DIR
+
+# an append-only archive of expired bookings, written by the cleanup job
+# one gzip file of json lines per month, by booking start date, e.g. bookings-2017-06.jsonl.gz
+# each append adds a gzip member, which gzip readers treat as one continuous stream
+# kept free of app/db imports, so the archive can be read without the app
+
+FILE_PREFIX = 'bookings-'
+FILE_SUFFIX = '.jsonl.gz'
+
+# record kinds
+BOOKING = 'booking'
+RECURRING = 'recurring'
+
+# record fields that are dates
+DATE_FIELDS = ('start_date', 'until_date')
+
+
+def parse_date(value):
+	if value == None or isinstance(value, datetime.date):
+		return value
+	return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def encode(record):
+	# a single json line, dates are written as iso strings
+	record = dict(record)
+	for field in DATE_FIELDS:
+		if isinstance(record.get(field), datetime.date):
+			record[field] = record[field].isoformat()
+	return (json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def decode(line):
+	record = json.loads(line.decode('utf-8'))
+	for field in DATE_FIELDS:
+		if field in record:
+			record[field] = parse_date(record[field])
+	return record
+
+
+def month_start(date):
+	return datetime.date(date.year, date.month, 1)
+
+
+class BookingArchive:
+	def __init__(self, directory=ARCHIVE_DIR):
+		self.directory = directory
+		self.listeners = []
+
+	def add_listener(self, listener):
+		# listener is called with the records, once they've been archived
+		self.listeners.append(listener)
+
+	def path(self, month):
+		return os.path.join(self.directory, '%s%04d-%02d%s' % (FILE_PREFIX, month.year,
+			month.month, FILE_SUFFIX))
+
+	def append(self, records):
+		# appends the records, dicts with at least a kind, id and start_date
+		# the data is synced before returning, so the rows can then be deleted
+		by_month = {}
+		for record in records:
+			by_month.setdefault(month_start(parse_date(record['start_date'])), []).append(record)
+		if not by_month:
+			return
+
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		for month in sorted(by_month):
+			with open(self.path(month), 'ab') as f:
+				gz = gzip.GzipFile(fileobj=f, mode='ab')
+				try:
+					for record in by_month[month]:
+						gz.write(encode(record))
+				finally:
+					gz.close()
+				f.flush()
+				os.fsync(f.fileno())
+
+		for listener in self.listeners:
+			listener(records)
+
+	def months(self, start_date=None, end_date=None):
+		# the months that have an archive file, optionally those overlapping
+		# start_date up to, but excluding, end_date
+		if not os.path.isdir(self.directory):
+			return []
+		months = []
+		for name in os.listdir(self.directory):
+			if name.startswith(FILE_PREFIX) and name.endswith(FILE_SUFFIX):
+				try:
+					month = datetime.datetime.strptime(name[len(FILE_PREFIX):-len(FILE_SUFFIX)],
+						'%Y-%m').date()
+				except ValueError:
+					continue
+				if start_date != None and month < month_start(start_date):
+					continue
+				if end_date != None and month >= end_date:
+					continue
+				months.append(month)
+		return sorted(months)
+
+	def read_month(self, month):
+		# every record in the month's file, in the order they were archived
+		# a record archived twice, e.g. the job was stopped before the rows were
+		# deleted, is only returned once
+		seen = set()
+		path = self.path(month)
+		with gzip.open(path, 'rb') as gz:
+			try:
+				for line in gz:
+					if not line.strip():
+						continue
+					record = decode(line)
+					key = (record.get('kind'), record.get('id'), record.get('start_date'))
+					if key in seen:
+						continue
+					seen.add(key)
+					yield record
+			except (EOFError, IOError, ValueError, struct.error):
+				# a partial last member, e.g. power was lost while archiving
+				logging.warning('Archive %s is truncated, the rest is skipped', path)
+
+	def read(self, start_date=None, end_date=None, room=None, kind=BOOKING):
+		# a generator of the archived records of a kind, optionally those starting
+		# from start_date up to, but excluding, end_date and/or in a room
+		# records are in month order, and archive order within a month
+		for month in self.months(start_date, end_date):
+			for record in self.read_month(month):
+				if kind != None and record.get('kind') != kind:
+					continue
+				if room != None and record.get('room') != room:
+					continue
+				date = record.get('start_date')
+				if (start_date != None and date < start_date) or \
+					(end_date != None and date >= end_date):
+					continue
+				yield record
+
+
+archive = BookingArchive()
@@ -0,0 +1,232 @@
+# benchmarks for the command, availability and display hot paths
+# runs offline against a scratch sqlite db filled with synthetic bookings, using
+# the fake SlackClient and PyMata in fakes.py, and prints the results as json
+#
+# usage: python benchmarks/bench_app.py [--rows 10,1000,100000] [--iterations 20]
+#   [--output results.json]
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+DEFAULT_ROWS = '10,1000,10000,100000'
+DEFAULT_ITERATIONS = 20
+
+# synthetic dataset, half of the bookings are in the past
+BOOKINGS_PER_DAY = 8
+NUM_BOOKERS = 50
+BENCH_USER = 'UBENCH'
+BENCH_CHANNEL = 'CBENCH'
+BENCH_BOT_ID = 'UBENCHBOT'
+NUM_REMINDERS = 20
+
+COMMANDS = [
+	('free_now', 'free now'),
+	('free_tomorrow', 'free tomorrow morning'),
+	('free_this_week', 'free this week'),
+	('book', 'book 1 name Benchmark'),
+	('show', 'show'),
+	('show_all', 'show all'),
+	('name', 'name 1 Renamed'),
+	('status', 'status'),
+]
+
+# commands that need a previous command to have been run, e.g. for option numbers
+COMMAND_SETUP = {
+	'book': 'free tomorrow morning',
+	'name': 'show',
+}
+
+
+def percentile(values, p):
+	values = sorted(values)
+	index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+	return values[index]
+
+
+def measure(fn, iterations, setup=None):
+	# per call timings in seconds, setup isn't timed
+	times = []
+	for _ in range(iterations):
+		if setup:
+			setup()
+		start = timeit.default_timer()
+		fn()
+		times.append(timeit.default_timer() - start)
+	return {'iterations':iterations, 'min':min(times), 'max':max(times),
+		'mean':sum(times) / len(times), 'median':percentile(times, 50),
+		'p95':percentile(times, 95)}
+
+
+def expect_status(response, status, location=None):
+	if response.status_code != status or \
+		(location != None and not response.headers['Location'].endswith(location)):
+		raise AssertionError('Expected %d %s, got %d %s' % (status, location or '',
+			response.status_code, response.headers.get('Location', '')))
+	return response
+
+
+def generate_bookings(rooms, dtutils, num_rows, seed=1):
+	# bulk inserts num_rows bookings, spread over the rooms and centred on today
+	# bulk inserts skip the mapper events, so the epoch minutes are set here
+	rng = random.Random(seed)
+	room_ids = rooms.all_room_ids()
+	bookers = [BENCH_USER] + ['U%05d' % (i) for i in range(1, NUM_BOOKERS)]
+	num_days = max(1, num_rows // (BOOKINGS_PER_DAY * len(room_ids)) + 1)
+	today = dtutils.local_date_now()
+	first_day = today - datetime.timedelta(days=num_days // 2)
+
+	rows = []
+	for i in range(num_rows):
+		slot = i % BOOKINGS_PER_DAY
+		room = room_ids[(i // BOOKINGS_PER_DAY) % len(room_ids)]
+		date = first_day + datetime.timedelta(days=i // (BOOKINGS_PER_DAY * len(room_ids)))
+		start_time = 8 * 60 + slot * 75 + rng.choice((0, 15))
+		duration = rng.choice((15, 30, 30, 45, 60))
+		start = dtutils.to_epoch_minute(date, start_time)
+		rows.append({'start_date':date, 'start_time':start_time, 'duration':duration,
+			'booker_sid':rng.choice(bookers), 'attendees':rng.randint(1, 8),
+			'in_progress':False, 'finished':date < today, 'name':'Meeting %d' % (i),
+			'start_epoch_min':start, 'end_epoch_min':start + duration, 'room':room})
+	return rows, bookers
+
+
+def run(num_rows, iterations):
+	# must run in its own process, app reads DATABASE_URL when it's imported
+	import fakes
+	fakes.install()
+
+	tmp_dir = tempfile.mkdtemp(prefix='bench_app')
+	os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp_dir, 'bench.db')
+	# jobs builds the bot's mention from BOT_ID when the scheduler imports it
+	os.environ.setdefault('BOT_ID', BENCH_BOT_ID)
+	try:
+		from app import app, db, models, slack_client
+		import booking_index
+		import bookings
+		import dtutils
+		import jobs
+		import migrations
+		import outbox
+		import rooms
+		import slack_directory
+		import storage
+
+		logging.getLogger().setLevel(logging.WARNING)
+		app.config['WTF_CSRF_ENABLED'] = False
+
+		results = {}
+		with app.app_context():
+			db.create_all()
+			migrations.stamp()
+
+			rows, bookers = generate_bookings(rooms, dtutils, num_rows)
+			start = timeit.default_timer()
+			db.session.bulk_insert_mappings(models.ConfirmedBooking, rows)
+			storage.commit()
+			logging.warning('Inserted %d booking(s) in %1.2fs', num_rows,
+				timeit.default_timer() - start)
+
+			slack_client.user_sids = bookers
+			slack_directory.directory.sync()
+
+		outbox.outbox.start()
+		try:
+			with app.app_context():
+				results['booking_index_load'] = measure(booking_index.index.load,
+					max(1, iterations // 4))
+
+				for name, command in COMMANDS:
+					setup = None
+					if name in COMMAND_SETUP:
+						setup = lambda c=COMMAND_SETUP[name]: \
+							jobs.handle_command(c, BENCH_CHANNEL, BENCH_USER)
+					results['command_' + name] = measure(
+						lambda c=command: jobs.handle_command(c, BENCH_CHANNEL, BENCH_USER),
+						iterations, setup)
+
+				day = dtutils.local_datetime_now() + datetime.timedelta(days=1)
+				day, tod_in_mins = dtutils.adjust_time(day, bookings.FIRST_SLOT_START)
+				avail = []
+
+				def available_slots():
+					avail[:] = bookings.available_slots(day, tod_in_mins,
+						bookings.MIN_SLOT_DURATION)[0]
+
+				results['available_slots'] = measure(available_slots, iterations)
+				results['suggest_slots'] = measure(
+					lambda: bookings.suggest_slots(avail, bookings.MIN_SLOT_DURATION * 2),
+					iterations)
+				results['get_bookings_all'] = measure(lambda: bookings.get_bookings(None),
+					iterations)
+
+				reminder_ids = []
+
+				def add_reminders():
+					send_at = dtutils.utc_timestamp_now()
+					reminders = [models.Reminder(send_at=send_at, slack_channel=BENCH_CHANNEL,
+						text='Reminder %d' % (i), booking=1) for i in range(NUM_REMINDERS)]
+					db.session.add_all(reminders)
+					storage.commit()
+					reminder_ids[:] = [r.id for r in reminders]
+
+				results['send_reminders'] = measure(
+					lambda: jobs.send_reminders(reminder_ids), iterations, add_reminders)
+
+			# the room's own url, and the status is checked, so a redirect can't pass
+			# as a timing of the view. A display post redirects back to the room's url
+			client = app.test_client()
+			room_url = '/room/%s' % (rooms.default_room.id)
+			results['view_index_get'] = measure(lambda: expect_status(client.get(room_url),
+				200), iterations)
+			results['view_index_post'] = measure(lambda: expect_status(client.post(room_url,
+				data={'booking_id':'-1', 'action':'1'}), 302, room_url), iterations)
+		finally:
+			outbox.outbox.stop()
+
+		return {'rows':num_rows, 'slack_api_calls':slack_client.calls, 'results':results}
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def run_in_subprocess(num_rows, iterations):
+	out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+		'--rows', str(num_rows), '--iterations', str(iterations), '--single'])
+	return json.loads(out.decode('utf-8'))
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Offline benchmarks of the bot hot paths')
+	parser.add_argument('--rows', default=DEFAULT_ROWS,
+		help='comma separated dataset sizes (default %s)' % (DEFAULT_ROWS))
+	parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+	parser.add_argument('--output', help='also write the results to this file')
+	parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	sizes = [int(r) for r in args.rows.split(',')]
+	if args.single:
+		print(json.dumps(run(sizes[0], args.iterations)))
+		return
+
+	report = {'python':sys.version.split()[0], 'iterations':args.iterations,
+		'datasets':[run_in_subprocess(rows, args.iterations) for rows in sizes]}
+	output = json.dumps(report, indent=2, sort_keys=True)
+	print(output)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(output + '\n')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,88 @@
+# micro-benchmark for the command tokeniser and parser
+# compares the original eager punctuation table and if/elif parsing with commands.py
+#
+# usage: python benchmarks/bench_commands.py [iterations]
+import os
+import subprocess
+import sys
+import timeit
+import unicodedata
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import commands
+
+try:
+	xrange
+except NameError:
+	# py3
+	xrange = range
+	unichr = chr
+
+TOD_MODS = {'morning':480, 'lunchtime':690, 'afternoon':720}
+
+SAMPLE_COMMANDS = [u'free now', u'free this afternoon', u'free tomorrow morning',
+	u'free friday', u'book 2 name Weekly stand-up!', u'show all', u'name 1 Retro, again.',
+	u'status']
+
+
+def build_eager_table():
+	# the original table, probes every code point
+	return dict.fromkeys(x for x in xrange(sys.maxunicode)
+		if unicodedata.category(unichr(x)).startswith('P'))
+
+
+def parse_eager(tokens):
+	# the original if/elif parsing of the free command options
+	if len(tokens) >= 2:
+		if tokens[1] == commands.NOW or tokens[1] == commands.TODAY \
+			or (tokens[1] == commands.THIS and len(tokens) >= 3 and tokens[2] in TOD_MODS):
+			return tokens[1]
+		elif tokens[1] == commands.TOMORROW:
+			if len(tokens) >= 3 and tokens[2] in TOD_MODS:
+				return TOD_MODS[tokens[2]]
+		elif tokens[1] in commands.WEEKDAYS:
+			if len(tokens) >= 3 and tokens[2] in TOD_MODS:
+				return TOD_MODS[tokens[2]]
+	return None
+
+
+def time_import(statement):
+	# import cost in a fresh interpreter, so nothing is cached
+	code = 'import time; t = time.time(); %s; print(time.time() - t)' % (statement)
+	out = subprocess.check_output([sys.executable, '-c', code],
+		cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+	return float(out.strip())
+
+
+def main(iterations):
+	eager_table = build_eager_table()
+
+	def before():
+		for c in SAMPLE_COMMANDS:
+			parse_eager(c.translate(eager_table).lower().split())
+
+	def after():
+		for c in SAMPLE_COMMANDS:
+			commands.parse_day(commands.tokenise(c), TOD_MODS)
+
+	before_import = time_import('import unicodedata, sys; ' +
+		'd = dict.fromkeys(x for x in range(sys.maxunicode) ' +
+		'if unicodedata.category(chr(x) if sys.version_info[0] > 2 else unichr(x)).startswith("P"))')
+	after_import = time_import('import commands')
+
+	per_cmd = float(iterations * len(SAMPLE_COMMANDS))
+	before_parse = timeit.timeit(before, number=iterations) / per_cmd
+	after_parse = timeit.timeit(after, number=iterations) / per_cmd
+
+	print('import (punctuation table)  before: %8.3f ms  after: %8.3f ms' % \
+		(before_import * 1000, after_import * 1000))
+	print('parse (per command)         before: %8.2f us  after: %8.2f us' % \
+		(before_parse * 1000000, after_parse * 1000000))
+
+
+if __name__ == '__main__':
+	iterations = 10000
+	if len(sys.argv) > 1:
+		iterations = int(sys.argv[1])
+	main(iterations)
@@ -0,0 +1,81 @@
+# fake SlackClient and PyMata modules, so the app can be imported on a plain
+# linux box, without a slack token or the MCU on /dev/ttyS0
+# install() must be called before anything imports app
+import sys
+import types
+
+USERS_PER_PAGE = 200
+
+
+def slack_user(sid):
+	return {'id':sid, 'name':sid.lower(), 'deleted':False, 'is_bot':False,
+		'profile':{'real_name':'User %s' % (sid), 'image_48':'https://example.com/%s.png' % (sid)}}
+
+
+class FakeSlackClient:
+	# answers the web api calls made by the app, and counts them
+	def __init__(self, token=None):
+		self.token = token
+		self.calls = {}
+		self.user_sids = []
+
+	def api_call(self, method, **kwargs):
+		self.calls[method] = self.calls.get(method, 0) + 1
+		if method == 'users.info':
+			return {'ok':True, 'user':slack_user(kwargs.get('user'))}
+		elif method == 'users.list':
+			start = int(kwargs.get('cursor') or 0)
+			end = start + kwargs.get('limit', USERS_PER_PAGE)
+			next_cursor = str(end) if end < len(self.user_sids) else ''
+			return {'ok':True, 'members':[slack_user(sid) for sid in self.user_sids[start:end]],
+				'response_metadata':{'next_cursor':next_cursor}}
+		return {'ok':True}
+
+	def rtm_connect(self):
+		return True
+
+	def rtm_read(self):
+		return []
+
+
+class FakePyMata:
+	# a MCU with fixed sensor readings
+	INPUT = 0
+	OUTPUT = 1
+	ANALOG = 2
+	DIGITAL = 3
+	DIGITAL_LATCH_LOW = 0
+	DIGITAL_LATCH_HIGH = 1
+
+	def __init__(self, port_id=None, verbose=True):
+		self.port_id = port_id
+		self.analog = {}
+		self.digital = {}
+
+	def set_pin_mode(self, pin, mode, pin_type, cb=None):
+		pass
+
+	def set_sampling_interval(self, interval):
+		pass
+
+	def set_digital_latch(self, pin, threshold_type, cb=None):
+		pass
+
+	def analog_read(self, pin):
+		return self.analog.get(pin, 512)
+
+	def digital_write(self, pin, value):
+		self.digital[pin] = value
+
+
+def install():
+	slackclient = types.ModuleType('slackclient')
+	slackclient.SlackClient = FakeSlackClient
+	sys.modules['slackclient'] = slackclient
+
+	pymata_package = types.ModuleType('PyMata')
+	pymata = types.ModuleType('PyMata.pymata')
+	pymata.PyMata = FakePyMata
+	pymata_package.pymata = pymata
+	sys.modules['PyMata'] = pymata_package
+	sys.modules['PyMata.pymata'] = pymata
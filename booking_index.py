@@ -0,0 +1,255 @@
+import bisect
+import datetime
+import dtutils
+import logging
+import recurring
+import rooms
+import threading
+from app import models
+from config import RECURRING_HORIZON_DAYS
+
+# an in-memory index of confirmed bookings, one sorted array per room and day
+# it's loaded from the db once and then kept up to date by the code that
+# changes bookings, so availability queries don't need to hit the db
+# the occurrences of recurring bookings are merged in from the recurring index
+
+
+class IndexedBooking:
+	# a detached copy of the ConfirmedBooking fields the queries need
+	def __init__(self, booking):
+		self.id = booking.id
+		self.start_date = booking.start_date
+		self.start_time = booking.start_time
+		self.duration = booking.duration
+		self.end_time = booking.start_time + booking.duration
+		self.booker_sid = booking.booker_sid
+		self.attendees = booking.attendees
+		self.name = booking.name
+		self.in_progress = booking.in_progress
+		self.finished = booking.finished
+		self.room = booking.room
+
+	def __repr__(self):
+		return '<IndexedBooking %d %s %r %d %d %s>' % (self.id, self.room,
+			self.start_date, self.start_time, self.duration, self.booker_sid)
+
+
+def load_query(day_start):
+	# the bookings that end from day_start, an epoch minute, on
+	return models.ConfirmedBooking.query.filter(models.ConfirmedBooking.end_epoch_min >= day_start)
+
+
+def booking_key(booking):
+	# the order bookings are listed in, e.g. by show, unique for each booking
+	return (booking.start_date, booking.start_time, booking.room, '%s' % (booking.id))
+
+
+class DayIndex:
+	# the bookings for a single day, sorted by start time
+	def __init__(self):
+		self.starts = []
+		self.bookings = []
+		self.max_duration = 0
+
+	def add(self, booking):
+		i = bisect.bisect_right(self.starts, booking.start_time)
+		self.starts.insert(i, booking.start_time)
+		self.bookings.insert(i, booking)
+		if booking.duration > self.max_duration:
+			self.max_duration = booking.duration
+
+	def remove(self, booking_id):
+		for i in range(len(self.bookings)):
+			if self.bookings[i].id == booking_id:
+				del self.starts[i]
+				del self.bookings[i]
+				return True
+		return False
+
+	def ending_after(self, tod_in_mins):
+		# bookings that end at or after tod_in_mins, in start time order
+		# no booking is longer than max_duration, so the search can start there
+		i = bisect.bisect_left(self.starts, tod_in_mins - self.max_duration)
+		return [b for b in self.bookings[i:] if b.end_time >= tod_in_mins]
+
+	def __len__(self):
+		return len(self.bookings)
+
+
+class BookingIndex:
+	def __init__(self):
+		# (room, date) -> DayIndex
+		self.days = {}
+		# room -> sorted list of dates that have bookings
+		self.dates = {}
+		# booking id -> (room, date)
+		self.locations = {}
+		self.loaded = False
+		self.lock = threading.RLock()
+		self.listeners = []
+
+	def add_listener(self, listener):
+		# listener is called, without arguments, whenever a booking changes
+		self.listeners.append(listener)
+
+	def changed(self):
+		for listener in self.listeners:
+			listener()
+
+	def load(self):
+		# (re)build the index from the db, must be called within an app context
+		with self.lock:
+			self.days = {}
+			self.dates = {}
+			self.locations = {}
+			day_start = dtutils.to_epoch_minute(dtutils.local_date_now(), 0)
+			bookings = load_query(day_start).all()
+			for booking in bookings:
+				self._add(IndexedBooking(booking))
+			self.loaded = True
+		self.changed()
+		logging.info('Loaded %d booking(s) into the booking index', len(bookings))
+
+	def ensure_loaded(self):
+		if not self.loaded:
+			self.load()
+
+	def _add(self, indexed):
+		key = (indexed.room, indexed.start_date)
+		day = self.days.get(key)
+		if day == None:
+			day = DayIndex()
+			self.days[key] = day
+			bisect.insort(self.dates.setdefault(indexed.room, []), indexed.start_date)
+		day.add(indexed)
+		self.locations[indexed.id] = key
+
+	def _remove(self, booking_id):
+		key = self.locations.pop(booking_id, None)
+		if key == None:
+			return False
+		day = self.days[key]
+		day.remove(booking_id)
+		if len(day) == 0:
+			del self.days[key]
+			room, date = key
+			dates = self.dates[room]
+			del dates[bisect.bisect_left(dates, date)]
+		return True
+
+	def add(self, booking):
+		# call once the booking has been committed
+		with self.lock:
+			if self.loaded:
+				self._remove(booking.id)
+				self._add(IndexedBooking(booking))
+		self.changed()
+
+	def update(self, booking):
+		self.add(booking)
+
+	def remove(self, booking_id):
+		with self.lock:
+			if self.loaded:
+				self._remove(booking_id)
+		self.changed()
+
+	def remove_before(self, date):
+		# drop every day before the specified date, e.g. after a cleanup
+		with self.lock:
+			for room, dates in self.dates.items():
+				while dates and dates[0] < date:
+					day = self.days.pop((room, dates.pop(0)))
+					for booking in day.bookings:
+						self.locations.pop(booking.id, None)
+		recurring.index.remove_before(date)
+		self.changed()
+
+	def day_bookings(self, date, tod_in_mins=0, room=None):
+		# the bookings in the room on the specified day, that end at or after tod_in_mins
+		if room == None:
+			room = rooms.default_room.id
+		occurrences = [o for o in recurring.index.day_occurrences(date, room)
+			if o.end_time >= tod_in_mins]
+		with self.lock:
+			self.ensure_loaded()
+			day = self.days.get((room, date))
+			bookings = day.ending_after(tod_in_mins) if day else []
+		if occurrences:
+			bookings = sorted(bookings + occurrences, key=lambda b: b.start_time)
+		return bookings
+
+	def bookings_from(self, date, booker_sid=None, room=None, until_date=None):
+		# all bookings on or after the specified date, in date and start time order
+		# from every room, unless a room is specified
+		# recurring bookings are only expanded up to until_date, RECURRING_HORIZON_DAYS by default
+		return list(self.iter_bookings(date, booker_sid=booker_sid, room=room,
+			occurrences_until=until_date))
+
+	def iter_bookings(self, date, tod_in_mins=0, booker_sid=None, room=None, until_date=None,
+		occurrences_until=None):
+		# a generator of the bookings from date, that end at or after tod_in_mins on
+		# that date, up to, but excluding, until_date, in booking_key order
+		# from every room, unless a room is specified
+		# recurring bookings are only expanded up to occurrences_until, or until_date,
+		# RECURRING_HORIZON_DAYS by default
+		# the lock is only held while each day is copied, not while the caller iterates
+		if occurrences_until == None:
+			occurrences_until = until_date or date + datetime.timedelta(days=RECURRING_HORIZON_DAYS)
+		if until_date != None:
+			occurrences_until = min(occurrences_until, until_date)
+		occurrences = {}
+		for occurrence in recurring.index.occurrences_between(date, occurrences_until, room,
+			booker_sid):
+			occurrences.setdefault(occurrence.start_date, []).append(occurrence)
+
+		with self.lock:
+			self.ensure_loaded()
+			room_ids = [room] if room else list(self.dates.keys())
+			dates = set(occurrences)
+			for room_id in room_ids:
+				room_dates = self.dates.get(room_id, [])
+				end = len(room_dates)
+				if until_date != None:
+					end = bisect.bisect_left(room_dates, until_date)
+				dates.update(room_dates[bisect.bisect_left(room_dates, date):end])
+
+		for d in sorted(dates):
+			bookings = list(occurrences.get(d, []))
+			with self.lock:
+				for room_id in room_ids:
+					day = self.days.get((room_id, d))
+					if day:
+						bookings.extend(b for b in day.bookings \
+							if booker_sid == None or b.booker_sid == booker_sid)
+			if d == date:
+				bookings = [b for b in bookings if b.end_time >= tod_in_mins]
+			bookings.sort(key=booking_key)
+			for booking in bookings:
+				yield booking
+
+	def days_between(self, start_date, end_date, room=None):
+		# (date, bookings) for each day from start_date up to, but excluding, end_date
+		if room == None:
+			room = rooms.default_room.id
+		occurrences = {}
+		for occurrence in recurring.index.occurrences_between(start_date, end_date, room):
+			occurrences.setdefault(occurrence.start_date, []).append(occurrence)
+		with self.lock:
+			self.ensure_loaded()
+			days = []
+			date = start_date
+			while date < end_date:
+				day = self.days.get((room, date))
+				bookings = list(day.bookings) if day else []
+				if date in occurrences:
+					bookings = sorted(bookings + occurrences[date], key=lambda b: b.start_time)
+				days.append((date, bookings))
+				date += datetime.timedelta(days=1)
+			return days
+
+
+index = BookingIndex()
+
+# the room displays etc. are refreshed when a recurring booking changes too
+recurring.index.add_listener(index.changed)
@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from config import BOOKING_REF_MAX_USERS
+from config import BOOKING_REF_PATH
+from config import BOOKING_REF_TTL
+
+# the option numbers the show command gives a user's bookings, used by later
+# commands such as name. They're kept in memory, so show doesn't write to the db,
+# and optionally saved to a file every minute, so they survive a restart
+
+FILE_VERSION = 2
+
+
+class BookingRefStore:
+	# booker -> {ref -> booking id}, a recurring booking's id is negated, and where
+	# the next page of the booker's last show starts, if there is one
+	# a booker's refs expire after ttl seconds, and the least recently used booker
+	# is evicted once there are max_users
+	def __init__(self, ttl=BOOKING_REF_TTL, max_users=BOOKING_REF_MAX_USERS,
+		path=BOOKING_REF_PATH):
+		self.ttl = ttl
+		self.max_users = max_users
+		self.path = path
+		self.entries = OrderedDict()
+		self.loaded = False
+		# whether there are changes that haven't been saved
+		self.dirty = False
+		self.lock = threading.Lock()
+
+	def _load(self):
+		# reads the saved refs, if they're persisted, the lock must be held
+		self.loaded = True
+		if self.path == None or not os.path.exists(self.path):
+			return
+		try:
+			with open(self.path) as f:
+				data = json.load(f)
+		except (IOError, ValueError):
+			logging.exception('Failed to read the booking refs in %s', self.path)
+			return
+		if data.get('version') != FILE_VERSION:
+			return
+		now = time.time()
+		# saved in least recently used order
+		for booker_sid, expires_at, refs, next_page in data.get('entries', []):
+			if expires_at >= now:
+				self.entries[booker_sid] = (expires_at,
+					dict((int(ref), booking_id) for ref, booking_id in refs.items()), next_page)
+		logging.info('Loaded the booking refs of %d user(s)', len(self.entries))
+
+	def replace(self, booker_sid, refs, next_page=None, extend=False):
+		# replaces the booker's refs with refs, a dict of ref -> booking id, or adds
+		# them to the booker's refs if extend is set, e.g. for the next page
+		# next_page is anything json can encode, it's replaced either way
+		with self.lock:
+			if not self.loaded:
+				self._load()
+			entry = self.entries.pop(booker_sid, None)
+			if extend and entry != None and entry[0] >= time.time():
+				extended = dict(entry[1])
+				extended.update(refs)
+				refs = extended
+			if refs or next_page != None:
+				self.entries[booker_sid] = (time.time() + self.ttl, dict(refs), next_page)
+				while len(self.entries) > self.max_users:
+					evicted, _ = self.entries.popitem(last=False)
+					logging.debug('Evicted booking refs for %s', evicted)
+			self.dirty = True
+
+	def _get(self, booker_sid):
+		# the booker's entry, unless it has expired, the lock must be held
+		if not self.loaded:
+			self._load()
+		entry = self.entries.get(booker_sid)
+		if entry == None:
+			return None
+		if entry[0] < time.time():
+			del self.entries[booker_sid]
+			self.dirty = True
+			return None
+		# most recently used last
+		del self.entries[booker_sid]
+		self.entries[booker_sid] = entry
+		return entry
+
+	def get(self, booker_sid, booker_ref):
+		# the booking id of the booker's ref, or None
+		with self.lock:
+			entry = self._get(booker_sid)
+			if entry == None:
+				return None
+			return entry[1].get(booker_ref)
+
+	def get_next_page(self, booker_sid):
+		with self.lock:
+			entry = self._get(booker_sid)
+			if entry == None:
+				return None
+			return entry[2]
+
+	def remove(self, booker_sid):
+		with self.lock:
+			if not self.loaded:
+				self._load()
+			if self.entries.pop(booker_sid, None) != None:
+				self.dirty = True
+
+	def cleanup(self):
+		# removes the expired refs
+		now = time.time()
+		with self.lock:
+			if not self.loaded:
+				self._load()
+			for booker_sid, (expires_at, refs, next_page) in list(self.entries.items()):
+				if expires_at < now:
+					del self.entries[booker_sid]
+					self.dirty = True
+
+	def save(self):
+		# writes the refs to the file, if they're persisted and have changed
+		with self.lock:
+			if self.path == None or not self.dirty:
+				return
+			data = {'version':FILE_VERSION, 'entries':[[booker_sid, expires_at,
+				dict(('%d' % (ref), booking_id) for ref, booking_id in refs.items()), next_page]
+				for booker_sid, (expires_at, refs, next_page) in self.entries.items()]}
+			self.dirty = False
+
+		try:
+			directory = os.path.dirname(self.path)
+			if directory and not os.path.isdir(directory):
+				os.makedirs(directory)
+			tmp_path = self.path + '.tmp'
+			with open(tmp_path, 'w') as f:
+				json.dump(data, f, separators=(',', ':'))
+			os.rename(tmp_path, self.path)
+		except (IOError, OSError):
+			logging.exception('Failed to save the booking refs to %s', self.path)
+			with self.lock:
+				self.dirty = True
+
+
+store = BookingRefStore()
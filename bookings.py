@@ -1,17 +1,30 @@
+import booking_index
+import booking_refs
 import datetime
 import dtutils
+import itertools
 import logging
+import metrics
+import occupancy
+import recurring
+import reminders
+import rooms
+import storage
+import suggestions
 import time
 from app import db, models
+from config import RECURRING_HORIZON_DAYS
+from config import RECURRING_REMINDER_DAYS
 from config import UNNAMED_MEETING_NAME
 from dtutils import MINS_IN_HOUR
 from dtutils import SECONDS_IN_MIN
 from dtutils import DAY_IN_MINS
-from sqlalchemy import text
 
 FIRST_SLOT_START = 8 * MINS_IN_HOUR
 LAST_SLOT_START = 18 * MINS_IN_HOUR
 MIN_SLOT_DURATION = 15
+MAX_RANGE_DAYS = 7
+MAX_OPTION_REF = max(occupancy.MAX_SUGGESTIONS, MAX_RANGE_DAYS)
 MORNING = {'start':FIRST_SLOT_START, 'end':12 * MINS_IN_HOUR}
 LUNCHTIME = {'start':11 * MINS_IN_HOUR + 30, 'end':13 * MINS_IN_HOUR + 30}
 AFTERNOON = {'start':12 * MINS_IN_HOUR, 'end':LAST_SLOT_START}
@@ -19,6 +32,10 @@ REMINDER_MINS_BEFORE = 15
 REMINDER_MSG = "<@%s> '%s' is starting in %d minutes. See you there!"
 REMINDER_MSG_UNNAMED = '<@%s> You have a meeting starting in %d minutes. See you there!'
 
+admitted = metrics.Counter('bookings_admitted', 'Bookings and recurring bookings admitted')
+conflicts = metrics.Counter('booking_conflicts',
+	'Bookings rejected as they overlapped another booking')
+
 # All dates and times are UTC
 
 class Slot:
@@ -30,6 +47,7 @@ class Slot:
 		self.duration = -1
 		self.ref = None
 		self.booking = None
+		self.room = None
 		self.complete = 0
 	
 	def setEnd(self, end, alt_start, min_slot):
@@ -58,158 +76,299 @@ def align_booking_start(tod_in_mins):
 	return tod_in_mins + 15 - diff
 
 
-def remove_unconfirmed_bookings(booker_sid):
+def remove_unconfirmed_bookings(booker_sid, commit=True):
 	# delete any previous suggestions
-	models.UnconfirmedBooking.query. \
-		filter(models.UnconfirmedBooking.booker_sid == booker_sid).delete()
-	db.session.commit()
+	suggestions.store.remove(booker_sid, commit=commit)
 	logging.debug('Deleted any remaining unconfirmed booking(s) for %s', booker_sid)
 
 
-BOOKING_FILTER_STMT = text('start_date=:now_date and start_time + duration >= :now_tod')
-
-def available_slots(day, tod_in_mins, min_duration, booker_sid=None, clean_ucbookings=True):
+def available_slots(day, tod_in_mins, min_duration, room=None):
 	# create a list of times when the room is currently available
-	
-	# remove any existing unconfirmed bookings, for the specified user
-	if clean_ucbookings and booker_sid:
-		remove_unconfirmed_bookings(booker_sid)
+	if room == None:
+		room = rooms.default_room.id
 	
 	# get a list of existing bookings
 	slot_start = align_booking_start(tod_in_mins)
-	bookings = models.ConfirmedBooking.query.filter(BOOKING_FILTER_STMT).\
-		params(now_date=day.date(), now_tod=slot_start).order_by('start_time').all()
+	bookings = booking_index.index.day_bookings(day.date(), slot_start, room)
+	logging.debug('bookings: %s', bookings)
 
 	# get a list of available slots, e.g. unbooked times
+	occupied = occupancy.day_mask(bookings)
 	slots = []
-	index = -1
-	for booking in bookings:
-		logging.debug('booking: %s', booking)
-
-		end_time = booking.start_time + booking.duration
-		# first slot
-		if index== -1:
-			# the first booking in the list may have started in the past
-			if booking.start_time < slot_start:
-				slots.append(Slot(end_time))
-				index = 0
-				continue
-			else:
-				slots.append(Slot(slot_start))
-				index = 0
-		# existing slot, ending at the start of this booking
-		# unless the slot duration is less than the min duration
-		# in which case set slot to start at the end of this booking
-		slots[index].setEnd(booking.start_time, end_time, min_duration)
-		
-		# new slot, starting at the end of this booking
-		if slots[index].isComplete():
-			slots.append(Slot(end_time))
-			index += 1	
-
-	logging.debug('index: %d', index)
+	for start, end in occupancy.available_runs(occupied, slot_start, min_duration):
+		slot = Slot(start)
+		slot.setEnd(end, 0, min_duration)
+		slot.room = room
+		slots.append(slot)
 
 	# nothing in the db, so room is free for the rest of the day
-	no_bookings = False
-	if index == -1:
-		slot = Slot(slot_start)
-		slot.setEnd(DAY_IN_MINS, 0, min_duration)
-		slots = [slot]
-		no_bookings = True
-
-	# an incomplete slot could indicate that the last slot ends at midnight
-	# or it could indicates that the room is fully booked
-	if index >= 0 and not slots[index].isComplete():
-		# set the slot to end at midnight
-		slots[index].setEnd(DAY_IN_MINS, 0, min_duration)
-		
-		# if the slot is too short, remove it
-		if not slots[index].isComplete():
-			del slots[index]
-			index -= 1
+	no_bookings = len(bookings) == 0
 
 	return slots, no_bookings
 
 
+def to_slots(suggestions, room=None):
+	# converts (start, duration) suggestions into slots
+	slots = []
+	for start, duration in suggestions:
+		slot = Slot(start)
+		slot.setEnd(start + duration, 0, duration)
+		slot.room = room
+		slots.append(slot)
+		logging.debug('Added: suggested_slot(%d, %d, %d)' % (slot.start, slot.end, slot.duration))
+	return slots
+
+
 def suggest_slots(avail_slots, req_duration):
 	# create a list of up to 4 booking suggestions
-	suggested_slots = []
+	# the available slots are all in the same room
+	free = 0
+	room = None
 	for avail_slot in avail_slots:
-		if avail_slot.start > LAST_SLOT_START:
-			logging.debug('Break: avail_slot.start > LAST_SLOT_START')
+		free |= occupancy.range_mask(occupancy.to_slot_ceil(avail_slot.start),
+			occupancy.to_slot(avail_slot.end))
+		room = avail_slot.room
+
+	return to_slots(occupancy.suggest(free, req_duration, LAST_SLOT_START), room)
+
+
+def suggest_all_rooms(day, tod_in_mins, req_duration):
+	# create a list of up to 4 booking suggestions, the earliest across every room
+	# a time that's free in more than one room is only offered in the first of them
+	# no_bookings is only set if every suggestion is in a room without bookings, or there
+	# are no suggestions and no room has bookings
+	options = {}
+	all_rooms = rooms.all_rooms()
+	free_rooms = set()
+	for room in all_rooms:
+		avail_slots, room_no_bookings = available_slots(day, tod_in_mins, MIN_SLOT_DURATION,
+			room.id)
+		if room_no_bookings:
+			free_rooms.add(room.id)
+		for slot in suggest_slots(avail_slots, req_duration):
+			options.setdefault((slot.start, slot.duration), slot)
+
+	suggested = sorted(options.values(), key=lambda s: (s.start, s.duration))
+	suggested = suggested[:occupancy.MAX_SUGGESTIONS]
+	if suggested:
+		no_bookings = all(slot.room in free_rooms for slot in suggested)
+	else:
+		no_bookings = len(free_rooms) == len(all_rooms)
+	return suggested, no_bookings
+
+
+def available_days(day, tod_in_mins, num_days, req_duration, room=None):
+	# create a list with the best booking option for each of the num_days days
+	# starting with day, in a single pass over the booking index
+	# without a room, the option for each day is the earliest across every room
+	start_date = day.date()
+	end_date = start_date + datetime.timedelta(days=num_days)
+	room_ids = [room] if room else rooms.all_room_ids()
+
+	best = {}
+	for room_id in room_ids:
+		days = booking_index.index.days_between(start_date, end_date, room_id)
+		options = occupancy.scan_days(days, align_booking_start(tod_in_mins),
+			FIRST_SLOT_START, req_duration, LAST_SLOT_START)
+		for date, start, duration in options:
+			if date not in best or start < best[date].start:
+				slot = Slot(start)
+				slot.setEnd(start + duration, 0, duration)
+				slot.setDate(date)
+				slot.room = room_id
+				best[date] = slot
+
+	return [best[date] for date in sorted(best)]
+
+
+def create_unconfirmed_bookings(booker_sid, slots):
+	# store the booking suggestions, replacing any previous ones for the booker
+	# each slot must have a date and ref
+	suggestions.store.replace(booker_sid, [suggestions.Suggestion(slot.date, slot.start,
+		slot.duration, booker_sid, slot.ref, room=slot.room or rooms.default_room.id)
+		for slot in slots])
+
+
+def reminder_send_at(date, start_time):
+	# the timestamp of the reminder for a booking on date at start_time
+	t = datetime.time(hour=int(start_time / MINS_IN_HOUR), minute=start_time % MINS_IN_HOUR)
+	send_at = dtutils.to_timestamp(dtutils.convert_date_to_datetime(date, t))
+	return send_at - REMINDER_MINS_BEFORE * SECONDS_IN_MIN
+
+
+def reminder_text(booker_sid, name):
+	if name == None or name == UNNAMED_MEETING_NAME:
+		return REMINDER_MSG_UNNAMED % (booker_sid, REMINDER_MINS_BEFORE)
+	return REMINDER_MSG % (booker_sid, name, REMINDER_MINS_BEFORE)
+
+
+class BookingConflict(Exception):
+	# a new booking overlaps another one, e.g. one confirmed by someone else since
+	# the booking was suggested. booking is the other ConfirmedBooking or RecurringBooking
+	def __init__(self, booking):
+		Exception.__init__(self, 'Overlaps %r' % (booking))
+		self.booking = booking
+
+
+def index_conflict(room, date, start_time, duration, exclude=None):
+	# the first booking or occurrence in the index that overlaps, or None
+	# exclude is the id or occurrence key of a booking being replaced
+	end_time = start_time + duration
+	for b in booking_index.index.day_bookings(date, start_time, room):
+		if b.start_time >= end_time:
 			break
+		if b.end_time > start_time and not b.finished and \
+			(exclude == None or '%s' % (b.id) != '%s' % (exclude)):
+			return b
+	return None
+
 
-		# a slot that's req_duration mins long
-		if avail_slot.duration >= req_duration:
-			suggested_slot = Slot(avail_slot.start)
-			suggested_slot.setEnd(suggested_slot.start + req_duration, 0, req_duration)
-			suggested_slots.append(suggested_slot)
-			logging.debug('Added: suggested_slot(%d, %d, %d)' 
-				% (suggested_slot.start, suggested_slot.end, suggested_slot.duration))
-			if len(suggested_slots) == 4:
-				break
-
-			# a slot that's req_duration x 2 mins long
-			if avail_slot.duration >= req_duration * 2:
-				suggested_slot = Slot(avail_slot.start)
-				suggested_slot.setEnd(suggested_slot.start + req_duration * 2, 0, req_duration * 2)
-				suggested_slots.append(suggested_slot)
-				logging.debug('Added: suggested_slot(%d, %d, %d)' 
-					% (suggested_slot.start, suggested_slot.end, suggested_slot.duration))
-				if len(suggested_slots) == 4:
-					break
-
-			# a slot that's 1 hour later and that's req_duration mins long
-			if avail_slot.duration >= req_duration + MINS_IN_HOUR \
-				and avail_slot.start + MINS_IN_HOUR <= LAST_SLOT_START:
-				suggested_slot = Slot(avail_slot.start + MINS_IN_HOUR)
-				suggested_slot.setEnd(suggested_slot.start + req_duration, 0, req_duration)
-				suggested_slots.append(suggested_slot)
-				logging.debug('Added: suggested_slot(%d, %d, %d)' 
-					% (suggested_slot.start, suggested_slot.end, suggested_slot.duration))
-				if len(suggested_slots) == 4:
-					break
-
-			# a slot that's 2 hours later and that's req_duration mins long
-			if avail_slot.duration >= req_duration + MINS_IN_HOUR * 2 \
-				and avail_slot.start + MINS_IN_HOUR * 2 <= LAST_SLOT_START:
-				suggested_slot = Slot(avail_slot.start + MINS_IN_HOUR * 2)
-				suggested_slot.setEnd(suggested_slot.start + req_duration, 0, req_duration)
-				suggested_slots.append(suggested_slot)
-				logging.debug('Added: suggested_slot(%d, %d, %d)' 
-					% (suggested_slot.start, suggested_slot.end, suggested_slot.duration))
-				if len(suggested_slots) == 4:
-					break
-
-		# a slot that's at least {min_duration} mins duration
-		elif req_duration >= Slot.min_duration * 2 and avail_slot.duration >= req_duration / 2:
-			suggested_slot = Slot(avail_slot.start)
-			suggested_slot.setEnd(suggested_slot.start + avail_slot.duration, 0, req_duration / 2)
-			suggested_slots.append(suggested_slot)
-			logging.debug('Added: suggested_slot(%d, %d, %d)' 
-				% (suggested_slot.start, suggested_slot.end, suggested_slot.duration))
-			if len(suggested_slots) == 4:
-				break
-
-	return suggested_slots
-
-
-def create_unconfirmed_booking(day, slot, booker_sid):
-	# store a booking suggestion
-	ucbooking = models.UnconfirmedBooking(start_date=day.date(), start_time=slot.start, 
-				duration=slot.duration, booker_sid=booker_sid, booker_ref=slot.ref)
-	db.session.add(ucbooking)
-	db.session.commit()
+def conflicting_bookings(room, start, end, exclude_id=None):
+	# the bookings in the room that overlap start to end, in epoch minutes
+	# no booking is longer than a day, so the start is a bounded range of
+	# ix_confirmed_booking_room_start
+	return models.ConfirmedBooking.query.filter(models.ConfirmedBooking.room == room,
+		models.ConfirmedBooking.start_epoch_min > start - DAY_IN_MINS,
+		models.ConfirmedBooking.start_epoch_min < end,
+		models.ConfirmedBooking.end_epoch_min > start,
+		models.ConfirmedBooking.finished == False,
+		models.ConfirmedBooking.id != exclude_id)
+
+
+def exception_query(rule_id, date):
+	return models.RecurringException.query.filter_by(recurring_id=rule_id, date=date)
+
+
+def rule_bookings(rule):
+	# the bookings in the rule's room during its series, a superset of those that
+	# overlap its occurrences
+	end_time = rule.start_time + rule.duration
+	query = models.ConfirmedBooking.query.filter(models.ConfirmedBooking.room == rule.room,
+		models.ConfirmedBooking.start_epoch_min >= dtutils.to_epoch_minute(rule.start_date, 0),
+		models.ConfirmedBooking.finished == False)
+	if rule.until_date != None:
+		query = query.filter(models.ConfirmedBooking.start_epoch_min < \
+			dtutils.to_epoch_minute(rule.until_date, end_time))
+	return query
+
+
+def db_conflict(room, date, start_time, duration, exclude_id=None):
+	# the first booking or recurring booking in the db that overlaps on date, or None
+	start = dtutils.to_epoch_minute(date, start_time)
+	end = start + duration
+	booking = conflicting_bookings(room, start, end, exclude_id).first()
+	if booking:
+		return booking
+
+	rules = models.RecurringBooking.query.filter(models.RecurringBooking.room == room,
+		models.RecurringBooking.weekday == date.weekday(),
+		models.RecurringBooking.start_date <= date,
+		(models.RecurringBooking.until_date == None) | \
+		(models.RecurringBooking.until_date >= date),
+		models.RecurringBooking.start_time < start_time + duration,
+		models.RecurringBooking.start_time + models.RecurringBooking.duration > start_time).all()
+	for rule in rules:
+		if not exception_query(rule.id, date).count():
+			return rule
+	return None
+
+
+def recurring_conflict(rule):
+	# the first booking or other recurring booking in the db that overlaps any
+	# occurrence of the rule, or None
+	end_time = rule.start_time + rule.duration
+	query = models.RecurringBooking.query.filter(models.RecurringBooking.room == rule.room,
+		models.RecurringBooking.id != rule.id,
+		models.RecurringBooking.weekday == rule.weekday,
+		models.RecurringBooking.start_time < end_time,
+		models.RecurringBooking.start_time + models.RecurringBooking.duration > rule.start_time,
+		(models.RecurringBooking.until_date == None) | \
+		(models.RecurringBooking.until_date >= rule.start_date))
+	if rule.until_date != None:
+		query = query.filter(models.RecurringBooking.start_date <= rule.until_date)
+	other = query.first()
+	if other:
+		return other
+
+	for booking in rule_bookings(rule):
+		if booking.start_date >= rule.start_date and \
+			booking.start_date.weekday() == rule.weekday and \
+			booking.start_time < end_time and \
+			booking.start_time + booking.duration > rule.start_time:
+			return booking
+	return None
+
+
+def admit_booking(booking, exclude=None):
+	# adds a new ConfirmedBooking or RecurringBooking to the session, the caller commits
+	# raises BookingConflict, without adding it, if it overlaps another booking
+	# it's checked against the in-memory index first, which needs no db lock, then in
+	# the db once the booking has been flushed. The insert holds sqlite's write lock
+	# until the commit, so no overlapping booking can be committed in the meantime
+	# exclude is the id or occurrence key of a booking it replaces, in the same transaction
+	conflict = index_conflict(booking.room, booking.start_date, booking.start_time,
+		booking.duration, exclude)
+	if conflict == None:
+		db.session.add(booking)
+		db.session.flush()
+		if isinstance(booking, models.RecurringBooking):
+			conflict = recurring_conflict(booking)
+		else:
+			conflict = db_conflict(booking.room, booking.start_date, booking.start_time,
+				booking.duration, booking.id)
+		if conflict != None:
+			# so the rest of the caller's transaction can still be committed
+			db.session.delete(booking)
+			db.session.flush()
+
+	if conflict != None:
+		conflicts.inc()
+		logging.info('%r overlaps %r', booking, conflict)
+		raise BookingConflict(conflict)
+	admitted.inc()
+
+
+def confirm_recurring_booking(ucbooking, name, num_weeks=None, slack_channel=None):
+	# convert a booking suggestion into a weekly booking, for num_weeks weeks or
+	# until it's cancelled, only the rule is stored
+	# raises BookingConflict if any of its occurrences overlap another booking
+	until_date = None
+	if num_weeks:
+		until_date = ucbooking.start_date + datetime.timedelta(weeks=num_weeks - 1)
+	rule = models.RecurringBooking(weekday=ucbooking.start_date.weekday(),
+		start_time=ucbooking.start_time, duration=ucbooking.duration,
+		start_date=ucbooking.start_date, until_date=until_date,
+		booker_sid=ucbooking.booker_sid, attendees=ucbooking.attendees,
+		name=name, room=ucbooking.room, slack_channel=slack_channel)
+	admit_booking(rule)
+
+	# remove any remaining booking suggestions, in the same transaction
+	remove_unconfirmed_bookings(ucbooking.booker_sid, commit=False)
+	storage.commit()
+	storage.on_commit(lambda: add_recurring_booking(rule))
+	logging.debug('Created recurring booking for %s', ucbooking.booker_sid)
+	return rule
+
+
+def add_recurring_booking(rule):
+	# call once the rule has been committed
+	recurring.index.add_rule(rule)
+	if rule.slack_channel:
+		schedule_recurring_reminders(rule.id)
 
 
 def confirm_booking(booker_sid, booker_ref, attendees, name=None,
-	set_reminder=False, slack_channel=None):
+	set_reminder=False, slack_channel=None, room=None, weekly=False, num_weeks=None):
 	# convert a booking suggestion into a booking
+	# if a room is specified, the suggestion must be for that room
+	# a weekly booking returns the RecurringBooking, rather than a ConfirmedBooking
+	# raises BookingConflict if the slot has been booked since it was suggested
 	
 	# fetch the booking that is being confirmed
-	ucbooking = models.UnconfirmedBooking.query.filter( \
-		models.UnconfirmedBooking.booker_sid == booker_sid,
-		models.UnconfirmedBooking.booker_ref == booker_ref).first()
+	ucbooking = suggestions.store.get(booker_sid, booker_ref)
+	if ucbooking and room and ucbooking.room != room:
+		logging.debug('ucbooking %s is not in room %s', ucbooking, room)
+		ucbooking = None
 	if ucbooking:
 		logging.debug('ucbooking: %s', ucbooking)
 	
@@ -221,111 +380,130 @@ def confirm_booking(booker_sid, booker_ref, attendees, name=None,
 					ucbooking.attendees = 1
 			logging.debug('ucbooking.attendees: %d', ucbooking.attendees)
 			
-			reminder_text = None
+			text = None
+			if set_reminder:
+				text = reminder_text(booker_sid, name)
 			if name == None:
 				name=UNNAMED_MEETING_NAME
-				if set_reminder:
-					reminder_text = REMINDER_MSG_UNNAMED % (booker_sid, REMINDER_MINS_BEFORE)
-			elif set_reminder:
-				reminder_text = REMINDER_MSG % (booker_sid, name, REMINDER_MINS_BEFORE)
+
+			if weekly:
+				return confirm_recurring_booking(ucbooking, name, num_weeks,
+					slack_channel if set_reminder else None)
 		
 			# create the booking
 			booking = models.ConfirmedBooking(start_date=ucbooking.start_date,
 				start_time=ucbooking.start_time, duration=ucbooking.duration,
 				booker_sid=ucbooking.booker_sid, attendees=ucbooking.attendees,
-				name=name)
-			db.session.add(booking)
-			db.session.commit()
-			logging.debug('Created confirmed booking for %s', booker_sid)
+				name=name, room=ucbooking.room)
+			admit_booking(booking)
 
-			# remove any remaining booking suggestions
-			remove_unconfirmed_bookings(booker_sid)
-			
-			# add a reminder
+			# remove any remaining booking suggestions, in the same transaction
+			remove_unconfirmed_bookings(booker_sid, commit=False)
+
+			# add a reminder, the admitted booking already has its id
+			reminder = None
 			if set_reminder and slack_channel:
-				# fetch the booking we just saved, so we have the id
-				booking = models.ConfirmedBooking.query.filter( \
-					models.ConfirmedBooking.start_date == booking.start_date,
-					models.ConfirmedBooking.start_time == booking.start_time).first()
-				
-				if booking:					
-					# create the reminder
-					t = datetime.time(hour=int(booking.start_time / MINS_IN_HOUR),
-						minute=booking.start_time % MINS_IN_HOUR)
-					send_at = dtutils.to_timestamp( \
-						dtutils.convert_date_to_datetime(booking.start_date, t))
-					send_at -= REMINDER_MINS_BEFORE * SECONDS_IN_MIN
-					if send_at > time.time():
-						reminder = models.Reminder(send_at=send_at, booking=booking.id,
-							slack_channel=slack_channel, text=reminder_text)
-						db.session.add(reminder)
-						db.session.commit()
-						logging.debug('Created reminder for booking %d', booking.id)
+				send_at = reminder_send_at(booking.start_date, booking.start_time)
+				if send_at > time.time():
+					reminder = models.Reminder(send_at=send_at, booking=booking.id,
+						slack_channel=slack_channel, text=text)
+					db.session.add(reminder)
+			storage.commit()
+			storage.on_commit(lambda: booking_index.index.add(booking))
+			logging.debug('Created confirmed booking %d for %s', booking.id, booker_sid)
+			if reminder:
+				storage.on_commit(lambda: reminders.scheduler.add(reminder))
+				logging.debug('Created reminder for booking %d', booking.id)
 		
 			return booking
 	
 	return None
 
-BOOKING_ORDER_BY_STMT = text(('start_date, start_time'))
-
-def get_bookings(booker_sid, dt=None):
-	# create a list of bookings for the specified booker_sid
+def iter_bookings(booker_sid, dt=None, room=None, until_date=None, after=None):
+	# a generator of slots for the current and future bookings of the specified
+	# booker_sid, or everyone's if it's None, in every room by default
+	# up to, but excluding, until_date, and after the booking with the key after,
+	# see booking_index.booking_key, e.g. the last one already shown
 	if dt == None:
 		dt = dtutils.local_datetime_now()
 	query_date = dt.date()
-	
-	bookings = []
-	if booker_sid:
-		bookings = models.ConfirmedBooking.query.filter( \
-			models.ConfirmedBooking.start_date >=  query_date, 
-			models.ConfirmedBooking.booker_sid == booker_sid). \
-			order_by(BOOKING_ORDER_BY_STMT).all()				
-	else:
-		bookings = models.ConfirmedBooking.query.filter( \
-			models.ConfirmedBooking.start_date >=  query_date). \
-			order_by(BOOKING_ORDER_BY_STMT).all()				
-		
-	slots = []
-	for booking in bookings:
+	# bookings that have ended are skipped by the index, rather than made into slots
+	start_date = query_date
+	tod_in_mins = dt.hour * MINS_IN_HOUR + dt.minute
+	if after != None and after[0] > query_date:
+		start_date = after[0]
+		tod_in_mins = 0
+
+	# the recurring bookings are expanded the same number of days, whatever the page
+	occurrences_until = query_date + datetime.timedelta(days=RECURRING_HORIZON_DAYS)
+	for booking in booking_index.index.iter_bookings(start_date, tod_in_mins, booker_sid, room,
+		until_date, occurrences_until):
+		if after != None and booking_index.booking_key(booking) <= after:
+			continue
 		slot = Slot(booking.start_time)
 		slot.setEnd(booking.start_time + booking.duration, 0, MIN_SLOT_DURATION)
 		slot.setDate(booking.start_date)
 		slot.booking = booking
-		slots.append(slot)
+		slot.room = booking.room
+		yield slot
 
-	# remove any slots from before now, too messy to do in db given the small number
-	tod_in_mins = dt.hour * 60 + dt.minute
-	slots = [s for s in slots if not (s.date == query_date and s.end < tod_in_mins)]
 
-	return slots
+def get_bookings(booker_sid, dt=None, room=None, until_date=None, after=None, limit=None):
+	# a list of slots for the bookings, see iter_bookings, at most limit of them
+	return list(itertools.islice(iter_bookings(booker_sid, dt, room, until_date, after), limit))
+
+
+def count_bookings(booker_sid, dt=None, room=None):
+	# the number of current and future bookings, without making them into slots
+	if dt == None:
+		dt = dtutils.local_datetime_now()
+	return sum(1 for booking in booking_index.index.iter_bookings(dt.date(),
+		dt.hour * MINS_IN_HOUR + dt.minute, booker_sid, room))
 
 
 def remove_booking_refs(booker_sid):
 	# remove old references used by commands such as show and name
-	models.ConfirmedBookingRef.query. \
-		filter(models.ConfirmedBookingRef.booker_sid == booker_sid).delete()
-	db.session.commit()
-	logging.debug('Deleted any remaining booking ref(s) for %s', booker_sid)
+	booking_refs.store.remove(booker_sid)
+	logging.debug('Removed any remaining booking ref(s) for %s', booker_sid)
 
 
-def set_booking_refs(booker_sid, slots):
-	# remove any existing booking refs
-	remove_booking_refs(booker_sid)
-	
+def set_booking_refs(booker_sid, slots, next_page=None, extend=False):
+	# replaces the booker's refs, or adds to them if extend is set, e.g. for the next
+	# page of show. They're kept in memory rather than in the db
+	# next_page is (show_all, after, count), where the next page starts, see get_next_page
+	refs = {}
 	for slot in slots:
-		ref = models.ConfirmedBookingRef(booker_sid=slot.booking.booker_sid, booker_ref=slot.ref,
-			booking=slot.booking.id)
-		db.session.add(ref)
-	db.session.commit()
+		# an occurrence refers to its whole recurring booking
+		booking_id = slot.booking.id
+		if isinstance(slot.booking, recurring.Occurrence):
+			booking_id = -slot.booking.recurring_id
+		refs[slot.ref] = booking_id
+	if next_page != None:
+		show_all, after, count = next_page
+		# json friendly
+		next_page = [show_all, after[0].isoformat()] + list(after[1:]) + [count]
+	booking_refs.store.replace(booker_sid, refs, next_page, extend)
+
+
+def get_next_page(booker_sid):
+	# (show_all, after, count) where the booker's last show or more stopped, or None
+	# after is the booking_key of the last booking shown, count the last ref
+	next_page = booking_refs.store.get_next_page(booker_sid)
+	if next_page == None:
+		return None
+	show_all, date, start_time, room, booking_id, count = next_page
+	date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+	return show_all, (date, start_time, room, booking_id), count
 
 
 def get_booking_by_ref(booker_sid, booker_ref):
 	# fetch the booking indicated by the specified reference
-	ref = models.ConfirmedBookingRef.query.filter( \
-		models.ConfirmedBookingRef.booker_sid == booker_sid,
-		models.ConfirmedBookingRef.booker_ref == booker_ref).first()
-	if ref:
-		return models.ConfirmedBooking.query.get(ref.booking)
+	# either a ConfirmedBooking or a RecurringBooking
+	booking_id = booking_refs.store.get(booker_sid, booker_ref)
+	if booking_id != None:
+		if booking_id < 0:
+			return models.RecurringBooking.query.get(-booking_id)
+		return models.ConfirmedBooking.query.get(booking_id)
 
 	return None
 	
@@ -337,8 +515,88 @@ def update_booking_by_ref(booker_sid, booker_ref, name=None):
 		if booking:
 			booking.name = name
 			db.session.add(booking)
-			db.session.commit()
+			storage.commit()
+			if isinstance(booking, models.RecurringBooking):
+				storage.on_commit(lambda: recurring.index.update_rule(booking))
+			else:
+				storage.on_commit(lambda: booking_index.index.update(booking))
 			return booking
 		
 	return None
+
+
+def cancel_occurrence(rule_id, date):
+	# the recurring booking no longer occurs on date, the caller commits
+	db.session.add(models.RecurringException(recurring_id=rule_id, date=date))
+	storage.on_commit(lambda: recurring.index.add_exception(rule_id, date))
+
+
+def cancel_booking(booking_id):
+	# deletes a booking, or a single occurrence of a recurring booking
+	# booking_id is an id or occurrence key, as shown on the room display
+	key = recurring.parse_key(booking_id)
+	if key:
+		cancel_occurrence(*key)
+		storage.commit()
+		return
+
+	booking_id = int(booking_id)
+	models.ConfirmedBooking.query.filter_by(id = booking_id).delete()
+	models.Reminder.query.filter_by(booking = booking_id).delete()
+	storage.commit()
+	storage.on_commit(lambda: booking_index.index.remove(booking_id))
+
+
+def get_display_booking(booking_id):
+	# the ConfirmedBooking for an id or occurrence key, as shown on the room display
+	# an occurrence is replaced by a ConfirmedBooking, so it can be started and ended
+	key = recurring.parse_key(booking_id)
+	if key == None:
+		return models.ConfirmedBooking.query.get(int(booking_id))
+
+	rule_id, date = key
+	occurrence = recurring.index.get_occurrence(rule_id, date)
+	if occurrence == None:
+		return None
+	booking = models.ConfirmedBooking(start_date=date, start_time=occurrence.start_time,
+		duration=occurrence.duration, booker_sid=occurrence.booker_sid,
+		attendees=occurrence.attendees, name=occurrence.name, room=occurrence.room,
+		recurring_id=rule_id)
+	cancel_occurrence(rule_id, date)
+	return booking
+
+
+def schedule_recurring_reminders(rule_id=None):
+	# schedules the reminders for the occurrences in the next RECURRING_REMINDER_DAYS days
+	# of every recurring booking, or just the specified one, see job3
+	# the reminders aren't stored, they're regenerated after a restart
+	today = dtutils.local_date_now()
+	end_date = today + datetime.timedelta(days=RECURRING_REMINDER_DAYS)
+	now = time.time()
+	count = 0
+	for occurrence in recurring.index.occurrences_between(today, end_date):
+		if rule_id != None and occurrence.recurring_id != rule_id:
+			continue
+		rule = recurring.index.get_rule(occurrence.recurring_id)
+		if rule == None or rule.slack_channel == None:
+			continue
+		send_at = reminder_send_at(occurrence.start_date, occurrence.start_time)
+		if send_at > now:
+			reminders.scheduler.add_key(send_at, occurrence.id)
+			count += 1
+	logging.debug('Scheduled %d recurring reminder(s)', count)
+
+
+def get_recurring_reminder(key):
+	# (slack channel, text) of the reminder for an occurrence
+	# or None if it no longer occurs, e.g. it was cancelled
+	parsed = recurring.parse_key(key)
+	if parsed == None:
+		return None
+	rule_id, date = parsed
+	rule = recurring.index.get_rule(rule_id)
+	if rule == None or rule.slack_channel == None or \
+		recurring.index.get_occurrence(rule_id, date) == None:
+		return None
+	return rule.slack_channel, reminder_text(rule.booker_sid, rule.name)
 	
@@ -0,0 +1,177 @@
+import unicodedata
+
+# command parsing, kept free of app/db imports so it is cheap to import and to benchmark
+
+try:
+	unichr
+except NameError:
+	# py3
+	unichr = chr
+
+# command options
+NOW = 'now'
+TODAY = 'today'
+THIS = 'this'
+TOMORROW = 'tomorrow'
+WEEKDAY = 'weekday'
+WEEKDAYS = {'monday':0, 'tuesday':1, 'wednesday':2, 'thursday':3, 'friday':4,
+	'saturday':5, 'sunday':6, 'mon':0, 'tue':1, 'wed':2, 'thu':3, 'fri':4, 'sat':5,
+	'sun':6, 'tues':1, 'thur':3, 'thurs':3}
+ALL = 'all'
+NEXT = 'next'
+WEEK = 'week'
+DAYS = ('day', 'days')
+IN = 'in'
+WEEKLY = 'weekly'
+FOR = 'for'
+WEEKS = ('week', 'weeks')
+LAST = 'last'
+
+
+class PunctuationTable(dict):
+	# a translate() table that removes punctuation
+	# rather than probing every code point up front, each code point is
+	# classified the first time it is seen and the result is kept
+	def __missing__(self, code_point):
+		value = code_point
+		if unicodedata.category(unichr(code_point)).startswith('P'):
+			value = None
+		self[code_point] = value
+		return value
+
+
+NO_PUNCT_TRANS = PunctuationTable()
+
+def tokenise(s):
+	# convert to lowercase and remove punctuation before splitting
+	return s.translate(NO_PUNCT_TRANS).lower().split()
+
+
+class DayOption:
+	# the day and (optional) time of day requested by a command,
+	# e.g. 'now', 'this afternoon', 'tomorrow' or 'friday morning'
+	def __init__(self, when, weekday=None, tod_in_mins=None):
+		self.when = when
+		self.weekday = weekday
+		self.tod_in_mins = tod_in_mins
+
+	def __repr__(self):
+		return '<DayOption %s %s %s>' % (self.when, self.weekday, self.tod_in_mins)
+
+
+def parse_tod(tokens, index, tod_mods):
+	# the time of day modifier at tokens[index], if there is one
+	if len(tokens) > index:
+		return tod_mods.get(tokens[index])
+	return None
+
+
+def parse_day(tokens, tod_mods):
+	# parses the options following a command, tokens[0] is the command itself
+	# <now|today|tomorrow|(day of week)|this (morning|lunchtime|afternoon)> [time of day]
+	# anything that isn't recognised is treated as 'now'
+	if len(tokens) < 2:
+		return None
+
+	option = tokens[1]
+	if option == THIS:
+		return DayOption(TODAY, tod_in_mins=parse_tod(tokens, 2, tod_mods))
+	elif option == TOMORROW:
+		return DayOption(TOMORROW, tod_in_mins=parse_tod(tokens, 2, tod_mods))
+	elif option in WEEKDAYS:
+		return DayOption(WEEKDAY, weekday=WEEKDAYS[option],
+			tod_in_mins=parse_tod(tokens, 2, tod_mods))
+
+	return DayOption(TODAY)
+
+
+class RangeOption:
+	# a range of days requested by a command, e.g. 'this week' or 'next 5 days'
+	# num_days is None for the rest of this week
+	def __init__(self, num_days=None):
+		self.num_days = num_days
+
+	def __repr__(self):
+		return '<RangeOption %s>' % (self.num_days)
+
+
+def parse_range(tokens):
+	# parses a range of days following a command, tokens[0] is the command itself
+	# <this week|next (number) days>
+	if len(tokens) >= 3 and tokens[1] == THIS and tokens[2] == WEEK:
+		return RangeOption()
+	elif len(tokens) >= 4 and tokens[1] == NEXT and tokens[3] in DAYS:
+		num_days = parse_ref(tokens, 2)
+		if num_days != None and num_days >= 1:
+			return RangeOption(num_days)
+
+	return None
+
+
+def parse_period(tokens):
+	# parses a past period following a command, tokens[0] is the command itself
+	# last (number) <days|weeks>, returns the number of days or None
+	if len(tokens) >= 4 and tokens[1] == LAST and (tokens[3] in DAYS or tokens[3] in WEEKS):
+		num = parse_ref(tokens, 2)
+		if num != None and num >= 1:
+			if tokens[3] in WEEKS:
+				return num * 7
+			return num
+
+	return None
+
+
+def parse_ref(tokens, index=1):
+	# the booking/option number at tokens[index], or None if it isn't a number
+	if len(tokens) > index:
+		try:
+			return int(tokens[index])
+		except ValueError:
+			# the specified option wasn't an integer
+			pass
+	return None
+
+
+def parse_room(tokens, aliases, stop=None):
+	# finds a room qualifier, e.g. 'in 1d' or just '1d', after the command
+	# and before the stop token, e.g. so a booking name isn't searched
+	# returns (room id, tokens without the qualifier), the room id is None if there isn't one
+	for i in range(1, len(tokens)):
+		if tokens[i] == stop:
+			break
+		if tokens[i] in aliases:
+			start = i
+			if i > 1 and tokens[i - 1] == IN:
+				start = i - 1
+			return aliases[tokens[i]], tokens[:start] + tokens[i + 1:]
+	return None, tokens
+
+
+class RepeatOption:
+	# a weekly repeat requested by a command, e.g. 'weekly' or 'weekly for 6 weeks'
+	# num_weeks is None for a booking that repeats until it's cancelled
+	def __init__(self, num_weeks=None):
+		self.num_weeks = num_weeks
+
+	def __repr__(self):
+		return '<RepeatOption %s>' % (self.num_weeks)
+
+
+def parse_repeat(tokens, stop=None):
+	# finds a repeat qualifier, e.g. 'weekly' or 'weekly for 6 weeks', after the command
+	# and before the stop token
+	# returns (RepeatOption, tokens without the qualifier), the option is None if there isn't one
+	for i in range(1, len(tokens)):
+		if tokens[i] == stop:
+			break
+		if tokens[i] == WEEKLY:
+			end = i + 1
+			num_weeks = None
+			if len(tokens) > i + 3 and tokens[i + 1] == FOR and tokens[i + 3] in WEEKS:
+				num_weeks = parse_ref(tokens, i + 2)
+				if num_weeks != None and num_weeks >= 1:
+					end = i + 4
+				else:
+					num_weeks = None
+			return RepeatOption(num_weeks), tokens[:i] + tokens[end:]
+	return None, tokens
@@ -6,43 +6,182 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 # slack related
 BOT_ID = os.environ.get("BOT_ID")
 
+# seconds before a cached slack user is fetched again
+SLACK_USER_TTL = 24 * 60 * 60
+
+# max number of messages waiting to be sent to slack
+SLACK_OUTBOX_SIZE = 200
+
+# longer messages are split, at line breaks, into several messages
+SLACK_MESSAGE_MAX_CHARS = 4000
+
+# bookings listed per show or more command
+SHOW_PAGE_SIZE = 20
+
+# seconds to wait after a slack HTTP 429 without a Retry-After header
+SLACK_RETRY_AFTER_DEFAULT = 1
+
+# optional slack web api url, e.g. a local fake endpoint for testing
+SLACK_API_URL = os.environ.get("SLACK_API_URL")
+
+# max number of bot events waiting to be handled
+RTM_QUEUE_SIZE = 100
+
+# seconds the RTM reader waits when slack has no new events
+RTM_IDLE_SLEEP = 0.1
+
+# seconds the RTM reader waits before reconnecting
+RTM_RECONNECT_DELAY = 5
+
+# seconds after send_at that a reminder is counted as late
+REMINDER_LATE_SECS = 5
+
+# seconds after send_at that a reminder is no longer worth sending, e.g. after downtime
+REMINDER_MAX_LATENESS = 15 * 60
+
+# level of the dtutils logger, DEBUG logs every time conversion
+TIME_LOG_LEVEL = 'INFO'
+
 # db related
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
+# DATABASE_URL overrides the db, e.g. a scratch db for the benchmarks
+SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL',
+	'sqlite:///' + os.path.join(basedir, 'app.db'))
 SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
 SQLALCHEMY_TRACK_MODIFICATIONS=True
 
+# sqlite storage mode, 'flash' enables WAL journaling and tuned pragmas
+SQLITE_STORAGE_MODE = os.environ.get('SQLITE_STORAGE_MODE', 'default')
+
+# sqlite page cache size, in KiB
+SQLITE_CACHE_SIZE_KB = 2048
+
+# bytes of the db file sqlite can memory map
+SQLITE_MMAP_SIZE = 8 * 1024 * 1024
+
+# where booking suggestions are kept until they're confirmed, 'memory' or 'sqlite'
+SUGGESTION_STORE = 'memory'
+
+# seconds until booking suggestions expire, only used by the 'memory' store
+SUGGESTION_TTL = 24 * 60 * 60
+
+# max number of users with booking suggestions, only used by the 'memory' store
+SUGGESTION_MAX_USERS = 500
+
+# seconds until the option numbers show gives a user's bookings expire
+BOOKING_REF_TTL = 24 * 60 * 60
+
+# max number of users whose booking option numbers are kept
+BOOKING_REF_MAX_USERS = 500
+
+# where the booking option numbers are saved every minute, so they survive a
+# restart, see job7. An empty BOOKING_REF_PATH only keeps them in memory
+BOOKING_REF_PATH = os.environ.get('BOOKING_REF_PATH',
+	os.path.join(basedir, 'booking_refs.json')) or None
+
+# max number of days of occurrences cached per recurring booking
+RECURRING_CACHE_DAYS = 64
+
+# days ahead that show lists the occurrences of recurring bookings
+RECURRING_HORIZON_DAYS = 28
+
+# days ahead that the reminders for recurring bookings are scheduled, see job3
+RECURRING_REMINDER_DAYS = 2
+
+# rows deleted per commit by the cleanup job, see job3
+RETENTION_BATCH_SIZE = 200
+
+# seconds the cleanup job waits between batches, so other writers aren't blocked
+RETENTION_BATCH_PAUSE_SECS = 0.05
+
+# where the cleanup job archives expired bookings, one gzip jsonl file per month
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(basedir, 'archive'))
+
+# where the sensor samples kept for the stats command are stored
+ANALYTICS_DIR = os.environ.get('ANALYTICS_DIR', os.path.join(basedir, 'analytics'))
+
+# days of sensor samples and booking history the stats command can cover
+ANALYTICS_MAX_DAYS = 180
+
+# days covered by the stats command, unless the user asks for more
+ANALYTICS_DEFAULT_DAYS = 30
+
+# sensor samples buffered in memory before they're written to ANALYTICS_DIR
+ANALYTICS_FLUSH_SAMPLES = 10
+
+# the part of the bot run by this process, 'all' or one of 'mcu', 'bot' and 'web', see processes
+PROCESS_ROLE = os.environ.get('PROCESS_ROLE', 'all')
+
+# the file the processes share the sensor status and booking changes through, it
+# should be on a ram backed file system such as /tmp on the device
+STATUS_SNAPSHOT_PATH = os.environ.get('STATUS_SNAPSHOT_PATH', '/tmp/room-manager-status')
+
+# seconds between checks for booking changes made by the other processes
+SHARED_STATUS_POLL_SECS = 1
+
+# web server related
+# how the room displays are served, 'dev' for flask's development server or
+# 'production' for a WSGI server with gzip and fingerprinted static assets, see serving
+SERVER_MODE = os.environ.get('SERVER_MODE', 'dev')
+
+SERVER_HOST = os.environ.get('SERVER_HOST', '192.168.0.17')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', '5000'))
+
+# threads of the production server, each room display holds one while its
+# server-sent events stream is open
+SERVER_THREADS = 8
+
+# responses smaller than this many bytes aren't worth gzipping
+GZIP_MIN_SIZE = 500
+
+# gzip compression level of responses, static assets are precompressed at level 9
+GZIP_LEVEL = 6
+
+# seconds browsers cache the fingerprinted static assets, their urls change with their content
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
 # scheduler related
 JOBS = [
 	{
-		'id': 'job1',
+		'id': 'job3',
 		'replace_existing': True,
-		'func': 'jobs:read_slack_rtm',
-		'trigger': 'interval',
-		'seconds': 2,
+		'func': 'jobs:cleanup_bookings',
+		'trigger': 'cron',
+		'hour': 3,
 		'coalesce': True
 	},
 	{
-		'id': 'job2',
+		# aggregates the sensor readings, every SENSOR_SAMPLE_SECS
+		'id': 'job4',
 		'replace_existing': True,
-		'func': 'jobs:send_reminders',
-		'trigger': 'cron',
-		'minute': '*/15',
+		'func': 'jobs:mcu_handler',
+		'trigger': 'interval',
+		'seconds': 30,
 		'coalesce': True
 	},
 	{
-		'id': 'job3',
+		'id': 'job6',
 		'replace_existing': True,
-		'func': 'jobs:cleanup_bookings',
+		'func': 'jobs:db_maintenance',
 		'trigger': 'cron',
 		'hour': 3,
+		'minute': 30,
 		'coalesce': True
 	},
 	{
-		'id': 'job4',
+		# saves the booking option numbers, if they've changed
+		'id': 'job7',
 		'replace_existing': True,
-		'func': 'jobs:mcu_handler',
+		'func': 'jobs:save_booking_refs',
 		'trigger': 'interval',
-		'seconds': 30,
+		'seconds': 60,
+		'coalesce': True
+	},
+	{
+		'id': 'job5',
+		'replace_existing': True,
+		'func': 'jobs:log_metrics',
+		'trigger': 'interval',
+		'minutes': 5,
 		'coalesce': True
 	}
 
@@ -71,9 +210,25 @@ ELECTRICITY_SENSOR = 2
 TEMP_SENSOR = 1
 LIGHT_SENSOR = 0
 
+# seconds between sensor aggregations, see job4
+SENSOR_SAMPLE_SECS = 30
+
+# ms between the analog readings reported by the MCU
+MCU_SAMPLING_INTERVAL_MS = 1000
+
+# rolling statistics windows, name -> seconds. The temp and light windows hold every
+# reading, one per MCU_SAMPLING_INTERVAL_MS, the electricity ones a current per aggregation
+SENSOR_WINDOWS = {'1m':60, '5m':5 * 60, '1h':60 * 60}
+
+# smoothing factor of the sensor exponentially weighted moving averages
+SENSOR_EWMA_ALPHA = 0.2
+
 # controls when the ELECTRICITY_RELAY is activated (closed)
 LIGHT_SENSOR_THRESHOLD = {'low':490, 'high':650}
 
+# seconds the light must stay past a threshold before the relay is switched
+LIGHT_RELAY_DEBOUNCE_SECS = 5
+
 # controls when messages are sent to room bookers
 TEMP_SENSOR_THRESHOLD = {'low':18, 'high':25}
 
@@ -81,4 +236,30 @@ TEMP_SENSOR_THRESHOLD = {'low':18, 'high':25}
 LOW_TEMP_MESSAGE = "I'm a bit chilly! So you might want to being a sweater"
 HIGH_TEMP_MESSAGE = "I'm hot! So you might want to being a sweater"
 
-UNNAMED_MEETING_NAME = 'Unnamed Meeting'
\ No newline at end of file
+UNNAMED_MEETING_NAME = 'Unnamed Meeting'
+
+# rooms
+# the handle of the bot in slack, shown on the room displays
+BOT_HANDLE = '@room1d'
+
+# each room has an id, used in commands and display urls (/room/<id>), and
+# optionally the pins of the MCU that's connected to its sensors
+ROOMS = [
+	{
+		'id': 'room1d',
+		'name': 'Room 1D',
+		'type': 'Conference Room',
+		'aliases': ['1d'],
+		'pins': {
+			'motion': MOTION_SENSOR,
+			'relay': ELECTRICITY_RELAY,
+			'electricity': ELECTRICITY_SENSOR,
+			'temp': TEMP_SENSOR,
+			'light': LIGHT_SENSOR
+		}
+	}
+]
+
+# the room used by the display's default route and by commands that can't
+# search every room
+DEFAULT_ROOM = 'room1d'
@@ -1,4 +1,12 @@
 from config import SQLALCHEMY_DATABASE_URI
 from app import db
+from sqlalchemy import inspect
+import migrations
 import os.path
+
+is_new = len(inspect(db.engine).get_table_names()) == 0
 db.create_all()
+
+# a new db already has the latest schema, existing ones need db_upgrade.py
+if is_new:
+	migrations.stamp()
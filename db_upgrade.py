@@ -0,0 +1,20 @@
+import migrations
+import sys
+from app import app
+
+# upgrades an existing app.db to the latest schema
+# usage: python db_upgrade.py [--check]
+# --check verifies that the booking and reminder queries are served by indexes, see
+# migrations.checked_queries
+
+with app.app_context():
+	version = migrations.upgrade()
+	print('Schema version: %d' % (version))
+
+	if len(sys.argv) > 1 and sys.argv[1] == '--check':
+		failed = 0
+		for name, plan, ok in migrations.explain():
+			print('%s %s: %s' % ('ok  ' if ok else 'FAIL', name, '; '.join(plan)))
+			if not ok:
+				failed += 1
+		sys.exit(1 if failed else 0)
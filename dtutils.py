@@ -1,20 +1,95 @@
+import bisect
 import logging
-from datetime import datetime
+from config import TIME_LOG_LEVEL
+from datetime import datetime, time, timedelta
 from pytz import timezone
+from time import time as wall_time
 import pytz
 
 MINS_IN_HOUR = 60
 SECONDS_IN_MIN = 60
 DAY_IN_MINS = 24 * MINS_IN_HOUR
+DAY_IN_SECS = DAY_IN_MINS * SECONDS_IN_MIN
 
 TZ = timezone('Europe/Amsterdam')
 UTC = pytz.utc
 
 EPOCHE = datetime(1970, 1, 1, tzinfo=None)
 
+# max number of dates in the day timestamp cache
+DAY_TS_CACHE_SIZE = 512
+
+# the current day's utc offset and midnight are cached, rather than localizing
+# every call, until midnight or the next DST transition, whichever is first
+# the system clock is assumed to be in TZ, like datetime.now() always was
+
+logger = logging.getLogger('dtutils')
+logger.setLevel(TIME_LOG_LEVEL)
+
+# the debug messages are only formatted if the dtutils logger is at DEBUG
+DEBUG = logging.DEBUG
+
+
+def next_transition(ts):
+	# the timestamp of the next DST transition in TZ after ts
+	transitions = getattr(TZ, '_utc_transition_times', None)
+	if not transitions:
+		# not a pytz DST timezone, check again in an hour
+		return ts + MINS_IN_HOUR * SECONDS_IN_MIN
+	i = bisect.bisect_right(transitions, datetime.utcfromtimestamp(ts))
+	if i == len(transitions):
+		return float('inf')
+	return (transitions[i] - EPOCHE).total_seconds()
+
+
+class LocalDay:
+	# the local date, utc offset and midnight at timestamp now, valid until end
+	def __init__(self, now):
+		naive = datetime.fromtimestamp(now)
+		local = TZ.localize(naive)
+		self.date = naive.date()
+		self.tzinfo = local.tzinfo
+		self.utc_offset = local.utcoffset()
+		self.utc_offset_secs = self.utc_offset.total_seconds()
+		# the naive local time is timestamp + sys_offset_secs
+		self.sys_offset_secs = (naive - datetime.utcfromtimestamp(now)).total_seconds()
+		midnight = datetime.combine(self.date, time())
+		self.midnight_secs = (midnight - EPOCHE).total_seconds()
+		self.midnight_ts = to_timestamp(TZ.localize(midnight))
+		self.valid_from = now
+		self.end = min(self.midnight_secs - self.sys_offset_secs + DAY_IN_SECS,
+			next_transition(now))
+
+	def __repr__(self):
+		return '<LocalDay %s %s>' % (self.date, self.utc_offset)
+
+
+local_day = None
+
+
+def current_day():
+	# (the cached local day, the current timestamp)
+	global local_day
+	now = wall_time()
+	day = local_day
+	if day == None or now < day.valid_from or now >= day.end:
+		day = LocalDay(now)
+		local_day = day
+		logger.info('Local day: %s; utc offset: %s', day.date, day.utc_offset)
+	return day, now
+
+
+def now_minute_of_day():
+	# the local time of day, in minutes
+	day, now = current_day()
+	return int(now + day.sys_offset_secs - day.midnight_secs) // SECONDS_IN_MIN
+
+
 def utc_datetime_now():
-	dt = local_datetime_now().astimezone(UTC)
-	logging.debug('utc_datetime_now(): %s', dt)
+	day, now = current_day()
+	dt = (datetime.fromtimestamp(now) - day.utc_offset).replace(tzinfo=UTC)
+	if logger.isEnabledFor(DEBUG):
+		logger.debug('utc_datetime_now(): %s', dt)
 	return dt
 
 
@@ -27,16 +102,21 @@ def utc_time_now():
 
 
 def utc_timestamp_now():
-	return to_timestamp(utc_datetime_now())
+	day, now = current_day()
+	return now + day.sys_offset_secs - day.utc_offset_secs
 
 
 def local_datetime_now():
-	dt = TZ.localize(datetime.now())
-	logging.debug('local_datetime_now(): %s', dt)
+	day, now = current_day()
+	# the same as TZ.localize(), as the offset is valid for the whole cached day
+	dt = datetime.fromtimestamp(now).replace(tzinfo=day.tzinfo)
+	if logger.isEnabledFor(DEBUG):
+		logger.debug('local_datetime_now(): %s', dt)
 	return dt
 
+
 def local_date_now():
-	return local_datetime_now().date()
+	return current_day()[0].date
 
 
 def local_time_now():
@@ -44,27 +124,52 @@ def local_time_now():
 
 
 def to_timestamp(dt):
-	logging.debug('to_timestamp(%s)', dt)
 	utc_dt = dt
 	if utc_dt.tzinfo:
 		utc_dt = utc_dt.replace(tzinfo=None) - utc_dt.utcoffset()
-	logging.debug('utc_dt: %s', utc_dt)
 	ts = (utc_dt - EPOCHE).total_seconds()
-	logging.debug('ts: %d', ts)
+	if logger.isEnabledFor(DEBUG):
+		logger.debug('to_timestamp(%s): %d', dt, ts)
 	return ts
 
 def to_day_timestamp(dt):
-	logging.debug('to_day_timestamp(%s)', dt)
 	ts = (datetime(dt.year, dt.month, dt.day, tzinfo=None)- EPOCHE).total_seconds()
-	logging.debug('ts: %d', ts)
 	utc_offset = dt.utcoffset()
 	if utc_offset:
-		logging.debug('dt.utcoffset(): %s', utc_offset)
 		ts -= utc_offset.total_seconds()
-		logging.debug('ts: %d', ts)
+	if logger.isEnabledFor(DEBUG):
+		logger.debug('to_day_timestamp(%s): %d; utc offset: %s', dt, ts, utc_offset)
+	return ts
+
+
+day_ts_cache = {}
+
+
+def day_ts(date):
+	# the timestamp of local midnight on date, the same as
+	# to_day_timestamp(convert_date_to_datetime(date)), without localizing
+	day = current_day()[0]
+	if date == day.date:
+		return day.midnight_ts
+	ts = day_ts_cache.get(date)
+	if ts == None:
+		ts = to_day_timestamp(convert_date_to_datetime(date))
+		if len(day_ts_cache) >= DAY_TS_CACHE_SIZE:
+			day_ts_cache.clear()
+		day_ts_cache[date] = ts
 	return ts
 
 
+def day_timestamps(dates):
+	# batch version of day_ts, e.g. for formatting a list of bookings
+	# returns a dict of date -> timestamp, each date is only converted once
+	timestamps = {}
+	for date in dates:
+		if date not in timestamps:
+			timestamps[date] = day_ts(date)
+	return timestamps
+
+
 def is_today(dt):
 	return dt.date() == utc_date_now()
 
@@ -93,3 +198,10 @@ def convert_date_to_datetime(date, time=None):
 	return TZ.localize(datetime.combine(date, time))
 
 
+def to_epoch_minute(date, tod_in_mins):
+	# minutes since the epoch (UTC) of a local date and time of day
+	if tod_in_mins >= DAY_IN_MINS:
+		return to_epoch_minute(date + timedelta(days=tod_in_mins // DAY_IN_MINS),
+			tod_in_mins % DAY_IN_MINS)
+	t = time(hour=tod_in_mins // MINS_IN_HOUR, minute=tod_in_mins % MINS_IN_HOUR)
+	return int(to_timestamp(convert_date_to_datetime(date, t))) // SECONDS_IN_MIN
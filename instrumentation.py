@@ -0,0 +1,134 @@
+import dtutils
+import functools
+import logging
+import metrics
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from apscheduler.events import EVENT_JOB_MISSED
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES
+from apscheduler.events import EVENT_JOB_SUBMITTED
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# timing histograms and db query counts for the scheduled jobs and slack commands
+# plus scheduler misfire, coalesce and max instance counters
+# everything is exported by the /metrics endpoint
+
+# max missed runs counted when a coalesced job runs, e.g. after a long stall
+MAX_COALESCED_COUNT = 1000
+
+job_seconds = metrics.Family(metrics.Histogram, 'job_seconds',
+	'Time taken by scheduled jobs', 'job')
+job_db_queries = metrics.Family(metrics.Histogram, 'job_db_queries',
+	'Db queries per scheduled job run', 'job', buckets=metrics.COUNT_BUCKETS)
+job_errors = metrics.Family(metrics.Counter, 'job_errors',
+	'Scheduled jobs that raised an error', 'job')
+job_start_delay = metrics.Family(metrics.Histogram, 'job_start_delay_seconds',
+	'Time from a run being due to it being submitted to a worker thread', 'job')
+job_misfires = metrics.Family(metrics.Counter, 'job_misfires',
+	'Job runs missed, too late to run', 'job')
+job_coalesced = metrics.Family(metrics.Counter, 'job_coalesced',
+	'Missed job runs combined into a later run', 'job')
+job_max_instances = metrics.Family(metrics.Counter, 'job_max_instances',
+	'Job runs skipped, the previous run was still running', 'job')
+
+command_seconds = metrics.Family(metrics.Histogram, 'command_seconds',
+	'Time taken by slack commands', 'command')
+command_db_queries = metrics.Family(metrics.Histogram, 'command_db_queries',
+	'Db queries per slack command', 'command', buckets=metrics.COUNT_BUCKETS)
+command_errors = metrics.Family(metrics.Counter, 'command_errors',
+	'Slack commands that raised an error', 'command')
+
+db_queries = metrics.Counter('db_queries', 'Db queries')
+
+_local = threading.local()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+	_local.queries = getattr(_local, 'queries', 0) + 1
+	db_queries.inc()
+
+
+def query_count():
+	# the number of db queries made by the current thread
+	return getattr(_local, 'queries', 0)
+
+
+@contextmanager
+def measure(seconds, queries, errors):
+	# observes the time taken and db queries made by the block
+	start = time.time()
+	start_queries = query_count()
+	try:
+		yield
+	except Exception:
+		errors.inc()
+		raise
+	finally:
+		seconds.observe(time.time() - start)
+		queries.observe(query_count() - start_queries)
+
+
+def measure_command(command):
+	return measure(command_seconds.get(command), command_db_queries.get(command),
+		command_errors.get(command))
+
+
+def timed_job(job_id, func):
+	# wraps a job function, so every run is measured
+	seconds = job_seconds.get(job_id)
+	queries = job_db_queries.get(job_id)
+	errors = job_errors.get(job_id)
+
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		with measure(seconds, queries, errors):
+			return func(*args, **kwargs)
+
+	return wrapper
+
+
+def count_missed_runs(trigger, previous, run_time):
+	# the number of fire times between two runs, that were coalesced into run_time
+	count = 0
+	fire_time = trigger.get_next_fire_time(previous, previous + timedelta(microseconds=1))
+	while fire_time != None and fire_time < run_time and count < MAX_COALESCED_COUNT:
+		count += 1
+		fire_time = trigger.get_next_fire_time(fire_time,
+			fire_time + timedelta(microseconds=1))
+	return count
+
+
+def instrument_scheduler(scheduler):
+	# wraps every job added from config.JOBS and counts misfires, coalesced runs
+	# and skipped runs, call before the scheduler is started
+	for job in scheduler.get_jobs():
+		scheduler.modify_job(job.id, func=timed_job(job.id, job.func))
+
+	# job id -> the last scheduled run time that was submitted
+	last_run_times = {}
+
+	def on_event(e):
+		if e.code == EVENT_JOB_MISSED:
+			job_misfires.get(e.job_id).inc()
+		elif e.code == EVENT_JOB_MAX_INSTANCES:
+			job_max_instances.get(e.job_id).inc()
+		elif e.code == EVENT_JOB_SUBMITTED and e.scheduled_run_times:
+			run_time = e.scheduled_run_times[-1]
+			delay = time.time() - dtutils.to_timestamp(run_time)
+			job_start_delay.get(e.job_id).observe(max(0, delay))
+
+			previous = last_run_times.get(e.job_id)
+			last_run_times[e.job_id] = run_time
+			job = scheduler.get_job(e.job_id)
+			if previous != None and job != None and job.coalesce:
+				missed = count_missed_runs(job.trigger, previous, run_time)
+				if missed:
+					job_coalesced.get(e.job_id).inc(missed)
+					logging.warning('Job %s: %d missed run(s) coalesced', e.job_id, missed)
+
+	scheduler.add_listener(on_event,
+		EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES | EVENT_JOB_SUBMITTED)
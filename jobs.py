@@ -1,23 +1,34 @@
+import analytics
+import booking_index
+import booking_refs
 import bookings
+import commands
 from datetime import datetime, timedelta
 import dtutils
+import instrumentation
 import logging
 import mcu_utils
+import metrics
+import outbox
+import recurring
+import retention
+import rooms
+import slack_directory
 import slackutils
+import storage
 import string
-import sys
 import time
-import unicodedata
-from app import db, models, slack_client
+from app import db, models
 from bookings import MIN_SLOT_DURATION
-from bookings import SECONDS_IN_MIN
+from config import ANALYTICS_DEFAULT_DAYS
+from config import ANALYTICS_MAX_DAYS
 from config import BOT_ID
+from config import SHOW_PAGE_SIZE
 from config import TEMP_SENSOR_THRESHOLD
 from config import LOW_TEMP_MESSAGE
 from config import HIGH_TEMP_MESSAGE
 
 from dtutils import MINS_IN_HOUR
-from sqlalchemy import text
 
 AT_BOT = "<@" + BOT_ID + ">"
 
@@ -27,27 +38,38 @@ BOOK_COMMAND = 'book'
 SHOW_COMMAND = 'show'
 NAME_COMMAND = 'name'
 STATUS_COMMAND = 'status'
+STATS_COMMAND = 'stats'
+MORE_COMMAND = 'more'
 
 # command options
-NOW = 'now'
-TODAY = 'today'
-THIS = 'this'
-TOMORROW = 'tomorrow'
-WEEKDAYS = {'monday':0, 'tuesday':1, 'wednesday':2, 'thursday':3, 'friday':4, 
-	'saturday':5, 'sunday':6, 'mon':0, 'tue':1, 'wed':2, 'thu':3, 'fri':4, 'sat':5,
-	'sun':6, 'tues':1, 'thur':3, 'thurs':3}
+NOW = commands.NOW
+TODAY = commands.TODAY
+THIS = commands.THIS
+TOMORROW = commands.TOMORROW
+WEEKDAYS = commands.WEEKDAYS
 TOD_MODS = {'morning':bookings.MORNING['start'],
 	'lunchtime':bookings.LUNCHTIME['start'],'afternoon':bookings.AFTERNOON['start']}
-ALL = 'all'
+ALL = commands.ALL
+WEEKDAY_NAMES = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+
+def format_slack_room(room_id):
+	# the room, when the bot manages more than one
+	room = rooms.get_room(room_id)
+	if room and rooms.is_multi_room():
+		return ' in %s' % (room.name)
+	return ''
 
 
 def format_slack_slot(slack_date, date_ts, slot):
 	# formats a single booking suggestions ready for sending to slack
 	t = slackutils.format_slack_time(date_ts, slot.start)
+	where = format_slack_room(slot.room)
 	if slot.booking and slot.booking.name:
-		return '%s at %s for %d mins - %s' % (slack_date, t, slot.duration, slot.booking.name)
+		return '%s at %s for %d mins%s - %s' % (slack_date, t, slot.duration, where,
+			slot.booking.name)
 	else:
-		return '%s at %s for %d mins' % (slack_date, t, slot.duration)
+		return '%s at %s for %d mins%s' % (slack_date, t, slot.duration, where)
 	
 
 def format_slack_booking(slack_date, date_ts, start_time, duration=0, full=False):
@@ -59,6 +81,19 @@ def format_slack_booking(slack_date, date_ts, start_time, duration=0, full=False
 	return ('%s at %s' % (slack_date, t))
 
 
+def format_slack_conflict(option, booking):
+	# formats the reply to a book command whose option has been booked in the meantime
+	# booking is the ConfirmedBooking or RecurringBooking it overlaps
+	day_ts = dtutils.day_ts(booking.start_date)
+	d = slackutils.format_slack_date(booking.start_date, day_ts)
+	when = format_slack_booking(d, day_ts, booking.start_time, booking.duration, full=True)
+	if isinstance(booking, models.RecurringBooking):
+		when = 'every %s from %s' % (WEEKDAY_NAMES[booking.weekday], when)
+	return ("Sorry, option `%s` is no longer free%s, it overlaps a booking %s\n" + \
+		"Use *%s* to see what's available now") % (option, format_slack_room(booking.room), when,
+		FREE_COMMAND)
+
+
 def format_free_response(suggested_slots, no_bookings, day, tod_in_mins):
 	# formats the response to a FREE_COMMAND ready for sending to slack
 	if no_bookings:
@@ -107,6 +142,25 @@ def format_free_response(suggested_slots, no_bookings, day, tod_in_mins):
 	return msg
 
 
+def format_free_range_response(suggested_slots, num_days):
+	# formats the response to a FREE_COMMAND for a range of days ready for sending to slack
+	if len(suggested_slots) == 0:
+		return "Sorry, I'm fully booked for the next %d days" % (num_days)
+
+	if len(suggested_slots) == 1:
+		msg = 'This is the best option for the next %d days:' % (num_days)
+	else:
+		msg = 'These are the best options for the next %d days:' % (num_days)
+
+	day_tss = dtutils.day_timestamps(slot.date for slot in suggested_slots)
+	for slot in suggested_slots:
+		day_ts = day_tss[slot.date]
+		d = slackutils.format_slack_date(slot.date, day_ts)
+		msg += ('\n`%d` %s' % (slot.ref, format_slack_slot(d, day_ts, slot)))
+
+	return msg
+
+
 def format_slack_status(status):
 	# formats a status msg ready for sending to slack
 	msg = "Sorry but I'm not able to share my status at this time"
@@ -125,9 +179,10 @@ def format_slack_status(status):
 		if status['temp']:
 			msg += 'Temperature: %1.0fC\n' % (status['temp'])
 		
-		if status['current'] and status['current'].get_latest_value() > 0:
+		current = status['current'].get_latest_value()
+		if current and current > 0:
 			msg += 'The wall socket is in use: %1.1fmA (5 min average: %1.1fmA)' % \
-				(status['current'].get_latest_value(), status['current'].get_average())
+				(current, status['current'].get_average(mcu_utils.AVERAGE_WINDOW))
 		else:
 			msg += 'The wall sock is not in use'
 			
@@ -135,33 +190,300 @@ def format_slack_status(status):
 
 
 def update_slack_user(sid):
-	# fetches the current user.info from slack and stores it in the db
-	slack_user = slackutils.get_slack_user(sid)
-	if slack_user:
-		user = models.SlackUser.query.filter(models.SlackUser.sid == sid).first()
-		if user:
-			user.name = slack_user['name']
-			user.real_name = slack_user['real_name']
-			user.image_48 = slack_user['image_48']
+	# makes sure the user's details are stored in the db, for the room display
+	# served from the local user directory, which only calls slack if it's stale
+	slack_directory.directory.get(sid)
+
+
+def strip_whitespace(s):
+	return s.strip(string.whitespace)
+
+
+def resolve_day(option, now):
+	# converts a parsed day option into a local datetime and time of day
+	day = now
+	tod_in_mins = day.hour * MINS_IN_HOUR + day.minute
+	if option.when == commands.TODAY:
+		if option.tod_in_mins != None:
+			day, tod_in_mins = dtutils.adjust_time(day, option.tod_in_mins, force=False)
+		return day, tod_in_mins
+
+	if option.when == commands.TOMORROW:
+		day = day + timedelta(days=1)
+	elif option.when == commands.WEEKDAY:
+		today = day.weekday()
+		offset = option.weekday - today
+		if option.weekday <= today:
+			offset += 7
+		day = day + timedelta(days=offset)
+
+	tod = option.tod_in_mins
+	if tod == None:
+		tod = bookings.MORNING['start']
+	return dtutils.adjust_time(day, tod)
+
+
+def free_command(command, tokens, channel, user):
+	# get a list of suggested booking options for the specified day and time
+	# free <now|today|tomorrow|(day of week)|(this morning|lunchtime|afternoon|evening)>
+	#   [in <room>]
+	# without a room, every room is searched
+	response = 'Use *' + FREE_COMMAND + '* and specify a day, for example *now* or \
+		*this afternoon* or *tomorrow* or *Mon* or *friday morning* or *this week*'
+	room, tokens = commands.parse_room(tokens, rooms.ALIASES)
+	range_option = commands.parse_range(tokens)
+	if range_option:
+		return free_range_command(range_option, user, room)
+
+	option = commands.parse_day(tokens, TOD_MODS)
+	if option == None:
+		return response
+
+	day, tod_in_mins = resolve_day(option, dtutils.local_datetime_now())
+	logging.debug('adjusted day: %s; tod_in_mins: %d' % (day, tod_in_mins))
+
+	if room:
+		# check when the room is free
+		available_slots, no_bookings = bookings.available_slots(day, tod_in_mins,
+			bookings.MIN_SLOT_DURATION, room)
+
+		# create a list of suggested bookings
+		suggested_slots = bookings.suggest_slots(available_slots,
+			MIN_SLOT_DURATION * 2)
+	else:
+		suggested_slots, no_bookings = bookings.suggest_all_rooms(day, tod_in_mins,
+			MIN_SLOT_DURATION * 2)
+
+	# store them, awaiting confirmation
+	count = 1
+	for slot in suggested_slots:
+		slot.ref = count
+		slot.setDate(day.date())
+		count += 1
+	bookings.create_unconfirmed_bookings(user, suggested_slots)
+
+	# prepare the slack response
+	return format_free_response(suggested_slots, no_bookings, day, tod_in_mins)
+
+
+def free_range_command(option, user, room=None):
+	# get the best booking option for each day in a range of days
+	# free <this week|next (number) days> [in <room>]
+	now = dtutils.local_datetime_now()
+	num_days = option.num_days
+	if num_days == None:
+		num_days = 7 - now.weekday()
+	num_days = min(num_days, bookings.MAX_RANGE_DAYS)
+
+	tod_in_mins = now.hour * MINS_IN_HOUR + now.minute
+	suggested_slots = bookings.available_days(now, tod_in_mins, num_days,
+		MIN_SLOT_DURATION * 2, room)
+
+	# store them, awaiting confirmation
+	count = 1
+	for slot in suggested_slots:
+		slot.ref = count
+		count += 1
+	bookings.create_unconfirmed_bookings(user, suggested_slots)
+
+	return format_free_range_response(suggested_slots, num_days)
+
+
+def book_command(command, tokens, channel, user):
+	# confirm one of the previously suggested booking options
+	# optionally, repeat it every week and give the booking a name
+	# book <option> [in <room>] [weekly [for <number> weeks]] [name <booking name>]
+	# the room is optional, if it's given the option must be in that room
+	response = 'Use *' + BOOK_COMMAND + '* and a valid option number.'
+	room, tokens = commands.parse_room(tokens, rooms.ALIASES, stop=NAME_COMMAND)
+	repeat, tokens = commands.parse_repeat(tokens, stop=NAME_COMMAND)
+	if len(tokens) < 2:
+		return response
+
+	response = "Sorry, I couldn't find option `%s`%s\n" % (tokens[1], format_slack_room(room)) + \
+		response
+	ref = commands.parse_ref(tokens)
+	if ref == None or ref < 1 or ref > bookings.MAX_OPTION_REF:
+		return response
+
+	name = None
+	if len(tokens) >= 4 and tokens[2] == NAME_COMMAND:
+		name = strip_whitespace(command.split(NAME_COMMAND, 1)[1])
+		logging.debug('new booking name is: %s', name)
+
+	try:
+		booking = bookings.confirm_booking(user, ref, 1, name=name,
+			set_reminder=True, slack_channel=channel, room=room, weekly=repeat != None,
+			num_weeks=repeat.num_weeks if repeat else None)
+	except bookings.BookingConflict as e:
+		return format_slack_conflict(tokens[1], e.booking)
+	if booking:
+		# so we have the latest details for the room display
+		update_slack_user(user)
+
+		day_ts = dtutils.day_ts(booking.start_date)
+		d = slackutils.format_slack_date(booking.start_date, day_ts)
+		response = 'Great!'
+		if name:
+			response += " '%s' is booked" % (booking.name)
+		response = response + ' for %s%s' % \
+			(format_slack_booking(d, day_ts, booking.start_time), format_slack_room(booking.room))
+		if repeat:
+			response += ', then every %s' % (WEEKDAY_NAMES[booking.weekday])
+			if repeat.num_weeks:
+				response += ' for %d weeks' % (repeat.num_weeks)
+
+	return response
+
+
+def show_command(command, tokens, channel, user):
+	# get a list of all the specified user's current and future booking
+	# or optionally, a list of future and future bookings for all users
+	# show <all>
+	# SHOW_PAGE_SIZE bookings at a time, the more command shows the next ones
+	show_all = len(tokens) >= 2 and tokens[1] == ALL
+	count = bookings.count_bookings(user)
+	response = format_show_page(user, show_all)
+	if count == 0:
+		return "You don't have any bookings" + response
+
+	return 'You have %d bookings' % (count) + response
+
+
+def more_command(command, tokens, channel, user):
+	# the next page of bookings of the user's last show command
+	# more
+	next_page = bookings.get_next_page(user)
+	if next_page == None:
+		return 'There are no more bookings to show, use *%s* to list them again' % (SHOW_COMMAND)
+	show_all, after, count = next_page
+	return format_show_page(user, show_all, after, count).lstrip('\n')
+
+
+def format_show_page(user, show_all, after=None, count=0):
+	# a page of bookings, after the booking with the key after, formats the user's
+	# own bookings with refs, starting from count + 1, and stores the refs
+	booked_slots = bookings.get_bookings(None if show_all else user, after=after,
+		limit=SHOW_PAGE_SIZE + 1)
+	more = len(booked_slots) > SHOW_PAGE_SIZE
+	booked_slots = booked_slots[:SHOW_PAGE_SIZE]
+
+	booking_refs = []
+	response = ''
+	# the dates are converted and formatted once, not once per booking
+	date_tss = dtutils.day_timestamps(slot.date for slot in booked_slots)
+	slack_dates = {}
+	for slot in booked_slots:
+		date_ts = date_tss[slot.date]
+		d = slack_dates.get(slot.date)
+		if d == None:
+			d = slackutils.format_slack_date(slot.date, date_ts)
+			slack_dates[slot.date] = d
+		if slot.booking.booker_sid == user:
+			count += 1
+			slot.ref = count
+			booking_refs.append(slot)
+			response += ('\n`%d` %s' % (count, format_slack_slot(d, date_ts, slot)))
 		else:
-			user = models.SlackUser(sid=slack_user['id'], name=slack_user['name'],
-				real_name=slack_user['real_name'], image_48=slack_user['image_48'])
-		db.session.add(user)
-		db.session.commit()	
+			response += ('\n%s' % (format_slack_slot(d, date_ts, slot)))
+
+	# store the refs we show the user, so they can use them with later commands
+	# and where the next page starts
+	next_page = None
+	if more:
+		response += '\nUse *%s* to see the next ones' % (MORE_COMMAND)
+		next_page = (show_all, booking_index.booking_key(booked_slots[-1].booking), count)
+	if booking_refs or next_page or after:
+		bookings.set_booking_refs(user, booking_refs, next_page, extend=after != None)
+
+	return response
+
+
+def name_command(command, tokens, channel, user):
+	# change the name of the specified booking
+	# name <option> <booking name>
+	response = 'Use *' + NAME_COMMAND + '* and a valid option number.'
+	if len(tokens) < 3:
+		return response
+
+	response = "Sorry, I couldn't find option `%s`\n" % (tokens[1]) + response
+	ref = commands.parse_ref(tokens)
+	if ref == None or ref < 1:
+		return response
+
+	name = strip_whitespace(command.split(tokens[1], 1)[1])
+	logging.debug('new booking name is: %s', name)
+	if bookings.update_booking_by_ref(user, ref, name=name) == None:
+		return response
+	return "Done!\nChanged the name to '%s'" % (name)
+
+
+def status_command(command, tokens, channel, user):
+	# get the status of room, including sensor info
+	# status [<room>]
+	# only the room connected to this device's MCU has sensors
+	room, tokens = commands.parse_room(tokens, rooms.ALIASES)
+	sensor_room = rooms.sensor_room()
+	if sensor_room == None or (room and room != sensor_room.id):
+		return format_slack_status(None)
+	status = mcu_utils.get_status()
+	return format_slack_status(status)
+
+
+def format_percent(value):
+	return '%d%%' % (int(round(value * 100)))
+
+
+def format_slack_stats(stats, num_days):
+	# formats the stats of a room ready for sending to slack
+	room = rooms.get_room(stats.room_id)
+	msg = '%s, the last %d days:' % (room.name, num_days)
+	utilization = stats.get_utilization()
+	if utilization == None:
+		msg += '\nNo working hours'
+		return msg
+
+	msg += '\nBooked: %s of working hours, %d bookings' % (format_percent(utilization),
+		stats.num_bookings)
+	if stats.occupancy != None:
+		msg += '\nOccupied: %s of working hours' % (format_percent(stats.occupancy))
+	no_show_rate = stats.get_no_show_rate()
+	if no_show_rate != None:
+		msg += '\nNo-shows: %d of %d bookings (%s)' % (stats.no_shows, stats.sensed_bookings,
+			format_percent(no_show_rate))
+	if stats.avg_power != None:
+		msg += '\nWall socket during meetings: %1.1fmA on average' % (stats.avg_power)
+	return msg
 
 
-# used to remove punctuation - py2
-NO_PUNCT_TRANS = dict.fromkeys(x for x in xrange(sys.maxunicode) 
-					if unicodedata.category(unichr(x)).startswith('P'))
+def stats_command(command, tokens, channel, user):
+	# get the utilization of a room, and for the room with sensors, its occupancy,
+	# no-shows and the power used during meetings
+	# stats [last (number) <days|weeks>] [in <room>]
+	room, tokens = commands.parse_room(tokens, rooms.ALIASES)
+	if room == None:
+		room = rooms.default_room.id
+	num_days = commands.parse_period(tokens)
+	if num_days == None:
+		num_days = ANALYTICS_DEFAULT_DAYS
+	num_days = min(num_days, ANALYTICS_MAX_DAYS)
 
-def tokenise(s):
-	# convert to lowercase and remove punctuation before splitting
-	return s.translate(NO_PUNCT_TRANS).lower().split()
-	
+	return format_slack_stats(analytics.compute(room, num_days), num_days)
 
-def strip_whitespace(s):
-	return s.strip(string.whitespace)
-	
+
+# the command grammar, the first token of a message selects the handler
+COMMAND_HANDLERS = {
+	FREE_COMMAND: free_command,
+	BOOK_COMMAND: book_command,
+	SHOW_COMMAND: show_command,
+	NAME_COMMAND: name_command,
+	STATUS_COMMAND: status_command,
+	STATS_COMMAND: stats_command,
+	MORE_COMMAND: more_command
+}
+
+HELP_RESPONSE = "Not sure what you mean.\nUse the *" + FREE_COMMAND + \
+	"* command followed by *now*, *tomorrow* or the name of a day to book me"
 
 def handle_command(command, channel, user):
 	# processes messages directed at the bot and determines if they
@@ -169,220 +491,105 @@ def handle_command(command, channel, user):
 	# if they are, then the command is acted on, otherwise, the reply is a help message
 	logging.debug('command: %s', command)
 
-	tokens = tokenise(command)
+	tokens = commands.tokenise(command)
 	logging.debug('tokens: %s', tokens)
-	
-	response = "Not sure what you mean.\nUse the *" + FREE_COMMAND + \
-			   "* command followed by *now*, *tomorrow* or the name of a day to book me"
-	
-	# all dates and times are local
-	if tokens[0] == FREE_COMMAND:
-		# get a list of suggested booking options for the specified day and time
-		# free <now|today|tomorrow|(day of week)|(this morning|lunchtime|afternoon|evening)>
-		response = 'Use *' + FREE_COMMAND + '* and specify a day, for example *now* or \
-			*this afternoon* or *tomorrow* or *Mon* or *friday morning'
-		if len(tokens) >= 2:
-			day = dtutils.local_datetime_now()
-			tod_in_mins = day.hour * MINS_IN_HOUR + day.minute
-			logging.debug('now day: %s; tod_in_mins: %d' % (day, tod_in_mins))
-			if tokens[1] == NOW or tokens[1] == TODAY \
-				or (tokens[1] == THIS and len(tokens) >= 3 and tokens[2] in TOD_MODS):
-				if tokens[1] == THIS:
-					day, tod_in_mins = dtutils.adjust_time(day, TOD_MODS[tokens[2]],
-						force=False)			
-			elif tokens[1] == TOMORROW:
-				day = day + timedelta(days=1)
-				if len(tokens) >= 3 and tokens[2] in TOD_MODS:
-					day, tod_in_mins = dtutils.adjust_time(day, TOD_MODS[tokens[2]])			
-				else:
-					day, tod_in_mins = dtutils.adjust_time(day, bookings.MORNING['start'])
-			elif tokens[1] in WEEKDAYS:
-				weekday = WEEKDAYS[tokens[1]]
-				today = day.weekday()
-				offset = weekday - today
-				if weekday <= today:
-					offset += 7
-				day = day + timedelta(days=offset)
-				if len(tokens) >= 3 and tokens[2] in TOD_MODS:
-					day, tod_in_mins = dtutils.adjust_time(day, TOD_MODS[tokens[2]])			
-				else:
-					day, tod_in_mins = dtutils.adjust_time(day, bookings.MORNING['start'])
-
-			logging.debug('adjusted day: %s; tod_in_mins: %d' % (day, tod_in_mins))
-			if tod_in_mins != None:
-				# check when the room is free
-				available_slots, no_bookings = bookings.available_slots(day, tod_in_mins,
-					bookings.MIN_SLOT_DURATION, user)
-		
-				# create a list of suggested bookings
-				suggested_slots = bookings.suggest_slots(available_slots,
-					MIN_SLOT_DURATION * 2)
-		
-				# store them, awaiting confirmation
-				count = 1
-				for slot in suggested_slots:
-					slot.ref = count
-					bookings.create_unconfirmed_booking(day, slot, user)
-					count += 1
-		
-				# prepare the slack response
-				response = format_free_response(suggested_slots, no_bookings, day,
-					tod_in_mins)
-	elif tokens[0] == BOOK_COMMAND:
-		# confirm one of the previously suggested booking options
-		# optionally, give the booking a name
-		# book <option>
-		response = 'Use *' + BOOK_COMMAND + '* and a valid option number.'
-		if len(tokens) >= 2:
-			response = "Sorry, I couldn't find option `%s`\n" % (tokens[1],) + response
-			try:
-				ref = int(tokens[1])
-				if ref >= 1 and ref <= 4:
-					name = None
-					if len(tokens) >= 4 and tokens[2] == NAME_COMMAND:
-						name = strip_whitespace(command.split(NAME_COMMAND, 1)[1])
-						logging.debug('new booking name is: %s', name)
-							
-					booking = bookings.confirm_booking(user, ref, 1, name=name,
-						set_reminder=True, slack_channel=channel)
-					if booking:
-						# so we have the latest details for the room display
-						update_slack_user(user)
-						
-						day = dtutils.convert_date_to_datetime(booking.start_date)
-						day_ts = dtutils.to_day_timestamp(day)
-						d = slackutils.format_slack_date(day)
-						response = 'Great!'
-						if name:
-							response += " '%s' is booked" % (booking.name)
-						response = response + ' for %s' % \
-							(format_slack_booking(d, day_ts, booking.start_time))			
-			except ValueError:
-				# the specified option wasn't an integer
-				pass
-	elif tokens[0] == SHOW_COMMAND:
-		# get a list of all the specified user's current and future booking
-		# or optionally, a list of future and future bookings for all users 
-		# show <all>
-		booked_slots = []
-		if len(tokens) >= 2 and tokens[1] == ALL:
-			booked_slots = bookings.get_bookings(None)
-		else:
-			booked_slots = bookings.get_bookings(user)
 
-		count = 0
-		booking_refs = []
-		response = ''
-		for slot in booked_slots:
-			date = dtutils.convert_date_to_datetime(slot.date)
-			d = slackutils.format_slack_date(date)
-			date_ts = dtutils.to_day_timestamp(date)
-			if slot.booking.booker_sid == user:
-				count += 1
-				slot.ref = count
-				booking_refs.append(slot)
-				response += ('\n`%d` %s' % (count, format_slack_slot(d, date_ts, slot)))
-			else:
-				response += ('\n%s' % (format_slack_slot(d, date_ts, slot)))
-		
-		# store the refs we show the user, so they can use them with later commands
-		if len(booking_refs) > 0:
-			bookings.set_booking_refs(user, booking_refs)
-			
-		if count == 0:
-			response = "You don't have any bookings" + response
-		else:
-			response = 'You have %d bookings' % (count) + response
-	elif tokens[0] == NAME_COMMAND:
-		# change the name of the specified booking
-		# name <option> <booking name>
-		response = 'Use *' + NAME_COMMAND + '* and a valid option number.'
-		if len(tokens) >= 3:
-			response = "Sorry, I couldn't find option `%s`\n" % (tokens[1]) + response
-			try:
-				ref = int(tokens[1])
-				if ref >= 1:
-						name = strip_whitespace(command.split(tokens[1], 1)[1])
-						logging.debug('new booking name is: %s', name)
-						bookings.update_booking_by_ref(user, ref, name=name)
-						response = "Done!\nChanged the name to '%s'" % (name)			
-			except ValueError:
-				# the specified option wasn't an integer
-				pass			
-	elif tokens[0] == STATUS_COMMAND:
-		# get the status of room, including sensor info
-		# status
-		status = mcu_utils.get_status()
-		response = format_slack_status(status)
+	# all dates and times are local
+	response = HELP_RESPONSE
+	if tokens and tokens[0] in COMMAND_HANDLERS:
+		# each command commits its changes once
+		with instrumentation.measure_command(tokens[0]), storage.unit_of_work():
+			response = COMMAND_HANDLERS[tokens[0]](command, tokens, channel, user)
 
 	logging.debug('response: %s', response)
 
-	slack_client.api_call("chat.postMessage", channel=channel, text=response, as_user=True)
+	outbox.send(channel, response)
 
 
-def	read_slack_rtm():
-	# scheduled job
-	# processes the latest messages from slack
-	with db.app.app_context():
-		event = slackutils.filter_slack_events(slack_client.rtm_read())
-		if event:
-			if event['type'] == slackutils.MESSAGE_EVENT_TYPE:
-				command = event['message'].split(AT_BOT)[1]
-				handle_command(command, event['channel'], event['user'])
+def handle_slack_event(event):
+	# processes a single slack event, queued by the RTM reader
+	if event['type'] == slackutils.MESSAGE_EVENT_TYPE:
+		parts = event['message'].split(AT_BOT, 1)
+		if len(parts) == 2:
+			handle_command(parts[1], event['channel'], event['user'])
+	elif event['type'] == slackutils.USER_CHG_EVENT_TYPE:
+		slack_directory.directory.on_user_change(event['user'])
 
 
-REMINDER_FILTER_STMT = text('send_at >= :earlier and send_at < :later')
-
-def send_reminders():
-	# scheduled job
-	# checks for any booking reminders that need to be sent
+def send_reminders(reminder_ids):
+	# called by the reminder scheduler with the reminders that are due
+	# Reminder ids and the keys of recurring booking occurrences
 	with db.app.app_context():
-		now_ts = dtutils.utc_timestamp_now()
-		reminders = models.Reminder.query.filter(REMINDER_FILTER_STMT). \
-			params(earlier=now_ts - SECONDS_IN_MIN / 2, \
-				later=now_ts + SECONDS_IN_MIN / 2).all()
+		keys = [i for i in reminder_ids if recurring.parse_key(i)]
+		reminder_ids = [i for i in reminder_ids if not recurring.parse_key(i)]
+
+		# (slack channel, text) of each reminder
+		messages = []
+		reminders = []
+		if reminder_ids:
+			reminders = models.Reminder.query.filter(models.Reminder.id.in_(reminder_ids)).all()
+			messages = [(reminder.slack_channel, reminder.text) for reminder in reminders]
+		for key in keys:
+			message = bookings.get_recurring_reminder(key)
+			if message:
+				messages.append(message)
 	
-		if reminders:
+		count = 0
+		if messages:
 			# get the status of room, including sensor info
 			status = mcu_utils.get_status()
 			
-			count = 0
-			for reminder in reminders:
-				msg = reminder.text
-				if status['temp']:
+			for channel, msg in messages:
+				if status and status['temp']:
 					if status['temp'] <= TEMP_SENSOR_THRESHOLD['low']:
 						msg += '\n' + LOW_TEMP_MESSAGE
 					elif status['temp'] >= TEMP_SENSOR_THRESHOLD['high']:
 						msg += '\n' + HIGH_TEMP_MESSAGE
-				slack_client.api_call("chat.postMessage", channel=reminder.slack_channel,
-					text=msg, as_user=True)
+				outbox.send(channel, msg, outbox.REMINDER)
 				count += 1
+
+		if reminders:
+			# sent reminders are removed, so they're not sent again after a restart
+			models.Reminder.query.filter(models.Reminder.id.in_(reminder_ids)). \
+				delete(synchronize_session=False)
+			storage.commit()
 		logging.info('Reminders sent: %s', count)		
 
 
 def cleanup_bookings():
 	# scheduled job
-	# removes any old booking, booking suggestions and reminders
+	# archives and removes any old booking, and removes old booking suggestions and
+	# reminders, a batch at a time, see retention
 	with db.app.app_context():
 		now = dtutils.utc_datetime_now()
-		now_date = now.date()
-		now_ts = now.timestamp()
+		retention.run(now)
+		booking_index.index.remove_before(now.date())
+		booking_refs.store.cleanup()
+
+		# the recurring bookings' reminders are scheduled a few days at a time
+		bookings.schedule_recurring_reminders()
 
-		# remove old reminders
-		models.Reminder.query.filter(models.Reminder.send_at < now_ts). \
-			delete(synchronize_session=False)
-		
-		# remove old bookings
-		models.ConfirmedBooking.query.filter(models.ConfirmedBooking.start_date < now_date). \
-			delete(synchronize_session=False)
-		
-		# remove old unconfirmed bookings
-		models.UnconfirmedBooking.query.filter(models.UnconfirmedBooking.start_date < now_date). \
-			delete(synchronize_session=False)
-		
-		db.session.commit()
 
 def mcu_handler():
 	# scheduled job
-	# processes the sensor input from the MCU
+	# aggregates and logs the sensor readings reported by the MCU
 	mcu_utils.read_mcu()
+
+
+def save_booking_refs():
+	# scheduled job
+	# saves the booking option numbers given by show, so they survive a restart
+	booking_refs.store.save()
+
+
+def db_maintenance():
+	# scheduled job
+	# reclaims space freed by cleanup_bookings and updates the query planner stats
+	with db.app.app_context():
+		storage.maintenance()
+
+
+def log_metrics():
+	# scheduled job
+	# logs the in-process counters, e.g. queue depths and latencies
+	logging.info('metrics: %s', metrics.summary())
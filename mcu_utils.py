@@ -1,45 +1,117 @@
+import analytics
 import logging
 import math
+import metrics
+import processes
+import rooms
+import sensor_stats
+import shared_status
+import threading
+import time
 from app import mcu
-from config import MOTION_SENSOR
-from config import ELECTRICITY_RELAY
-from config import ELECTRICITY_SENSOR
-from config import TEMP_SENSOR
 from config import TEMP_SENSOR_THRESHOLD
-from config import LIGHT_SENSOR
 from config import LIGHT_SENSOR_THRESHOLD
+from config import LIGHT_RELAY_DEBOUNCE_SECS
+from config import MCU_SAMPLING_INTERVAL_MS
+from config import SENSOR_SAMPLE_SECS
+from config import SENSOR_WINDOWS
+from config import SENSOR_EWMA_ALPHA
 
 SENSOR_VCC = 3.3
 
+# the window used for averages in status messages
+AVERAGE_WINDOW = '5m'
+
 # sensor v1.0
 TEMP_SENSOR_B_VALUE = 3975
 
-class Average_Value:
-	def __init__(self, max_values):
-		self.max_values = max_values
-		self.values = []
-		self.avg = 0.0
-		
+# the pins of the room whose sensors are connected to the MCU, if there is one
+SENSOR_ROOM = rooms.sensor_room()
+PINS = SENSOR_ROOM.pins if SENSOR_ROOM else {}
+
+ANALOG_SENSORS = ('electricity', 'temp', 'light')
+
+# analog pin -> sensor
+PIN_SENSORS = dict((PINS[sensor], sensor) for sensor in ANALOG_SENSORS if sensor in PINS)
+
+# readings are pushed by the MCU, via firmata analog and digital reporting, into
+# a buffer per sensor. The blinds relay is switched as soon as a light reading
+# crosses a threshold, and the temp and light readings are added to their rolling
+# stats as they arrive. A single reading of the AC current sensor is a point on the
+# wave rather than a current, so the aggregation job adds the current, from the
+# peak of the readings, to the electricity stats every SENSOR_SAMPLE_SECS
+
+# time spent handling a reading, on PyMata's serial reader thread
+HANDLER_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+mcu_read_seconds = metrics.Family(metrics.Histogram, 'mcu_read_seconds',
+	'Time taken to handle a sensor reading from the MCU', 'sensor', buckets=HANDLER_BUCKETS)
+mcu_samples = metrics.Family(metrics.Counter, 'mcu_samples',
+	'Sensor readings reported by the MCU', 'sensor')
+relay_switches = metrics.Counter('mcu_relay_switches', 'Times the blinds relay was switched')
+
+
+class SampleBuffer:
+	# the raw readings of a sensor since the last aggregation
+	def __init__(self, name):
+		self.name = name
+		self.latest = None
+		self.count = 0
+		self.total = 0
+		self.max_value = None
+		self.lock = threading.Lock()
+
 	def add(self, value):
-		self.values.append(value)
-		
-		# remove the oldest entry
-		if len(self.values) > self.max_values:
-			del self.values[0]
-		
-		total = 0.0
-		for v in self.values:
-			total += v
-		self.avg = total / len(self.values)
-		
-	def get_average(self):
-		return self.avg
-		
-	def get_latest_value(self):
-		if len(self.values) > 0:
-			return self.values[-1]
-		return None
-		
+		with self.lock:
+			self.latest = value
+			self.count += 1
+			self.total += value
+			if self.max_value == None or value > self.max_value:
+				self.max_value = value
+
+	def drain(self):
+		# (count, mean, max) of the readings since the last drain
+		with self.lock:
+			count, total, max_value = self.count, self.total, self.max_value
+			self.count = 0
+			self.total = 0
+			self.max_value = None
+		if count == 0:
+			return 0, None, None
+		return count, float(total) / count, max_value
+
+
+class Hysteresis:
+	# switches on above high and off below low, but only once the reading has
+	# been past the threshold for debounce_secs, so a passing shadow or a noisy
+	# reading doesn't flap the blinds
+	def __init__(self, low, high, debounce_secs, switch, active=False):
+		self.low = low
+		self.high = high
+		self.debounce_secs = debounce_secs
+		self.switch = switch
+		self.active = active
+		self.pending = None
+		self.pending_since = None
+
+	def update(self, value, now):
+		wanted = None
+		if value > self.high:
+			wanted = True
+		elif value < self.low:
+			wanted = False
+
+		if wanted == None or wanted == self.active:
+			self.pending = None
+			return
+		if wanted != self.pending:
+			self.pending = wanted
+			self.pending_since = now
+		if now - self.pending_since >= self.debounce_secs:
+			self.pending = None
+			self.active = wanted
+			self.switch(wanted)
+
 
 motion_sensor_active = False
 
@@ -52,7 +124,17 @@ def set_motion_sensor_state(state):
     motion_sensor_active = state
 
 
-elect_sensor_avg = Average_Value(10)
+# the windows of the stats added to per reading, and per aggregation
+READING_WINDOW_SIZES = sensor_stats.window_sizes(SENSOR_WINDOWS, MCU_SAMPLING_INTERVAL_MS / 1000.0)
+SAMPLE_WINDOW_SIZES = sensor_stats.window_sizes(SENSOR_WINDOWS, SENSOR_SAMPLE_SECS)
+
+elect_sensor_stats = sensor_stats.SensorStats('electricity', SAMPLE_WINDOW_SIZES, SENSOR_EWMA_ALPHA)
+
+temp_sensor_stats = sensor_stats.SensorStats('temperature', READING_WINDOW_SIZES, SENSOR_EWMA_ALPHA)
+
+light_sensor_stats = sensor_stats.SensorStats('light', READING_WINDOW_SIZES, SENSOR_EWMA_ALPHA)
+
+buffers = dict((sensor, SampleBuffer(sensor)) for sensor in ANALOG_SENSORS)
 
 elect_relay_active = False
 
@@ -61,40 +143,121 @@ current_temp_value = None
 current_light_value = None
 
 
+def switch_relay(active):
+	# when the 'high' threshold is exceeded, the ELECTRICITY_RELAY is activated (closed)
+	# the relay remains active until the sensor value is below the 'low' threshold
+	global elect_relay_active
+	if active:
+		# activate relay to close the blinds
+		mcu.digital_write(PINS['relay'], 1)
+	else:
+		# remove power, the blinds open automatically
+		mcu.digital_write(PINS['relay'], 0)
+	elect_relay_active = active
+	relay_switches.inc()
+	logging.info('ELECTRICITY_RELAY: %s', active)
+
+
+blinds = Hysteresis(LIGHT_SENSOR_THRESHOLD['low'], LIGHT_SENSOR_THRESHOLD['high'],
+	LIGHT_RELAY_DEBOUNCE_SECS, switch_relay)
+
+
+def analog_callback(data):
+	# called by PyMata, on its serial reader thread, with [pin type, pin, value]
+	# whenever an analog pin reports a reading, so it must be quick
+	start = time.time()
+	sensor = PIN_SENSORS.get(data[1])
+	if sensor == None:
+		return
+	value = data[2]
+	buffers[sensor].add(value)
+	mcu_samples.get(sensor).inc()
+
+	if sensor == 'temp':
+		# 0 is an open circuit, not a temperature
+		if value > 0:
+			temp_sensor_stats.add(calc_temp(value))
+	elif sensor == 'light':
+		global current_light_value
+		current_light_value = value
+		light_sensor_stats.add(value)
+		blinds.update(value, start)
+	mcu_read_seconds.get(sensor).observe(time.time() - start)
+
+
+def motion_sensor_callback(data):
+	# called by PyMata when the motion sensor pin changes, with [pin type, pin, value]
+	# the sensor pulls the pin low when it detects motion
+	logging.debug('motion_sensor_callback(%s)', data)
+	mcu_samples.get('motion').inc()
+	if data[2] == 0:
+		set_motion_sensor_state(True)
+
+
+def start_sampling():
+	# sets the MCU pin modes and reporting callbacks, for the room connected to the MCU
+	if not PINS:
+		return
+
+	mcu.set_sampling_interval(MCU_SAMPLING_INTERVAL_MS)
+	mcu.set_pin_mode(PINS['motion'], mcu.INPUT, mcu.DIGITAL, motion_sensor_callback)
+	mcu.set_pin_mode(PINS['relay'], mcu.OUTPUT, mcu.DIGITAL)
+	for sensor in ANALOG_SENSORS:
+		mcu.set_pin_mode(PINS[sensor], mcu.INPUT, mcu.ANALOG, analog_callback)
+
+
+def drain(sensor):
+	# the buffered readings of the sensor, falls back to reading the pin if
+	# the MCU hasn't reported anything since the last aggregation
+	count, mean, max_value = buffers[sensor].drain()
+	if count == 0:
+		logging.warning('No %s readings reported, reading the pin', sensor)
+		mean = max_value = mcu.analog_read(PINS[sensor])
+	return count, mean, max_value
+
+
 def read_mcu():
-	# AC current sensor
-	elect_sensor = mcu.analog_read(ELECTRICITY_SENSOR)
-	ac_current = calc_elect_current(elect_sensor)
-	logging.info('ELECTRICITY_SENSOR: %1.1fmA', ac_current)
-	elect_sensor_avg.add(ac_current)
-	logging.info('Avg AC current: %1.1fmA', elect_sensor_avg.get_average())
+	# aggregates the readings since the last call, and logs them
+	if not PINS:
+		return
+
+	# AC current sensor, the peak reading is the amplitude of the current
+	count, mean, peak = drain('electricity')
+	ac_current = calc_elect_current(peak)
+	logging.info('ELECTRICITY_SENSOR: %1.1fmA (%d readings)', ac_current, count)
+	elect_sensor_stats.add(ac_current)
+	logging.info('Avg AC current: %1.1fmA',
+		elect_sensor_stats.get_snapshot().get_average(AVERAGE_WINDOW))
 	
 	# temp sensor
 	global current_temp_value
-	temp_sensor = mcu.analog_read(TEMP_SENSOR)
-	current_temp_value = calc_temp(temp_sensor)
-	logging.info('TEMP_SENSOR: %1.0fC', current_temp_value)
+	count, mean, peak = drain('temp')
+	current_temp_value = calc_temp(mean)
+	if count == 0:
+		# the stats are added to by analog_callback, unless the MCU isn't reporting
+		temp_sensor_stats.add(current_temp_value)
+	logging.info('TEMP_SENSOR: %1.0fC (%d readings)', current_temp_value, count)
 	
 	# PIR motion sensor
-	logging.info('MOTION_SENSOR: %s', get_motion_sensor_state())
+	motion = get_motion_sensor_state()
+	logging.info('MOTION_SENSOR: %s', motion)
 	set_motion_sensor_state(False)
 
-	# LDR light sensor
-	global current_light_value
-	current_light_value = mcu.analog_read(LIGHT_SENSOR)
-	logging.info('LIGHT_SENSOR: %d', current_light_value)
-	
-	# when the 'high' threshold is exceeded, the ELECTRICITY_RELAY is activated (closed)
-	# the relay remains active until the sensor value is below the 'low' threshold
-	global elect_relay_active
-	if current_light_value > LIGHT_SENSOR_THRESHOLD['high']:
-		# activate relay to close the blinds
-		mcu.digital_write(ELECTRICITY_RELAY, 1)
-		elect_relay_active = True
-	elif current_light_value < LIGHT_SENSOR_THRESHOLD['low']:
-		# remove power, the blinds open automatically
-		mcu.digital_write(ELECTRICITY_RELAY, 0)
-		elect_relay_active = False
+	# kept for the stats command
+	analytics.samples.add(time.time(), motion, ac_current)
+
+	if processes.is_split():
+		status = get_local_status()
+		# the motion seen since the last aggregation, as it's just been reset
+		status['motion'] = motion
+		shared_status.status.publish(status)
+
+	# LDR light sensor, the relay has already been switched by analog_callback
+	count, mean, peak = drain('light')
+	if count == 0:
+		light_sensor_stats.add(mean)
+	logging.info('LIGHT_SENSOR: %d (%d readings); ELECTRICITY_RELAY: %s', mean, count,
+		elect_relay_active)
 	
 
 def calc_elect_current(value):
@@ -126,20 +289,20 @@ def calc_temp(value):
 	return temp
 	
 	
-def motion_sensor_callback(data):
-	# called by Pymata when the associated latch triggers
-	logging.debug('motion_sensor_callback(%s)', data)
-	
-	set_motion_sensor_state(True)
-	
-	# re-arm the latch
-	mcu.set_digital_latch(MOTION_SENSOR, mcu.DIGITAL_LATCH_LOW, motion_sensor_callback)
+def get_status():
+	# current status of each of the i/o devices connected to the MCU, or None if
+	# it's not known
+	if not processes.owns_mcu():
+		# published by the mcu process, see read_mcu
+		return shared_status.status.read()
+	return get_local_status()
 
 
-def get_status():
-	# current status of each of the i/o devices connected to the MCU
+def get_local_status():
+	# the sensor stats are immutable snapshots, so they're safe to use from any thread
 	status = {'temp':current_temp_value, 'light':current_light_value,
-		'current':elect_sensor_avg, 'relay':elect_relay_active,
-		'motion':motion_sensor_active}
+		'current':elect_sensor_stats.get_snapshot(), 'relay':elect_relay_active,
+		'motion':motion_sensor_active, 'temp_stats':temp_sensor_stats.get_snapshot(),
+		'light_stats':light_sensor_stats.get_snapshot()}
 	logging.debug('status: %s', status)
 	return status
\ No newline at end of file
@@ -0,0 +1,242 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict
+
+# simple, thread safe, in-process counters
+# every metric registers itself, so they can be logged or exported in one place
+# metrics can have labels, e.g. {'job':'job3'}, a Family creates them on demand
+
+REGISTRY = []
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# upper bounds of the histogram buckets for counts, e.g. db queries per command
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250)
+
+
+class Counter:
+	# a value that only ever goes up
+	def __init__(self, name, help_text='', labels=None):
+		self.name = name
+		self.help_text = help_text
+		self.labels = labels
+		self.value = 0
+		self.lock = threading.Lock()
+		REGISTRY.append(self)
+
+	def inc(self, amount=1):
+		with self.lock:
+			self.value += amount
+
+	def get_value(self):
+		return self.value
+
+
+class Gauge:
+	# a value that can go up and down, e.g. a queue depth
+	def __init__(self, name, help_text='', labels=None):
+		self.name = name
+		self.help_text = help_text
+		self.labels = labels
+		self.value = 0
+		self.max_value = 0
+		self.lock = threading.Lock()
+		REGISTRY.append(self)
+
+	def set(self, value):
+		with self.lock:
+			self.value = value
+			if value > self.max_value:
+				self.max_value = value
+
+	def inc(self, amount=1):
+		with self.lock:
+			self.value += amount
+			if self.value > self.max_value:
+				self.max_value = self.value
+
+	def dec(self, amount=1):
+		with self.lock:
+			self.value -= amount
+
+	def get_value(self):
+		return self.value
+
+	def get_max_value(self):
+		return self.max_value
+
+
+class Latency:
+	# running count, total and max of a duration in seconds
+	def __init__(self, name, help_text='', labels=None):
+		self.name = name
+		self.help_text = help_text
+		self.labels = labels
+		self.count = 0
+		self.total = 0.0
+		self.max_value = 0.0
+		self.lock = threading.Lock()
+		REGISTRY.append(self)
+
+	def observe(self, seconds):
+		with self.lock:
+			self.count += 1
+			self.total += seconds
+			if seconds > self.max_value:
+				self.max_value = seconds
+
+	def time_since(self, start):
+		# convenience method, observes the time elapsed since start
+		self.observe(time.time() - start)
+
+	def get_average(self):
+		if self.count == 0:
+			return 0.0
+		return self.total / self.count
+
+	def get_max_value(self):
+		return self.max_value
+
+
+class Histogram(Latency):
+	# a latency that also counts observations per bucket, e.g. for percentiles
+	# observing is a binary search and an increment, cheap enough to leave on
+	def __init__(self, name, help_text='', labels=None, buckets=DEFAULT_BUCKETS):
+		Latency.__init__(self, name, help_text, labels)
+		self.buckets = tuple(buckets)
+		# the last count is for values above the largest bucket
+		self.counts = [0] * (len(self.buckets) + 1)
+
+	def observe(self, value):
+		index = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			self.count += 1
+			self.total += value
+			self.counts[index] += 1
+			if value > self.max_value:
+				self.max_value = value
+
+	def get_buckets(self):
+		# (upper bound, cumulative count) for each bucket, the last bound is None
+		with self.lock:
+			counts = list(self.counts)
+		cumulative = []
+		total = 0
+		for bound, count in zip(self.buckets + (None,), counts):
+			total += count
+			cumulative.append((bound, total))
+		return cumulative
+
+
+class Family:
+	# metrics with the same name, one per value of a label, created on first use
+	def __init__(self, metric_class, name, help_text, label, **kwargs):
+		self.metric_class = metric_class
+		self.name = name
+		self.help_text = help_text
+		self.label = label
+		self.kwargs = kwargs
+		self.metrics = {}
+		self.lock = threading.Lock()
+
+	def get(self, value):
+		metric = self.metrics.get(value)
+		if metric == None:
+			with self.lock:
+				metric = self.metrics.get(value)
+				if metric == None:
+					metric = self.metric_class(self.name, self.help_text,
+						labels={self.label:value}, **self.kwargs)
+					self.metrics[value] = metric
+		return metric
+
+
+def full_name(metric):
+	if metric.labels:
+		return '%s{%s}' % (metric.name,
+			','.join('%s=%s' % (k, v) for k, v in sorted(metric.labels.items())))
+	return metric.name
+
+
+def summary():
+	# a one line summary of every registered metric, for logging
+	parts = []
+	for metric in REGISTRY:
+		if isinstance(metric, Latency):
+			parts.append('%s=%d/%1.3fs/%1.3fs' % \
+				(full_name(metric), metric.count, metric.get_average(), metric.max_value))
+		elif isinstance(metric, Gauge):
+			parts.append('%s=%d(max %d)' % (full_name(metric), metric.value, metric.max_value))
+		else:
+			parts.append('%s=%d' % (full_name(metric), metric.value))
+	return ' '.join(parts)
+
+
+def escape_label(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels, extra=None):
+	items = sorted((labels or {}).items())
+	if extra:
+		items.append(extra)
+	if not items:
+		return ''
+	return '{%s}' % (','.join('%s="%s"' % (k, escape_label(v)) for k, v in items))
+
+
+def format_value(value):
+	if value == None:
+		return '+Inf'
+	if isinstance(value, float):
+		return repr(value)
+	return str(value)
+
+
+def prometheus_text():
+	# every registered metric in the prometheus text exposition format
+	# name -> (type, help, lines), metrics with the same name are grouped
+	families = OrderedDict()
+
+	def add(name, metric_type, help_text, line):
+		if name not in families:
+			families[name] = (metric_type, help_text, [])
+		families[name][2].append(line)
+
+	for metric in list(REGISTRY):
+		labels = metric.labels
+		if isinstance(metric, Histogram):
+			for bound, count in metric.get_buckets():
+				add(metric.name, 'histogram', metric.help_text, '%s_bucket%s %d' % \
+					(metric.name, format_labels(labels, ('le', format_value(bound))), count))
+			add(metric.name, 'histogram', metric.help_text, '%s_sum%s %s' % \
+				(metric.name, format_labels(labels), format_value(metric.total)))
+			add(metric.name, 'histogram', metric.help_text, '%s_count%s %d' % \
+				(metric.name, format_labels(labels), metric.count))
+		elif isinstance(metric, Latency):
+			add(metric.name, 'summary', metric.help_text, '%s_sum%s %s' % \
+				(metric.name, format_labels(labels), format_value(metric.total)))
+			add(metric.name, 'summary', metric.help_text, '%s_count%s %d' % \
+				(metric.name, format_labels(labels), metric.count))
+		elif isinstance(metric, Gauge):
+			add(metric.name, 'gauge', metric.help_text, '%s%s %s' % \
+				(metric.name, format_labels(labels), format_value(metric.value)))
+		else:
+			add(metric.name, 'counter', metric.help_text, '%s%s %s' % \
+				(metric.name, format_labels(labels), format_value(metric.value)))
+
+		if isinstance(metric, (Latency, Gauge)):
+			name = metric.name + '_max'
+			add(name, 'gauge', 'Max of ' + metric.name, '%s%s %s' % \
+				(name, format_labels(labels), format_value(metric.max_value)))
+
+	lines = []
+	for name, (metric_type, help_text, family_lines) in families.items():
+		if help_text:
+			help_text = help_text.replace('\\', '\\\\').replace('\n', '\\n')
+			lines.append('# HELP %s %s' % (name, help_text))
+		lines.append('# TYPE %s %s' % (name, metric_type))
+		lines.extend(family_lines)
+	return '\n'.join(lines) + '\n'
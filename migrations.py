@@ -0,0 +1,178 @@
+import booking_index
+import bookings
+import datetime
+import dtutils
+import logging
+import reminders
+import retention
+import storage
+import time
+from app import db, models
+from config import DEFAULT_ROOM
+from sqlalchemy import text
+
+# schema migrations for existing app.db files
+# the schema version is kept in sqlite's user_version pragma, each migration
+# takes a connection, within a transaction, and upgrades the schema by one version
+
+
+def get_version(conn):
+	return conn.execute(text('PRAGMA user_version')).scalar()
+
+
+def set_version(conn, version):
+	# pragmas can't take bound parameters
+	conn.execute(text('PRAGMA user_version = %d' % (int(version))))
+
+
+def get_columns(conn, table):
+	return [row[1] for row in conn.execute(text('PRAGMA table_info(%s)' % (table)))]
+
+
+def parse_date(value):
+	if isinstance(value, datetime.date):
+		return value
+	return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def add_booking_epoch_minutes(conn):
+	# absolute start and end columns, backfilled, with composite indexes
+	columns = get_columns(conn, 'confirmed_booking')
+	for column in ('start_epoch_min', 'end_epoch_min'):
+		if column not in columns:
+			conn.execute(text('ALTER TABLE confirmed_booking ADD COLUMN %s INTEGER' % (column)))
+
+	rows = conn.execute(text('SELECT id, start_date, start_time, duration ' +
+		'FROM confirmed_booking')).fetchall()
+	for row in rows:
+		start = dtutils.to_epoch_minute(parse_date(row[1]), row[2])
+		conn.execute(text('UPDATE confirmed_booking SET start_epoch_min = :start, ' +
+			'end_epoch_min = :end WHERE id = :id'), {'start':start, 'end':start + row[3],
+			'id':row[0]})
+	logging.info('Backfilled %d booking(s)', len(rows))
+
+	conn.execute(text('CREATE INDEX IF NOT EXISTS ix_confirmed_booking_finished_start ' +
+		'ON confirmed_booking (finished, start_epoch_min)'))
+	conn.execute(text('CREATE INDEX IF NOT EXISTS ix_confirmed_booking_booker_start ' +
+		'ON confirmed_booking (booker_sid, start_epoch_min)'))
+	conn.execute(text('CREATE INDEX IF NOT EXISTS ix_confirmed_booking_end ' +
+		'ON confirmed_booking (end_epoch_min)'))
+
+
+def add_booking_room(conn):
+	# the room of each booking and suggestion, existing rows are in the default room
+	for table in ('confirmed_booking', 'unconfirmed_booking'):
+		if 'room' not in get_columns(conn, table):
+			conn.execute(text(("ALTER TABLE %s ADD COLUMN room VARCHAR(20) NOT NULL " +
+				"DEFAULT '%s'") % (table, DEFAULT_ROOM.replace("'", "''"))))
+
+	conn.execute(text('CREATE INDEX IF NOT EXISTS ix_confirmed_booking_room_start ' +
+		'ON confirmed_booking (room, start_epoch_min)'))
+
+
+def add_recurring_bookings(conn):
+	# the recurring booking tables, and the series of a started occurrence
+	models.RecurringBooking.__table__.create(bind=conn, checkfirst=True)
+	models.RecurringException.__table__.create(bind=conn, checkfirst=True)
+	if 'recurring_id' not in get_columns(conn, 'confirmed_booking'):
+		conn.execute(text('ALTER TABLE confirmed_booking ADD COLUMN recurring_id INTEGER ' +
+			'REFERENCES recurring_booking (id)'))
+
+
+def add_recurring_archived_until(conn):
+	# how far the occurrences of each recurring booking have been archived
+	# the exceptions before today have already been deleted, so the occurrences
+	# before today can't be archived, only those from today on
+	if 'archived_until' not in get_columns(conn, 'recurring_booking'):
+		conn.execute(text('ALTER TABLE recurring_booking ADD COLUMN archived_until DATE'))
+	conn.execute(text('UPDATE recurring_booking SET archived_until = :today ' +
+		'WHERE start_date < :today'), {'today':dtutils.local_date_now().isoformat()})
+
+
+# in order, the index + 1 is the schema version after the migration
+MIGRATIONS = [
+	add_booking_epoch_minutes,
+	add_booking_room,
+	add_recurring_bookings,
+	add_recurring_archived_until,
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def upgrade():
+	# applies any outstanding migrations, each in its own transaction
+	with db.engine.begin() as conn:
+		version = get_version(conn)
+	logging.info('Schema version: %d, latest: %d', version, LATEST_VERSION)
+
+	while version < LATEST_VERSION:
+		migration = MIGRATIONS[version]
+		with db.engine.begin() as conn:
+			logging.info('Applying migration %d: %s', version + 1, migration.__name__)
+			migration(conn)
+			set_version(conn, version + 1)
+		version += 1
+
+	return version
+
+
+def stamp():
+	# marks a newly created db as up to date
+	with db.engine.begin() as conn:
+		set_version(conn, LATEST_VERSION)
+
+
+def checked_queries():
+	# (name, statement) of the queries over the tables that grow with the bookings,
+	# built by the code that issues them with sample arguments, so a change to one
+	# that stops it using an index fails db_upgrade.py --check
+	today = dtutils.local_date_now()
+	start = dtutils.to_epoch_minute(today, 9 * 60)
+	rule = models.RecurringBooking(id=1, room=DEFAULT_ROOM, weekday=today.weekday(),
+		start_time=9 * 60, duration=60, start_date=today,
+		until_date=today + datetime.timedelta(days=28))
+	return [
+		('booking index load', booking_index.load_query(start).statement),
+		('booking conflicts', bookings.conflicting_bookings(DEFAULT_ROOM, start, start + 60,
+			1).statement),
+		("a recurring booking's conflicts", bookings.rule_bookings(rule).statement),
+		('recurring exception', bookings.exception_query(1, today).statement),
+		('past recurring exceptions', retention.exceptions_between(1, today,
+			today + datetime.timedelta(days=7)).statement),
+		('booking cleanup', retention.expired_query(start).statement),
+		('reminder load', reminders.pending_query(time.time()).statement),
+		('reminder cleanup', storage.batch_delete_statement(models.Reminder.__table__.name,
+			retention.EXPIRED_REMINDERS)),
+	]
+
+
+def sqlite_param(value):
+	# sqlite stores dates as iso strings
+	if isinstance(value, datetime.date):
+		return value.isoformat()
+	return value
+
+
+def explain_plan(conn, statement):
+	# the steps of the statement's query plan, run on the dbapi connection as sqlalchemy
+	# doesn't know EXPLAIN QUERY PLAN
+	compiled = statement.compile(dialect=db.engine.dialect)
+	params = [sqlite_param(compiled.params.get(name)) for name in compiled.positiontup]
+	cursor = conn.connection.cursor()
+	try:
+		cursor.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)
+		return [row[-1] for row in cursor.fetchall()]
+	finally:
+		cursor.close()
+
+
+def explain():
+	# returns a list of (name, plan, ok), ok is False if the query scans the table
+	results = []
+	with db.engine.begin() as conn:
+		for name, statement in checked_queries():
+			plan = explain_plan(conn, statement)
+			ok = all(('USING' in step or not step.startswith('SCAN')) for step in plan)
+			results.append((name, plan, ok))
+	return results
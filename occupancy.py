@@ -0,0 +1,139 @@
+from dtutils import DAY_IN_MINS
+from dtutils import MINS_IN_HOUR
+
+# occupancy of a day as a bitmask, one bit per 15 min slot (bit 0 is 00:00)
+# bookings are aligned to 15 min boundaries, so a day fits in 96 bits and
+# finding free time is a handful of shifts and ANDs rather than a loop per booking
+
+SLOT_MINS = 15
+SLOTS_IN_DAY = DAY_IN_MINS // SLOT_MINS
+FULL_DAY = (1 << SLOTS_IN_DAY) - 1
+MAX_SUGGESTIONS = 4
+
+
+def to_slot(tod_in_mins):
+	# the slot containing tod_in_mins
+	return tod_in_mins // SLOT_MINS
+
+
+def to_slot_ceil(tod_in_mins):
+	# the first slot that starts at or after tod_in_mins
+	return (tod_in_mins + SLOT_MINS - 1) // SLOT_MINS
+
+
+def range_mask(start_slot, end_slot):
+	# bits start_slot to end_slot - 1
+	if end_slot <= start_slot:
+		return 0
+	return ((1 << (end_slot - start_slot)) - 1) << start_slot
+
+
+def booking_mask(start_time, duration):
+	# every slot the booking touches, even partially
+	end = min(start_time + duration, DAY_IN_MINS)
+	return range_mask(to_slot(max(start_time, 0)), to_slot_ceil(end))
+
+
+def day_mask(bookings):
+	# the occupied slots for a list of bookings (anything with start_time and duration)
+	occupied = 0
+	for booking in bookings:
+		occupied |= booking_mask(booking.start_time, booking.duration)
+	return occupied
+
+
+def free_mask(occupied, from_tod=0, to_tod=DAY_IN_MINS):
+	# the free slots between from_tod and to_tod
+	return ~occupied & range_mask(to_slot_ceil(from_tod), to_slot_ceil(to_tod))
+
+
+def run_starts(free, num_slots):
+	# bits where a run of at least num_slots free slots begins
+	# shifts by doubling widths, so it's O(log num_slots)
+	starts = free
+	width = 1
+	while width < num_slots:
+		step = min(width, num_slots - width)
+		starts &= starts >> step
+		width += step
+	return starts
+
+
+def free_runs(free, min_slots=1):
+	# maximal runs of free slots as (start_slot, end_slot), in order
+	runs = []
+	while free:
+		start = (free & -free).bit_length() - 1
+		x = free >> start
+		# x + 1 clears the trailing ones, so the xor is the run plus one bit
+		length = (x ^ (x + 1)).bit_length() - 1
+		if length >= min_slots:
+			runs.append((start, start + length))
+		free &= ~range_mask(start, start + length)
+	return runs
+
+
+def available_runs(occupied, from_tod, min_duration):
+	# free time from from_tod until midnight, as (start, end) in mins,
+	# excluding any gaps that are shorter than min_duration
+	runs = free_runs(free_mask(occupied, from_tod), to_slot_ceil(min_duration))
+	return [(s * SLOT_MINS, e * SLOT_MINS) for s, e in runs]
+
+
+def has_run(starts, start_slot):
+	return (starts >> start_slot) & 1
+
+
+def suggest(free, req_duration, last_start, max_suggestions=MAX_SUGGESTIONS):
+	# up to max_suggestions booking suggestions as (start, duration) in mins
+	# for each free run: req_duration at the start of the run, then
+	# req_duration x 2, then req_duration 1 and 2 hours later. A run that is
+	# too short for req_duration is offered in full if it's at least half as long
+	req_slots = to_slot_ceil(req_duration)
+	hour_slots = MINS_IN_HOUR // SLOT_MINS
+	starts_req = run_starts(free, req_slots)
+	starts_double = run_starts(free, req_slots * 2)
+	starts_hour = run_starts(free, req_slots + hour_slots)
+	starts_two_hours = run_starts(free, req_slots + hour_slots * 2)
+
+	suggestions = []
+	for start, end in free_runs(free):
+		start_mins = start * SLOT_MINS
+		if start_mins > last_start:
+			break
+
+		if has_run(starts_req, start):
+			options = [(start_mins, req_duration)]
+			if has_run(starts_double, start):
+				options.append((start_mins, req_duration * 2))
+			if has_run(starts_hour, start) and start_mins + MINS_IN_HOUR <= last_start:
+				options.append((start_mins + MINS_IN_HOUR, req_duration))
+			if has_run(starts_two_hours, start) and \
+				start_mins + MINS_IN_HOUR * 2 <= last_start:
+				options.append((start_mins + MINS_IN_HOUR * 2, req_duration))
+		elif req_duration >= SLOT_MINS * 2 and (end - start) * SLOT_MINS >= req_duration / 2:
+			options = [(start_mins, (end - start) * SLOT_MINS)]
+		else:
+			options = []
+
+		for option in options:
+			suggestions.append(option)
+			if len(suggestions) == max_suggestions:
+				return suggestions
+
+	return suggestions
+
+
+def scan_days(days, first_tod, from_tod, req_duration, last_start):
+	# the best (earliest) suggestion for each day in one pass
+	# days is a list of (date, bookings); the first day starts at first_tod,
+	# the others at from_tod. Returns a list of (date, start, duration)
+	options = []
+	tod = first_tod
+	for date, bookings in days:
+		free = free_mask(day_mask(bookings), tod)
+		best = suggest(free, req_duration, last_start, max_suggestions=1)
+		if best:
+			options.append((date, best[0][0], best[0][1]))
+		tod = from_tod
+	return options
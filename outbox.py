@@ -0,0 +1,237 @@
+import collections
+import json
+import logging
+import metrics
+import os
+import slackutils
+import threading
+import time
+from app import slack_client
+from config import SLACK_API_URL
+from config import SLACK_MESSAGE_MAX_CHARS
+from config import SLACK_OUTBOX_SIZE
+from config import SLACK_RETRY_AFTER_DEFAULT
+
+try:
+	import Queue as queue
+	from urllib import urlencode
+	from urllib2 import HTTPError, Request, urlopen
+except ImportError:
+	import queue
+	from urllib.error import HTTPError
+	from urllib.parse import urlencode
+	from urllib.request import Request, urlopen
+
+# messages to slack are sent by a dedicated worker thread, so a slow slack api
+# call never holds up command handling or the scheduler threads
+# messages to a channel are always sent in order, and reminders that are
+# waiting for the same channel are combined into a single message
+
+MESSAGE = 'message'
+REMINDER = 'reminder'
+
+messages_queued = metrics.Counter('outbox_messages_queued', 'Messages queued for slack')
+messages_sent = metrics.Counter('outbox_messages_sent', 'Messages sent to slack')
+messages_coalesced = metrics.Counter('outbox_messages_coalesced',
+	'Reminders combined with another reminder')
+messages_dropped = metrics.Counter('outbox_messages_dropped',
+	'Messages dropped, queue full or send failed')
+rate_limited = metrics.Counter('outbox_rate_limited', 'Slack HTTP 429 responses')
+queue_depth = metrics.Gauge('outbox_queue_depth', 'Messages waiting to be sent')
+send_latency = metrics.Latency('outbox_send_latency_seconds',
+	'Time from queueing a message to slack accepting it')
+
+
+class OutboundMessage:
+	def __init__(self, channel, text, kind=MESSAGE):
+		self.channel = channel
+		self.text = text
+		self.kind = kind
+		self.queued_at = time.time()
+
+
+class SendResult:
+	def __init__(self, ok, retry_after=None, error=None):
+		self.ok = ok
+		self.retry_after = retry_after
+		self.error = error
+
+
+def parse_retry_after(value):
+	try:
+		return float(value)
+	except (TypeError, ValueError):
+		return SLACK_RETRY_AFTER_DEFAULT
+
+
+class SlackClientTransport:
+	# sends using the app's SlackClient
+	def post(self, channel, text):
+		result = slack_client.api_call("chat.postMessage", channel=channel, text=text,
+			as_user=True)
+		if result.get('ok'):
+			return SendResult(True)
+		if result.get('error') == 'ratelimited':
+			headers = result.get('headers', {})
+			return SendResult(False, retry_after=parse_retry_after(headers.get('Retry-After')),
+				error='ratelimited')
+		return SendResult(False, error=result.get('error'))
+
+
+class HTTPTransport:
+	# posts directly to a slack compatible web api, e.g. a local fake endpoint
+	def __init__(self, base_url, token, timeout=10):
+		self.url = base_url.rstrip('/') + '/chat.postMessage'
+		self.token = token
+		self.timeout = timeout
+
+	def post(self, channel, text):
+		data = urlencode({'token':self.token, 'channel':channel, 'text':text,
+			'as_user':'true'}).encode('utf-8')
+		try:
+			response = urlopen(Request(self.url, data), timeout=self.timeout)
+			result = json.loads(response.read().decode('utf-8'))
+		except HTTPError as e:
+			if e.code == 429:
+				return SendResult(False,
+					retry_after=parse_retry_after(e.headers.get('Retry-After')),
+					error='ratelimited')
+			return SendResult(False, error='HTTP %d' % (e.code))
+		except Exception as e:
+			return SendResult(False, error=str(e))
+
+		if result.get('ok'):
+			return SendResult(True)
+		return SendResult(False, error=result.get('error'))
+
+
+def create_transport():
+	if SLACK_API_URL:
+		return HTTPTransport(SLACK_API_URL, os.environ.get('SLACK_BOT_TOKEN'))
+	return SlackClientTransport()
+
+
+class Outbox:
+	def __init__(self, transport, max_size=SLACK_OUTBOX_SIZE):
+		self.transport = transport
+		self.queue = queue.Queue(maxsize=max_size)
+		# messages waiting per channel, in the order the channels were first seen
+		self.channels = collections.OrderedDict()
+		# channel -> time before which nothing is sent, after a 429
+		self.not_before = {}
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def send(self, channel, text, kind=MESSAGE):
+		# queue a message, returns False if the outbox is full
+		# a message that's too long for slack is queued as several, in order
+		for part in slackutils.split_message(text):
+			try:
+				self.queue.put(OutboundMessage(channel, part, kind), timeout=1)
+			except queue.Full:
+				messages_dropped.inc()
+				logging.error('Slack outbox full, dropped message to %s', channel)
+				return False
+			messages_queued.inc()
+			queue_depth.inc()
+		return True
+
+	def collect(self, timeout):
+		# moves queued messages into the per channel queues
+		try:
+			message = self.queue.get(timeout=timeout)
+		except queue.Empty:
+			return
+		while message:
+			self.channels.setdefault(message.channel, collections.deque()).append(message)
+			try:
+				message = self.queue.get_nowait()
+			except queue.Empty:
+				message = None
+
+	def next_batch(self, now):
+		# the next message(s) to send, from the first channel that isn't rate limited
+		for channel, waiting in self.channels.items():
+			if self.not_before.get(channel, 0) > now:
+				continue
+			batch = [waiting.popleft()]
+			if batch[0].kind == REMINDER:
+				# combined up to the size of a single message
+				size = len(batch[0].text)
+				while waiting and waiting[0].kind == REMINDER and \
+					size + 2 + len(waiting[0].text) <= SLACK_MESSAGE_MAX_CHARS:
+					size += 2 + len(waiting[0].text)
+					batch.append(waiting.popleft())
+			if not waiting:
+				del self.channels[channel]
+			else:
+				# round robin, so one busy channel doesn't starve the others
+				self.channels[channel] = self.channels.pop(channel)
+			return channel, batch
+		return None, None
+
+	def requeue(self, channel, batch):
+		# put a batch back at the front of its channel queue, e.g. after a 429
+		waiting = self.channels.setdefault(channel, collections.deque())
+		waiting.extendleft(reversed(batch))
+
+	def wait_time(self, now):
+		# how long the worker can block waiting for new messages
+		if not self.channels:
+			return 1
+		earliest = min(self.not_before.get(c, 0) for c in self.channels)
+		return max(0, min(1, earliest - now))
+
+	def send_batch(self, channel, batch):
+		text = '\n\n'.join(m.text for m in batch)
+		result = self.transport.post(channel, text)
+		now = time.time()
+		if result.ok:
+			for m in batch:
+				send_latency.observe(now - m.queued_at)
+			messages_sent.inc()
+			messages_coalesced.inc(len(batch) - 1)
+			queue_depth.dec(len(batch))
+		elif result.retry_after != None:
+			rate_limited.inc()
+			logging.warning('Slack rate limited %s, retry after %1.1fs', channel,
+				result.retry_after)
+			self.not_before[channel] = now + result.retry_after
+			self.requeue(channel, batch)
+		else:
+			messages_dropped.inc(len(batch))
+			queue_depth.dec(len(batch))
+			logging.error('Failed to send message to %s: %s', channel, result.error)
+
+	def run(self):
+		while not self.stopped.is_set():
+			self.collect(self.wait_time(time.time()))
+			while True:
+				channel, batch = self.next_batch(time.time())
+				if batch == None:
+					break
+				try:
+					self.send_batch(channel, batch)
+				except Exception:
+					messages_dropped.inc(len(batch))
+					queue_depth.dec(len(batch))
+					logging.exception('Failed to send message to %s', channel)
+				if self.stopped.is_set():
+					return
+
+	def start(self):
+		self.stopped.clear()
+		self.thread = threading.Thread(target=self.run, name='outbox')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread:
+			self.thread.join(timeout=2)
+
+
+outbox = Outbox(create_transport())
+
+def send(channel, text, kind=MESSAGE):
+	return outbox.send(channel, text, kind)
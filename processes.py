@@ -0,0 +1,53 @@
+from config import PROCESS_ROLE
+
+# the bot can run as one process, or split into a process per role, so the room
+# displays never wait on serial i/o or slack, see the README
+# the processes of a split deployment share the sensor status and booking
+# changes through shared_status
+
+# every part in one process
+ALL = 'all'
+# owns the serial port to the MCU, aggregates and publishes the sensor readings
+MCU = 'mcu'
+# slack, reminders and the scheduled jobs
+BOT = 'bot'
+# the room displays
+WEB = 'web'
+
+ROLES = (ALL, MCU, BOT, WEB)
+
+# the scheduled jobs that need the MCU
+MCU_JOBS = ('jobs:mcu_handler',)
+
+# the scheduled jobs every process with a scheduler runs, as metrics are per process
+COMMON_JOBS = ('jobs:log_metrics',)
+
+if PROCESS_ROLE not in ROLES:
+	raise ValueError('Unknown process role: %s' % (PROCESS_ROLE))
+
+role = PROCESS_ROLE
+
+
+def is_split():
+	return role != ALL
+
+
+def owns_mcu():
+	return role in (ALL, MCU)
+
+
+def runs_bot():
+	return role in (ALL, BOT)
+
+
+def runs_web():
+	return role in (ALL, WEB)
+
+
+def runs_job(func_ref):
+	# whether this process runs the scheduled job, func_ref as in JOBS
+	if role == ALL or func_ref in COMMON_JOBS:
+		return True
+	if func_ref in MCU_JOBS:
+		return role == MCU
+	return role == BOT
@@ -0,0 +1,236 @@
+import datetime
+import dtutils
+import logging
+import threading
+from app import models
+from config import RECURRING_CACHE_DAYS
+
+# recurring bookings are stored as weekly rules and expanded into occurrences
+# only for the days a query touches. The occurrences of each rule are cached,
+# and the cache is invalidated per rule when the rule or its exceptions change
+
+DAYS_IN_WEEK = 7
+
+KEY_PREFIX = 'r'
+
+
+def occurrence_key(rule_id, date):
+	# the id of an occurrence, e.g. on the room display and in reminders
+	return '%s%d:%s' % (KEY_PREFIX, rule_id, date.isoformat())
+
+
+def parse_key(key):
+	# (rule id, date) of an occurrence key, or None if it isn't one
+	key = '%s' % (key)
+	if not key.startswith(KEY_PREFIX):
+		return None
+	try:
+		rule_id, date = key[len(KEY_PREFIX):].split(':', 1)
+		return int(rule_id), datetime.datetime.strptime(date, '%Y-%m-%d').date()
+	except ValueError:
+		return None
+
+
+class IndexedRule:
+	# a detached copy of a RecurringBooking
+	def __init__(self, rule):
+		self.id = rule.id
+		self.weekday = rule.weekday
+		self.start_time = rule.start_time
+		self.duration = rule.duration
+		self.start_date = rule.start_date
+		self.until_date = rule.until_date
+		self.booker_sid = rule.booker_sid
+		self.attendees = rule.attendees
+		self.name = rule.name
+		self.room = rule.room
+		self.slack_channel = rule.slack_channel
+
+	def first_on_or_after(self, date):
+		# the date of the first occurrence on or after date, ignoring exceptions
+		date = max(date, self.start_date)
+		date += datetime.timedelta(days=(self.weekday - date.weekday()) % DAYS_IN_WEEK)
+		if self.until_date != None and date > self.until_date:
+			return None
+		return date
+
+
+class Occurrence:
+	# a single occurrence of a recurring booking, has the same fields as
+	# booking_index.IndexedBooking, so the two can be used interchangeably
+	def __init__(self, rule, date):
+		self.id = occurrence_key(rule.id, date)
+		self.recurring_id = rule.id
+		self.start_date = date
+		self.start_time = rule.start_time
+		self.duration = rule.duration
+		self.end_time = rule.start_time + rule.duration
+		self.booker_sid = rule.booker_sid
+		self.attendees = rule.attendees
+		self.name = rule.name
+		self.in_progress = False
+		self.finished = False
+		self.room = rule.room
+
+	def __repr__(self):
+		return '<Occurrence %s %s %r %d %d %s>' % (self.id, self.room,
+			self.start_date, self.start_time, self.duration, self.booker_sid)
+
+
+class RecurringIndex:
+	def __init__(self, cache_days=RECURRING_CACHE_DAYS):
+		self.cache_days = cache_days
+		# rule id -> IndexedRule
+		self.rules = {}
+		# rule id -> set of dates the rule doesn't occur on
+		self.exceptions = {}
+		# rule id -> {date: Occurrence or None}, the expanded days of each rule
+		self.cache = {}
+		self.loaded = False
+		self.lock = threading.RLock()
+		self.listeners = []
+
+	def add_listener(self, listener):
+		# listener is called, without arguments, whenever a rule changes
+		self.listeners.append(listener)
+
+	def changed(self):
+		for listener in self.listeners:
+			listener()
+
+	def load(self):
+		# (re)load the current rules from the db, must be called within an app context
+		today = dtutils.local_date_now()
+		with self.lock:
+			self.rules = {}
+			self.exceptions = {}
+			self.cache = {}
+			rules = models.RecurringBooking.query.filter( \
+				(models.RecurringBooking.until_date == None) | \
+				(models.RecurringBooking.until_date >= today)).all()
+			for rule in rules:
+				self.rules[rule.id] = IndexedRule(rule)
+			exceptions = models.RecurringException.query.filter( \
+				models.RecurringException.date >= today).all()
+			for exception in exceptions:
+				self.exceptions.setdefault(exception.recurring_id, set()).add(exception.date)
+			self.loaded = True
+		self.changed()
+		logging.info('Loaded %d recurring booking(s)', len(rules))
+
+	def ensure_loaded(self):
+		if not self.loaded:
+			self.load()
+
+	def invalidate(self, rule_id):
+		with self.lock:
+			self.cache.pop(rule_id, None)
+
+	def add_rule(self, rule):
+		# call once the rule has been committed
+		with self.lock:
+			if self.loaded:
+				self.rules[rule.id] = IndexedRule(rule)
+				self.invalidate(rule.id)
+		self.changed()
+
+	def update_rule(self, rule):
+		self.add_rule(rule)
+
+	def remove_rule(self, rule_id):
+		with self.lock:
+			self.rules.pop(rule_id, None)
+			self.exceptions.pop(rule_id, None)
+			self.invalidate(rule_id)
+		self.changed()
+
+	def add_exception(self, rule_id, date):
+		# call once the exception has been committed
+		with self.lock:
+			if self.loaded:
+				self.exceptions.setdefault(rule_id, set()).add(date)
+				self.invalidate(rule_id)
+		self.changed()
+
+	def remove_before(self, date):
+		# forget rules that have ended and cached days before date, e.g. after a cleanup
+		with self.lock:
+			for rule_id, rule in list(self.rules.items()):
+				if rule.until_date != None and rule.until_date < date:
+					del self.rules[rule_id]
+					self.exceptions.pop(rule_id, None)
+					self.cache.pop(rule_id, None)
+			for rule_id, dates in self.exceptions.items():
+				dates.difference_update([d for d in dates if d < date])
+			for rule_id, days in self.cache.items():
+				for d in [d for d in days if d < date]:
+					del days[d]
+
+	def get_rule(self, rule_id):
+		with self.lock:
+			self.ensure_loaded()
+			return self.rules.get(rule_id)
+
+	def _occurrence(self, rule, date):
+		# the rule's occurrence on date, or None, expanded on first use
+		days = self.cache.get(rule.id)
+		if days == None:
+			days = {}
+			self.cache[rule.id] = days
+		elif date in days:
+			return days[date]
+
+		occurrence = None
+		if date.weekday() == rule.weekday and date >= rule.start_date and \
+			(rule.until_date == None or date <= rule.until_date) and \
+			date not in self.exceptions.get(rule.id, ()):
+			occurrence = Occurrence(rule, date)
+		if len(days) >= self.cache_days:
+			# the cache only needs to cover the days being queried
+			days.clear()
+		days[date] = occurrence
+		return occurrence
+
+	def get_occurrence(self, rule_id, date):
+		with self.lock:
+			self.ensure_loaded()
+			rule = self.rules.get(rule_id)
+			if rule == None:
+				return None
+			return self._occurrence(rule, date)
+
+	def day_occurrences(self, date, room):
+		# the occurrences in the room on date, in start time order
+		with self.lock:
+			self.ensure_loaded()
+			occurrences = []
+			for rule in self.rules.values():
+				if rule.room == room and rule.weekday == date.weekday():
+					occurrence = self._occurrence(rule, date)
+					if occurrence:
+						occurrences.append(occurrence)
+		occurrences.sort(key=lambda o: o.start_time)
+		return occurrences
+
+	def occurrences_between(self, start_date, end_date, room=None, booker_sid=None):
+		# the occurrences from start_date up to, but excluding, end_date
+		# in date and start time order, optionally for a room and/or booker
+		with self.lock:
+			self.ensure_loaded()
+			occurrences = []
+			for rule in self.rules.values():
+				if (room and rule.room != room) or \
+					(booker_sid != None and rule.booker_sid != booker_sid):
+					continue
+				date = rule.first_on_or_after(start_date)
+				while date != None and date < end_date and \
+					(rule.until_date == None or date <= rule.until_date):
+					occurrence = self._occurrence(rule, date)
+					if occurrence:
+						occurrences.append(occurrence)
+					date += datetime.timedelta(days=DAYS_IN_WEEK)
+		occurrences.sort(key=lambda o: (o.start_date, o.start_time))
+		return occurrences
+
+
+index = RecurringIndex()
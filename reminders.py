@@ -0,0 +1,126 @@
+import heapq
+import itertools
+import logging
+import metrics
+import threading
+import time
+from app import db, models
+from config import REMINDER_LATE_SECS
+from config import REMINDER_MAX_LATENESS
+
+# pending reminders are kept in a min-heap ordered by send_at, a single thread
+# sleeps until the earliest one is due, so every reminder is sent on time
+# rather than when a periodic sweep happens to line up with it
+# the heap holds Reminder ids and the keys of recurring booking occurrences, whose
+# reminders aren't stored, see bookings.schedule_recurring_reminders
+
+reminders_fired = metrics.Counter('reminders_fired', 'Reminders sent')
+reminders_late = metrics.Counter('reminders_late', 'Reminders sent after send_at')
+reminders_dropped = metrics.Counter('reminders_dropped', 'Reminders too late to send')
+reminders_pending = metrics.Gauge('reminders_pending', 'Reminders waiting to be sent')
+
+
+def pending_query(now):
+	# the stored reminders that aren't too late to send, now is a timestamp
+	return models.Reminder.query.filter(models.Reminder.send_at >= now - REMINDER_MAX_LATENESS)
+
+
+class ReminderScheduler:
+	def __init__(self):
+		self.heap = []
+		self.pending = set()
+		# breaks send_at ties, so ids and keys are never compared
+		self.seq = itertools.count()
+		self.cond = threading.Condition()
+		self.stopped = False
+		self.thread = None
+		self.fire = None
+
+	def load(self):
+		# hydrate the heap from the db, must be called within an app context
+		# reminders already too late to send are left for the cleanup job to delete,
+		# rather than dropped again on every start
+		reminders = pending_query(time.time()).all()
+		with self.cond:
+			for reminder in reminders:
+				self._push(reminder.send_at, reminder.id)
+			self.cond.notify()
+		logging.info('Loaded %d reminder(s)', len(reminders))
+
+	def _push(self, send_at, reminder_id):
+		if reminder_id not in self.pending:
+			heapq.heappush(self.heap, (send_at, next(self.seq), reminder_id))
+			self.pending.add(reminder_id)
+			reminders_pending.set(len(self.pending))
+
+	def add(self, reminder):
+		# call once the reminder has been committed
+		self.add_key(reminder.send_at, reminder.id)
+
+	def add_key(self, send_at, key):
+		# a reminder that isn't stored, e.g. for an occurrence of a recurring booking
+		with self.cond:
+			self._push(send_at, key)
+			self.cond.notify()
+
+	def pop_due(self, now):
+		# removes and returns the ids of reminders that are due
+		# reminders that are too late to be useful are dropped
+		due = []
+		with self.cond:
+			while self.heap and self.heap[0][0] <= now:
+				send_at, seq, reminder_id = heapq.heappop(self.heap)
+				self.pending.discard(reminder_id)
+				lateness = now - send_at
+				if lateness > REMINDER_MAX_LATENESS:
+					reminders_dropped.inc()
+					logging.warning('Dropped reminder %s, %ds late', reminder_id, lateness)
+					continue
+				if lateness > REMINDER_LATE_SECS:
+					reminders_late.inc()
+				due.append(reminder_id)
+			reminders_pending.set(len(self.pending))
+		return due
+
+	def run(self):
+		# the reminder thread, sleeps until the next reminder is due
+		with db.app.app_context():
+			self.load()
+			while True:
+				with self.cond:
+					while not self.stopped:
+						if self.heap:
+							delay = self.heap[0][0] - time.time()
+							if delay <= 0:
+								break
+							self.cond.wait(delay)
+						else:
+							self.cond.wait()
+					if self.stopped:
+						return
+
+				due = self.pop_due(time.time())
+				if due:
+					try:
+						self.fire(due)
+						reminders_fired.inc(len(due))
+					except Exception:
+						logging.exception('Failed to send reminders: %s', due)
+
+	def start(self, fire):
+		# fire is called with a list of reminder ids and occurrence keys that are due
+		self.fire = fire
+		self.stopped = False
+		self.thread = threading.Thread(target=self.run, name='reminders')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		with self.cond:
+			self.stopped = True
+			self.cond.notify()
+		if self.thread:
+			self.thread.join(timeout=2)
+
+
+scheduler = ReminderScheduler()
@@ -0,0 +1,218 @@
+import archive
+import datetime
+import dtutils
+import logging
+import metrics
+import storage
+import suggestions
+from app import db, models
+from config import RETENTION_BATCH_SIZE
+
+# removes expired rows in small batches, each in its own short transaction, with a
+# pause between them, so the bot and displays aren't blocked by one long delete
+# expired bookings and recurring bookings are archived before they're deleted,
+# and the booking refs that point at them are deleted with them
+
+rows_deleted = metrics.Family(metrics.Counter, 'retention_rows_deleted',
+	'Rows deleted by the cleanup job', 'table')
+rows_archived = metrics.Family(metrics.Counter, 'retention_rows_archived',
+	'Rows archived by the cleanup job', 'kind')
+
+
+# the reminders that have been sent, or are too late to send
+EXPIRED_REMINDERS = 'send_at < :now'
+
+
+def booking_record(booking):
+	return {'kind':archive.BOOKING, 'id':booking.id, 'room':booking.room,
+		'start_date':booking.start_date, 'start_time':booking.start_time,
+		'duration':booking.duration, 'booker_sid':booking.booker_sid,
+		'attendees':booking.attendees, 'name':booking.name, 'finished':booking.finished,
+		'start_epoch_min':booking.start_epoch_min, 'end_epoch_min':booking.end_epoch_min,
+		'recurring_id':booking.recurring_id}
+
+
+def recurring_record(rule):
+	return {'kind':archive.RECURRING, 'id':rule.id, 'room':rule.room,
+		'start_date':rule.start_date, 'until_date':rule.until_date, 'weekday':rule.weekday,
+		'start_time':rule.start_time, 'duration':rule.duration, 'booker_sid':rule.booker_sid,
+		'attendees':rule.attendees, 'name':rule.name}
+
+
+def occurrence_record(rule, date):
+	# an occurrence that happened, archived as a booking, its id is minus the rule's
+	# as for refs, so it's never mistaken for a ConfirmedBooking
+	start = dtutils.to_epoch_minute(date, rule.start_time)
+	return {'kind':archive.BOOKING, 'id':-rule.id, 'room':rule.room, 'start_date':date,
+		'start_time':rule.start_time, 'duration':rule.duration, 'booker_sid':rule.booker_sid,
+		'attendees':rule.attendees, 'name':rule.name, 'finished':True,
+		'start_epoch_min':start, 'end_epoch_min':start + rule.duration, 'recurring_id':rule.id}
+
+
+def exceptions_between(rule_id, start_date, end_date):
+	return models.RecurringException.query.filter( \
+		models.RecurringException.recurring_id == rule_id,
+		models.RecurringException.date >= start_date,
+		models.RecurringException.date < end_date)
+
+
+def past_occurrences(rule, today):
+	# the dates of the rule's occurrences from archived_until up to, but excluding,
+	# today, except those it was cancelled on or that were started, as a started
+	# occurrence is a ConfirmedBooking that's archived itself
+	start_date = rule.archived_until or rule.start_date
+	end_date = today
+	if rule.until_date != None and rule.until_date < end_date:
+		end_date = rule.until_date + datetime.timedelta(days=1)
+	if start_date >= end_date:
+		return []
+	exceptions = set(e.date for e in exceptions_between(rule.id, start_date, end_date))
+	date = start_date + datetime.timedelta(days=(rule.weekday - start_date.weekday()) % 7)
+	dates = []
+	while date < end_date:
+		if date not in exceptions:
+			dates.append(date)
+		date += datetime.timedelta(days=7)
+	return dates
+
+
+def archive_occurrences(today, batch_size=RETENTION_BATCH_SIZE):
+	# archives the occurrences of the recurring bookings before today, before their
+	# exceptions are deleted, so past occurrences are only read from the archive
+	# returns the number of occurrences archived
+	total = 0
+	while True:
+		rules = models.RecurringBooking.query.filter( \
+			(models.RecurringBooking.archived_until == None) | \
+			(models.RecurringBooking.archived_until < today)). \
+			filter(models.RecurringBooking.start_date < today). \
+			order_by(models.RecurringBooking.id).limit(batch_size).all()
+		if not rules:
+			return total
+
+		records = []
+		for rule in rules:
+			records += [occurrence_record(rule, date) for date in past_occurrences(rule, today)]
+			rule.archived_until = today
+		if records:
+			archive.archive.append(records)
+			rows_archived.get(archive.BOOKING).inc(len(records))
+		storage.commit()
+		db.session.expunge_all()
+		total += len(records)
+
+		if len(rules) < batch_size:
+			return total
+		storage.pause_between_batches()
+
+
+def delete_refs(booking_ids):
+	# the refs of the deleted bookings, part of the caller's batch
+	if booking_ids:
+		count = models.ConfirmedBookingRef.query. \
+			filter(models.ConfirmedBookingRef.booking.in_(booking_ids)). \
+			delete(synchronize_session=False)
+		rows_deleted.get('confirmed_booking_ref').inc(count)
+
+
+def expired_query(day_start, batch_size=RETENTION_BATCH_SIZE):
+	# the oldest batch of bookings that ended before day_start, an epoch minute
+	return models.ConfirmedBooking.query. \
+		filter(models.ConfirmedBooking.end_epoch_min < day_start). \
+		order_by(models.ConfirmedBooking.end_epoch_min).limit(batch_size)
+
+
+def expire_bookings(day_start, batch_size=RETENTION_BATCH_SIZE):
+	# archives then deletes the bookings that ended before day_start, an epoch minute
+	# oldest first, using ix_confirmed_booking_end
+	total = 0
+	while True:
+		bookings = expired_query(day_start, batch_size).all()
+		if not bookings:
+			return total
+
+		archive.archive.append([booking_record(b) for b in bookings])
+		rows_archived.get(archive.BOOKING).inc(len(bookings))
+
+		ids = [b.id for b in bookings]
+		delete_refs(ids)
+		models.Reminder.query.filter(models.Reminder.booking.in_(ids)). \
+			delete(synchronize_session=False)
+		models.ConfirmedBooking.query.filter(models.ConfirmedBooking.id.in_(ids)). \
+			delete(synchronize_session=False)
+		storage.commit()
+		db.session.expunge_all()
+		rows_deleted.get('confirmed_booking').inc(len(ids))
+		total += len(ids)
+
+		if len(bookings) < batch_size:
+			return total
+		storage.pause_between_batches()
+
+
+def expire_recurring_bookings(today, batch_size=RETENTION_BATCH_SIZE):
+	# archives then deletes the recurring bookings that ended before today
+	total = 0
+	while True:
+		rules = models.RecurringBooking.query. \
+			filter(models.RecurringBooking.until_date < today). \
+			order_by(models.RecurringBooking.until_date).limit(batch_size).all()
+		if not rules:
+			return total
+
+		archive.archive.append([recurring_record(r) for r in rules])
+		rows_archived.get(archive.RECURRING).inc(len(rules))
+
+		ids = [r.id for r in rules]
+		# refs to a recurring booking are minus its id
+		delete_refs([-i for i in ids])
+		models.RecurringException.query. \
+			filter(models.RecurringException.recurring_id.in_(ids)). \
+			delete(synchronize_session=False)
+		models.RecurringBooking.query.filter(models.RecurringBooking.id.in_(ids)). \
+			delete(synchronize_session=False)
+		storage.commit()
+		db.session.expunge_all()
+		rows_deleted.get('recurring_booking').inc(len(ids))
+		total += len(ids)
+
+		if len(rules) < batch_size:
+			return total
+		storage.pause_between_batches()
+
+
+def delete_in_batches(model, where, params=None):
+	count = storage.delete_in_batches(model.__table__.name, where, params)
+	rows_deleted.get(model.__table__.name).inc(count)
+	return count
+
+
+def run(now):
+	# the cleanup, now is a utc datetime
+	# must be called within an app context, but not within a unit of work
+	# returns table name -> rows deleted
+	today = dtutils.local_date_now()
+	# bookings that ended before today
+	day_start = dtutils.to_epoch_minute(today, 0)
+
+	counts = {}
+	counts['reminder'] = delete_in_batches(models.Reminder, EXPIRED_REMINDERS,
+		{'now':dtutils.to_timestamp(now)})
+	counts['confirmed_booking'] = expire_bookings(day_start)
+	# before the exceptions they're checked against, and their rules, are deleted
+	occurrences = archive_occurrences(today)
+	counts['recurring_booking'] = expire_recurring_bookings(today)
+	# sqlite stores dates as iso strings
+	counts['recurring_exception'] = delete_in_batches(models.RecurringException,
+		'date < :today', {'today':today.isoformat()})
+
+	# refs left behind before the refs were deleted with their bookings
+	counts['confirmed_booking_ref'] = delete_in_batches(models.ConfirmedBookingRef,
+		'(booking > 0 AND booking NOT IN (SELECT id FROM confirmed_booking)) OR ' +
+		'(booking < 0 AND -booking NOT IN (SELECT id FROM recurring_booking))')
+
+	suggestions.store.cleanup(now.date())
+
+	logging.info('Cleanup: %s, %d recurring occurrence(s) archived', ', '.join('%s %d' % \
+		(table, counts[table]) for table in sorted(counts)), occurrences)
+	return counts
@@ -0,0 +1,198 @@
+import booking_index
+import dtutils
+import hashlib
+import json
+import logging
+import math
+import rooms
+import threading
+from app import models
+from config import UNNAMED_MEETING_NAME
+from dtutils import MINS_IN_HOUR
+
+# the state shown on a room's display, computed once and shared by every display of the room
+# it's only recomputed when a booking changes or the minute ticks over
+
+CTA_NEW_BOOKING = {'cta':'Meet Now', 'action':1}
+CTA_START_MEETING = {'cta':'Start Meeting', 'action':2}
+CTA_START_MEETING_EARLY = {'cta':'Start Meeting Early', 'action':2}
+CTA_END_MEETING = {'cta':'End Meeting', 'action':3}
+CTA_STEAL_AND_BOOK = {'cta':'Steal Me', 'action':4}
+
+MSG_AVAILABLE = 'Available'
+MSG_BOOKING_STARTS_SOON = '%s'
+MSG_BOOKING_WAITING = '%s'
+MSG_BOOKING_IN_PROGRESS = '%s'
+MSG_BOOKING_ABANDONED = '%s, abandoned'
+MSG_NO_BOOKINGS_ROTD = "I'm free for the rest of the day"
+MSG_CURR_BOOKING_ENDS = 'The current meeting ends in %d minutes, at %02d:%02d'
+MSG_NEXT_BOOKING_STARTS = 'The next meeting starts in %d %s'
+MSG_CHECK_SLACK = 'Check upcoming meetings on Slack:'
+MSG_NEXT_FREE_AT = "I'm next free at %02d:%02d for %d minutes"
+MSG_FREE_ROTD_AFTER = 'After %02d:%02d, ' + MSG_NO_BOOKINGS_ROTD
+
+
+def get_booker(booking):
+	# the booker's details shown on the display
+	user = models.SlackUser.query.filter(models.SlackUser.sid == booking.booker_sid).first()
+	if user:
+		return {'name':user.name, 'real_name':user.real_name, 'image_48':user.image_48}
+	return None
+
+
+def compute_state(now, room_id):
+	# the status of the room at the specified local time
+	now_date = now.date()
+	now_tod = now.hour * MINS_IN_HOUR + now.minute
+	logging.debug('now_date: %s; now_tod: %d' % (now_date, now_tod))
+
+	conf_bookings = [b for b in booking_index.index.day_bookings(now_date, now_tod, room_id)
+		if not b.finished][:2]
+
+	booking_id = -1
+	cta = CTA_NEW_BOOKING
+	colour = 'success'
+	availability = MSG_AVAILABLE
+	current_booking = None
+	next_booking = None
+	next_free = None
+	for b in conf_bookings:
+		if next_free == None:
+			# the end of the first meeting in the list
+			next_free = [b.start_time + b.duration]
+		elif b.start_time == next_free[0]:
+			# the end of the last meeting in the list
+			next_free[0] = b.start_time + b.duration
+		else:
+			next_free.append(b.start_time)
+
+		if b.in_progress:
+			current_booking = b
+			colour = 'danger'
+			availability = MSG_BOOKING_IN_PROGRESS
+			booking_id = b.id
+			cta = CTA_END_MEETING
+		elif b.start_time <= now_tod:
+			current_booking = b
+			colour = 'warning'
+			booking_id = b.id
+			if b.start_time <= now_tod - 10:
+				availability = MSG_BOOKING_ABANDONED
+				cta = CTA_STEAL_AND_BOOK
+			else:
+				availability = MSG_BOOKING_WAITING
+				cta = CTA_START_MEETING
+		else:
+			# the first future booking is the next booking
+			if next_booking == None:
+				next_booking = b
+			if now_tod + 15 > b.start_time and availability == MSG_AVAILABLE:
+				colour = 'warning'
+				availability = MSG_BOOKING_STARTS_SOON
+				booking_id = b.id
+				cta = CTA_START_MEETING_EARLY
+
+	booker = None
+	if availability.startswith('%s'):
+		if current_booking:
+			if current_booking.name:
+				availability = availability % (current_booking.name)
+				booker = get_booker(current_booking)
+		elif next_booking:
+			if next_booking.name:
+				availability = availability % (next_booking.name)
+				booker = get_booker(next_booking)
+		else:
+			availability = availability % (UNNAMED_MEETING_NAME)
+	
+	next_free_msg = MSG_NO_BOOKINGS_ROTD
+	if next_free and len(next_free) == 1 and len(conf_bookings) == 2:
+		# could be the last booking of the day or just the last booking in the list
+		next_free_msg = MSG_CHECK_SLACK
+	elif next_free and len(next_free) == 2:
+		next_free_msg = MSG_NEXT_FREE_AT % \
+			(next_free[0] // MINS_IN_HOUR, next_free[0] % MINS_IN_HOUR, \
+			next_free[1] - next_free[0])
+	elif current_booking:
+		booking_ends = current_booking.start_time + current_booking.duration
+		next_free_msg = MSG_FREE_ROTD_AFTER % \
+			(booking_ends // MINS_IN_HOUR, booking_ends % MINS_IN_HOUR)
+	elif next_booking:
+		booking_ends = next_booking.start_time + next_booking.duration
+		next_free_msg = MSG_FREE_ROTD_AFTER % \
+			(booking_ends // MINS_IN_HOUR, booking_ends % MINS_IN_HOUR)
+	
+	next_booking_msg = MSG_NO_BOOKINGS_ROTD
+	if next_booking == None:
+		if current_booking:
+			booking_ends = current_booking.start_time + current_booking.duration
+			num_mins = booking_ends - now_tod
+			next_booking_msg = MSG_CURR_BOOKING_ENDS % \
+				(num_mins, booking_ends // MINS_IN_HOUR, booking_ends % MINS_IN_HOUR)
+	else:
+		msg = MSG_NEXT_BOOKING_STARTS
+		num_mins = next_booking.start_time - now_tod
+		if num_mins > 90:
+			msg = msg % (int(math.ceil(num_mins / MINS_IN_HOUR)), 'hours')
+		else:
+			msg = msg % (num_mins, 'minutes')
+		next_booking_msg = msg + ', at %02d:%02d' % \
+			(next_booking.start_time // MINS_IN_HOUR, next_booking.start_time % MINS_IN_HOUR)
+
+	return {'colour':colour, 'availability':availability, 'next_free':next_free_msg,
+		'next_booking':next_booking_msg, 'cta':cta['cta'], 'action':cta['action'],
+		'booking_id':booking_id, 'booker':booker,
+		'time':'%02d:%02d' % (now.hour, now.minute)}
+
+
+class RoomState:
+	def __init__(self, room_id):
+		self.room_id = room_id
+		self.version = 0
+		self.key = None
+		self.state = None
+		self.body = None
+		self.etag = None
+		self.cond = threading.Condition()
+		self.lock = threading.Lock()
+
+	def invalidate(self):
+		# call when a booking changes, wakes up any waiting display streams
+		with self.cond:
+			self.version += 1
+			self.cond.notify_all()
+
+	def get(self):
+		# the current state, its json encoding and etag
+		# must be called within an app context
+		now = dtutils.local_datetime_now()
+		key = (self.version, now.date(), now.hour, now.minute)
+		with self.lock:
+			if key != self.key:
+				self.state = compute_state(now, self.room_id)
+				self.body = json.dumps(self.state, sort_keys=True)
+				self.etag = '"%s"' % (hashlib.md5(self.body.encode('utf-8')).hexdigest())
+				self.key = key
+			return self.state, self.body, self.etag
+
+	def wait(self, version, timeout):
+		# waits until the state changes from version, or timeout seconds
+		with self.cond:
+			if self.version == version:
+				self.cond.wait(timeout)
+			return self.version
+
+
+room_states = dict((room.id, RoomState(room.id)) for room in rooms.all_rooms())
+
+
+def get_room_state(room_id):
+	return room_states.get(room_id)
+
+
+def invalidate_all():
+	for state in room_states.values():
+		state.invalidate()
+
+
+booking_index.index.add_listener(invalidate_all)
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from config import ROOMS
+from config import DEFAULT_ROOM
+
+# the rooms managed by the bot, from config.ROOMS
+# a room can be referred to in commands by its id or any of its aliases
+
+
+class Room:
+	def __init__(self, id, name, type, aliases=None, pins=None):
+		self.id = id
+		self.name = name
+		self.type = type
+		self.aliases = aliases or []
+		# sensor/relay pins of the MCU in the room, if it has one
+		self.pins = pins
+
+	def has_sensors(self):
+		return self.pins != None
+
+	def __repr__(self):
+		return '<Room %s>' % (self.id)
+
+
+registry = OrderedDict()
+for room_config in ROOMS:
+	room = Room(**room_config)
+	registry[room.id] = room
+
+# lowercase id/alias -> room id, as used in commands
+ALIASES = {}
+for room in registry.values():
+	ALIASES[room.id.lower()] = room.id
+	for alias in room.aliases:
+		ALIASES[alias.lower()] = room.id
+
+
+def get_room(room_id):
+	return registry.get(room_id)
+
+
+def all_rooms():
+	return list(registry.values())
+
+
+def all_room_ids():
+	return list(registry.keys())
+
+
+def is_multi_room():
+	return len(registry) > 1
+
+
+def sensor_room():
+	# the room whose sensors are connected to this device's MCU
+	for room in registry.values():
+		if room.has_sensors():
+			return room
+	return None
+
+
+default_room = registry[DEFAULT_ROOM]
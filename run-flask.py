@@ -1,24 +1,65 @@
+# app first, its scheduler resolves the job functions in jobs, which must be
+# imported after the app's db and mcu exist
+from app import app, scheduler, slack_client
+import analytics
+import argparse
 import logging
+import bookings
+import instrumentation
+import jobs
 import mcu_utils
-from app import app, mcu, scheduler, slack_client
-from config import MOTION_SENSOR
-from config import ELECTRICITY_RELAY
-from config import ELECTRICITY_SENSOR
-from config import TEMP_SENSOR
-from config import LIGHT_SENSOR
-
-# set MCU pin modes
-mcu.set_pin_mode(MOTION_SENSOR, mcu.INPUT, mcu.DIGITAL)
-mcu.set_digital_latch(MOTION_SENSOR, mcu.DIGITAL_LATCH_LOW,
-	mcu_utils.motion_sensor_callback)
-mcu.set_pin_mode(ELECTRICITY_RELAY, mcu.OUTPUT, mcu.DIGITAL)
-mcu.set_pin_mode(ELECTRICITY_SENSOR, mcu.INPUT, mcu.ANALOG)
-mcu.set_pin_mode(TEMP_SENSOR, mcu.INPUT, mcu.ANALOG)
-mcu.set_pin_mode(LIGHT_SENSOR, mcu.INPUT, mcu.ANALOG)
-
-if slack_client.rtm_connect():
-	scheduler.start()
-
-	app.run(host='192.168.0.17', debug=False)
+import outbox
+import processes
+import reminders
+import serving
+import shared_status
+import slack_directory
+import slack_rtm
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='Runs the room manager bot and displays')
+parser.add_argument('--serve', choices=serving.MODES, default=serving.SERVER_MODE,
+	help='serve the room displays with the dev or production server (default %(default)s)')
+args = parser.parse_args()
+
+# PROCESS_ROLE picks the part of the bot this process runs, see processes
+logging.info('Starting the %s process role', processes.role)
+
+if processes.runs_bot() and not slack_client.rtm_connect():
+	logging.critical("Connection failed. Invalid Slack token or bot ID?")
+	sys.exit(1)
+
+# the jobs of the other roles
+for job in scheduler.get_jobs():
+	if not processes.runs_job(job.func_ref):
+		scheduler.remove_job(job.id)
+
+if processes.owns_mcu():
+	# set MCU pin modes and start the sensor reporting
+	mcu_utils.start_sampling()
+
+if processes.is_split() and (processes.runs_bot() or processes.runs_web()):
+	# the bot and web processes reload the bookings the other one changes
+	shared_status.share_bookings(app)
+
+if processes.runs_bot():
+	with app.app_context():
+		slack_directory.directory.sync()
+		# the recurring bookings' reminders aren't stored
+		bookings.schedule_recurring_reminders()
+	# so the first stats command doesn't have to read them
+	analytics.load()
+	outbox.outbox.start()
+	slack_rtm.start()
+	reminders.scheduler.start(instrumentation.timed_job('send_reminders', jobs.send_reminders))
+
+instrumentation.instrument_scheduler(scheduler)
+scheduler.start()
+
+if processes.runs_web():
+	serving.serve(app, args.serve)
 else:
-	logging.critical("Connection failed. Invalid Slack token or bot ID?")
\ No newline at end of file
+	# the scheduler and the mcu and slack threads are daemons
+	while True:
+		time.sleep(60)
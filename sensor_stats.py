@@ -0,0 +1,115 @@
+import collections
+import threading
+from array import array
+
+# rolling statistics for sensor readings
+# each window is a fixed size ring buffer, with a running sum and monotonic
+# queues for min and max, so adding a sample is O(1) however big the window is
+# readers get an immutable snapshot, which is replaced rather than changed
+
+
+class RollingWindow:
+	def __init__(self, size):
+		self.size = size
+		self.values = array('d', [0.0] * size)
+		self.count = 0
+		self.index = 0
+		self.total = 0.0
+		# (sample number, value), values increasing for min, decreasing for max
+		self.mins = collections.deque()
+		self.maxs = collections.deque()
+		self.samples = 0
+
+	def add(self, value):
+		if self.count == self.size:
+			# overwrite the oldest value
+			self.total -= self.values[self.index]
+		else:
+			self.count += 1
+		self.values[self.index] = value
+		self.index = (self.index + 1) % self.size
+		self.total += value
+
+		oldest = self.samples - self.size + 1
+		while self.mins and self.mins[-1][1] >= value:
+			self.mins.pop()
+		self.mins.append((self.samples, value))
+		while self.mins[0][0] < oldest:
+			self.mins.popleft()
+		while self.maxs and self.maxs[-1][1] <= value:
+			self.maxs.pop()
+		self.maxs.append((self.samples, value))
+		while self.maxs[0][0] < oldest:
+			self.maxs.popleft()
+		self.samples += 1
+
+	def get_mean(self):
+		if self.count == 0:
+			return None
+		return self.total / self.count
+
+	def get_min(self):
+		if self.count == 0:
+			return None
+		return self.mins[0][1]
+
+	def get_max(self):
+		if self.count == 0:
+			return None
+		return self.maxs[0][1]
+
+
+class WindowSnapshot:
+	def __init__(self, window):
+		self.count = window.count
+		self.mean = window.get_mean()
+		self.min = window.get_min()
+		self.max = window.get_max()
+
+
+class SensorSnapshot:
+	# an immutable view of a sensor's stats, safe to read from any thread
+	def __init__(self, latest=None, ewma=None, windows=None):
+		self.latest = latest
+		self.ewma = ewma
+		self.windows = windows or {}
+
+	def get_latest_value(self):
+		return self.latest
+
+	def get_average(self, window):
+		if window in self.windows:
+			return self.windows[window].mean
+		return None
+
+
+class SensorStats:
+	# windows is a dict of window name -> number of samples
+	def __init__(self, name, windows, ewma_alpha):
+		self.name = name
+		self.windows = dict((w, RollingWindow(size)) for w, size in windows.items())
+		self.ewma_alpha = ewma_alpha
+		self.ewma = None
+		self.lock = threading.Lock()
+		self.snapshot = SensorSnapshot()
+
+	def add(self, value):
+		# writers are serialised, readers never wait
+		with self.lock:
+			for window in self.windows.values():
+				window.add(value)
+			if self.ewma == None:
+				self.ewma = value
+			else:
+				self.ewma += self.ewma_alpha * (value - self.ewma)
+			self.snapshot = SensorSnapshot(value, self.ewma,
+				dict((w, WindowSnapshot(window)) for w, window in self.windows.items()))
+
+	def get_snapshot(self):
+		return self.snapshot
+
+
+def window_sizes(windows, sample_secs):
+	# converts a dict of window name -> seconds into a number of samples, added
+	# every sample_secs, which can be a fraction of a second
+	return dict((w, int(max(1, secs // sample_secs))) for w, secs in windows.items())
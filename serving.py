@@ -0,0 +1,128 @@
+import logging
+import static_assets
+from config import GZIP_LEVEL
+from config import GZIP_MIN_SIZE
+from config import SERVER_HOST
+from config import SERVER_MODE
+from config import SERVER_PORT
+from config import SERVER_THREADS
+
+try:
+	import waitress
+except ImportError:
+	waitress = None
+
+try:
+	from cheroot import wsgi as cheroot_wsgi
+except ImportError:
+	cheroot_wsgi = None
+
+# how the room displays are served, see SERVER_MODE
+# flask's development server
+DEV = 'dev'
+# a WSGI server, waitress or else cheroot, with gzipped responses and the static
+# files served as fingerprinted, precompressed assets, see static_assets
+PRODUCTION = 'production'
+
+MODES = (DEV, PRODUCTION)
+
+# the content types worth gzipping, server-sent events are streamed so they never are
+COMPRESSIBLE_TYPES = ('text/html', 'text/css', 'text/plain', 'text/javascript',
+	'application/javascript', 'application/json', 'image/svg+xml')
+
+
+def get_header(headers, name):
+	name = name.lower()
+	for key, value in headers:
+		if key.lower() == name:
+			return value
+	return None
+
+
+class GzipMiddleware:
+	# gzips the responses with a compressible content type of at least min_size bytes,
+	# for the clients that accept it. Responses that are already encoded, e.g. the
+	# precompressed assets, are passed through
+	# the app must not use the write callable of start_response, flask doesn't
+	def __init__(self, app, min_size=GZIP_MIN_SIZE, level=GZIP_LEVEL):
+		self.app = app
+		self.min_size = min_size
+		self.level = level
+
+	def compressible(self, status, headers):
+		if not status.startswith('200'):
+			return False
+		content_type = get_header(headers, 'Content-Type')
+		if content_type == None or content_type.split(';')[0].strip() not in COMPRESSIBLE_TYPES:
+			return False
+		if get_header(headers, 'Content-Encoding') != None:
+			return False
+		length = get_header(headers, 'Content-Length')
+		return length == None or int(length) >= self.min_size
+
+	def __call__(self, environ, start_response):
+		if 'gzip' not in environ.get('HTTP_ACCEPT_ENCODING', '') or \
+			environ.get('REQUEST_METHOD') == 'HEAD':
+			return self.app(environ, start_response)
+
+		response = []
+
+		def capture(status, headers, exc_info=None):
+			response[:] = [status, headers, exc_info]
+
+		body = self.app(environ, capture)
+		status, headers, exc_info = response
+		if not self.compressible(status, headers):
+			start_response(status, headers, exc_info)
+			return body
+
+		try:
+			data = b''.join(body)
+		finally:
+			if hasattr(body, 'close'):
+				body.close()
+		if len(data) >= self.min_size:
+			data = static_assets.gzip_bytes(data, self.level)
+			vary = get_header(headers, 'Vary')
+			headers = [(key, value) for key, value in headers
+				if key.lower() not in ('content-length', 'vary')]
+			headers.append(('Content-Encoding', 'gzip'))
+			headers.append(('Vary', 'Accept-Encoding' if vary == None else
+				'%s, Accept-Encoding' % (vary)))
+			headers.append(('Content-Length', '%d' % (len(data))))
+		start_response(status, headers, exc_info)
+		return [data]
+
+
+def serve(app, mode=SERVER_MODE, host=SERVER_HOST, port=SERVER_PORT):
+	# serves the app until the process is stopped
+	if mode not in MODES:
+		raise ValueError('Unknown server mode: %s' % (mode))
+
+	if mode == DEV:
+		# threaded, as each room display holds open a server-sent events stream
+		app.run(host=host, port=port, debug=False, threaded=True)
+		return
+
+	static_assets.build()
+	static_assets.load()
+	missing = static_assets.missing_vendor_assets()
+	if missing:
+		logging.warning('Not vendored, the room displays load these from their CDN and break ' +
+			'offline, run vendor_static.py: %s', ', '.join(missing))
+	app.wsgi_app = GzipMiddleware(app.wsgi_app)
+
+	if waitress != None:
+		logging.info('Serving on %s:%d with waitress, %d threads', host, port, SERVER_THREADS)
+		waitress.serve(app, host=host, port=port, threads=SERVER_THREADS)
+	elif cheroot_wsgi != None:
+		logging.info('Serving on %s:%d with cheroot, %d threads', host, port, SERVER_THREADS)
+		server = cheroot_wsgi.Server((host, port), app, numthreads=SERVER_THREADS)
+		try:
+			server.start()
+		finally:
+			server.stop()
+	else:
+		# the assets are still fingerprinted and gzipped
+		logging.warning('Neither waitress nor cheroot is installed, using the development server')
+		app.run(host=host, port=port, debug=False, threaded=True)
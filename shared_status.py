@@ -0,0 +1,241 @@
+import booking_index
+import fcntl
+import logging
+import math
+import mmap
+import os
+import recurring
+import sensor_stats
+import struct
+import threading
+import time
+from config import SENSOR_SAMPLE_SECS
+from config import SENSOR_WINDOWS
+from config import SHARED_STATUS_POLL_SECS
+from config import STATUS_SNAPSHOT_PATH
+
+# the state shared by the processes of a split deployment, see processes
+# a fixed layout, memory mapped file with a header, two counters and the sensor status:
+#   magic, body size | status sequence | bookings generation | status body
+# the mcu process is the only writer of the status. The sequence is odd while it's
+# being written, so readers copy the body and retry if the sequence was odd or changed,
+# and never wait on the writer, which only holds it odd for a memcpy
+# the bookings generation is bumped by any process that changes a booking, so the
+# others reload their in-memory indexes
+
+MAGIC = b'RMS1'
+HEADER = struct.Struct('<4sI')
+# 32 bit, so they're written in one store on the device
+COUNTER = struct.Struct('<I')
+COUNTER_MASK = 0xffffffff
+SEQUENCE_OFFSET = HEADER.size
+GENERATION_OFFSET = SEQUENCE_OFFSET + COUNTER.size
+BODY_OFFSET = GENERATION_OFFSET + COUNTER.size
+
+# the sensor stats in the status, and their windows
+STATS = ('current', 'temp_stats', 'light_stats')
+WINDOWS = tuple(sorted(SENSOR_WINDOWS))
+
+# written at, temp, light, relay, motion, then for each of STATS the latest value,
+# ewma and the count, mean, min and max of each window. Missing values are NaN
+BODY = struct.Struct('<dddBB' + ('dd' + 'Iddd' * len(WINDOWS)) * len(STATS))
+SIZE = BODY_OFFSET + BODY.size
+
+NAN = float('nan')
+
+# attempts to read a consistent status before giving up
+READ_ATTEMPTS = 100
+
+# a status that hasn't been updated for a few aggregations is stale, e.g. the mcu
+# process has stopped
+MAX_AGE_SECS = 3 * SENSOR_SAMPLE_SECS
+
+
+def to_double(value):
+	if value == None:
+		return NAN
+	return float(value)
+
+
+def from_double(value):
+	if math.isnan(value):
+		return None
+	return value
+
+
+class WindowValues:
+	# a window of a shared sensor snapshot, see sensor_stats.WindowSnapshot
+	def __init__(self, count, mean, min_value, max_value):
+		self.count = count
+		self.mean = mean
+		self.min = min_value
+		self.max = max_value
+
+
+def pack_status(status):
+	values = [time.time(), to_double(status['temp']), to_double(status['light']),
+		1 if status['relay'] else 0, 1 if status['motion'] else 0]
+	for name in STATS:
+		snapshot = status[name]
+		values += [to_double(snapshot.latest), to_double(snapshot.ewma)]
+		for window in WINDOWS:
+			snapshot_window = snapshot.windows.get(window)
+			if snapshot_window == None:
+				values += [0, NAN, NAN, NAN]
+			else:
+				values += [snapshot_window.count, to_double(snapshot_window.mean),
+					to_double(snapshot_window.min), to_double(snapshot_window.max)]
+	return BODY.pack(*values)
+
+
+def unpack_status(body):
+	values = BODY.unpack(body)
+	status = {'written_at':values[0], 'temp':from_double(values[1]),
+		'light':from_double(values[2]), 'relay':values[3] == 1, 'motion':values[4] == 1}
+	i = 5
+	for name in STATS:
+		latest, ewma = from_double(values[i]), from_double(values[i + 1])
+		i += 2
+		windows = {}
+		for window in WINDOWS:
+			count, mean, min_value, max_value = values[i:i + 4]
+			i += 4
+			windows[window] = WindowValues(count, from_double(mean), from_double(min_value),
+				from_double(max_value))
+		status[name] = sensor_stats.SensorSnapshot(latest, ewma, windows)
+	return status
+
+
+class SharedStatus:
+	def __init__(self, path=STATUS_SNAPSHOT_PATH):
+		self.path = path
+		self.fd = None
+		self.map = None
+		# the bookings generation this process is up to date with
+		self.generation = None
+		self.lock = threading.Lock()
+
+	def open(self):
+		# maps the file, creating it if it doesn't exist or has a different layout
+		with self.lock:
+			if self.map != None:
+				return
+			fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+			fcntl.flock(fd, fcntl.LOCK_EX)
+			try:
+				header = os.read(fd, HEADER.size)
+				if os.fstat(fd).st_size != SIZE:
+					os.ftruncate(fd, SIZE)
+				if header != HEADER.pack(MAGIC, BODY.size):
+					logging.info('Initialising the shared status in %s', self.path)
+					os.lseek(fd, 0, os.SEEK_SET)
+					os.write(fd, HEADER.pack(MAGIC, BODY.size) + b'\0' * (SIZE - HEADER.size))
+					os.fsync(fd)
+			finally:
+				fcntl.flock(fd, fcntl.LOCK_UN)
+			self.map = mmap.mmap(fd, SIZE)
+			self.fd = fd
+
+	def read_counter(self, offset):
+		return COUNTER.unpack_from(self.map, offset)[0]
+
+	def publish(self, status):
+		# writes the status, a dict as returned by mcu_utils.get_status
+		# must only be called by the process that owns the MCU
+		body = pack_status(status)
+		self.open()
+		with self.lock:
+			sequence = self.read_counter(SEQUENCE_OFFSET)
+			COUNTER.pack_into(self.map, SEQUENCE_OFFSET, (sequence + 1) & COUNTER_MASK)
+			self.map[BODY_OFFSET:SIZE] = body
+			COUNTER.pack_into(self.map, SEQUENCE_OFFSET, (sequence + 2) & COUNTER_MASK)
+
+	def read(self):
+		# the latest status published by the mcu process, or None if there isn't a
+		# recent one
+		self.open()
+		for attempt in range(READ_ATTEMPTS):
+			sequence = self.read_counter(SEQUENCE_OFFSET)
+			if sequence % 2 == 0:
+				body = self.map[BODY_OFFSET:SIZE]
+				if self.read_counter(SEQUENCE_OFFSET) == sequence:
+					break
+			time.sleep(0)
+		else:
+			logging.warning('No consistent shared status after %d attempts', READ_ATTEMPTS)
+			return None
+
+		if sequence == 0:
+			# nothing has been published yet
+			return None
+		status = unpack_status(body)
+		if time.time() - status['written_at'] > MAX_AGE_SECS:
+			logging.warning('The shared status is stale, is the mcu process running?')
+			return None
+		return status
+
+	def bump_generation(self):
+		# tells the other processes that a booking has changed
+		self.open()
+		with self.lock:
+			fcntl.flock(self.fd, fcntl.LOCK_EX)
+			try:
+				generation = self.read_counter(GENERATION_OFFSET)
+				COUNTER.pack_into(self.map, GENERATION_OFFSET, (generation + 1) & COUNTER_MASK)
+			finally:
+				fcntl.flock(self.fd, fcntl.LOCK_UN)
+			if self.generation == generation:
+				# no other process has changed a booking, so this one is still up to date
+				self.generation = (generation + 1) & COUNTER_MASK
+
+	def changed_elsewhere(self):
+		# whether another process has changed a booking since the last call
+		self.open()
+		with self.lock:
+			generation = self.read_counter(GENERATION_OFFSET)
+			changed = self.generation != None and generation != self.generation
+			self.generation = generation
+			return changed
+
+
+status = SharedStatus()
+
+_local = threading.local()
+
+
+def booking_changed():
+	# booking index listener, the reloads of changes made elsewhere aren't passed on
+	if not getattr(_local, 'reloading', False):
+		status.bump_generation()
+
+
+def load_bookings(app):
+	_local.reloading = True
+	try:
+		with app.app_context():
+			recurring.index.load()
+			booking_index.index.load()
+	finally:
+		_local.reloading = False
+
+
+def watch_bookings(app):
+	while True:
+		time.sleep(SHARED_STATUS_POLL_SECS)
+		try:
+			if status.changed_elsewhere():
+				load_bookings(app)
+		except Exception:
+			logging.exception('Failed to reload the bookings changed by another process')
+
+
+def share_bookings(app):
+	# for the bot and web processes, the booking changes made by this process are
+	# passed on to the other one, and the indexes are reloaded when it changes a booking
+	status.changed_elsewhere()
+	load_bookings(app)
+	booking_index.index.add_listener(booking_changed)
+
+	thread = threading.Thread(target=watch_bookings, args=(app,), name='shared_status')
+	thread.daemon = True
+	thread.start()
@@ -0,0 +1,78 @@
+import logging
+import slackutils
+import storage
+import threading
+import time
+from app import db, models
+from config import SLACK_USER_TTL
+
+# a local mirror of the slack user directory
+# it's bulk loaded at startup and kept up to date by user_change events, so
+# booking a room doesn't need a users.info call or a db write
+
+
+class SlackDirectory:
+	def __init__(self, ttl=SLACK_USER_TTL):
+		self.ttl = ttl
+		# sid -> (fetched_at, user)
+		self.users = {}
+		self.lock = threading.Lock()
+
+	def _cache(self, user, now):
+		with self.lock:
+			previous = self.users.get(user['id'])
+			self.users[user['id']] = (now, user)
+		return previous == None or previous[1] != user
+
+	def _store(self, users):
+		# upserts SlackUser rows, part of the caller's transaction
+		if not users:
+			return
+		by_sid = dict((u['id'], u) for u in users)
+		existing = models.SlackUser.query.filter(models.SlackUser.sid.in_(list(by_sid))).all()
+		for row in existing:
+			user = by_sid.pop(row.sid)
+			row.name = user['name']
+			row.real_name = user['real_name']
+			row.image_48 = user['image_48']
+		for user in by_sid.values():
+			db.session.add(models.SlackUser(sid=user['id'], name=user['name'],
+				real_name=user['real_name'], image_48=user['image_48']))
+
+	def sync(self):
+		# loads every user via users.list and stores any changes in a single commit
+		# must be called within an app context
+		now = time.time()
+		changed = []
+		count = 0
+		for user in slackutils.list_slack_users():
+			count += 1
+			if self._cache(user, now):
+				changed.append(user)
+		self._store(changed)
+		storage.commit()
+		logging.info('Synced %d slack user(s), %d changed', count, len(changed))
+
+	def on_user_change(self, slack_user):
+		# handles a user_change RTM event
+		user = slackutils.parse_slack_user(slack_user)
+		if user and self._cache(user, time.time()):
+			self._store([user])
+			storage.commit()
+
+	def get(self, sid):
+		# the cached user, falls back to users.info if it's missing or stale
+		with self.lock:
+			entry = self.users.get(sid)
+		if entry and entry[0] + self.ttl > time.time():
+			return entry[1]
+
+		user = slackutils.get_slack_user(sid)
+		if user:
+			if self._cache(user, time.time()):
+				self._store([user])
+				storage.commit()
+		return user
+
+
+directory = SlackDirectory()
@@ -0,0 +1,108 @@
+import logging
+import metrics
+import slackutils
+import threading
+import time
+from app import db, slack_client
+from config import RTM_QUEUE_SIZE
+from config import RTM_IDLE_SLEEP
+from config import RTM_RECONNECT_DELAY
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+# the slack Real Time Messaging API is read by a dedicated thread, which queues
+# every event directed at the bot. A second thread drains the queue and runs
+# the commands, so a slow command never delays reading the next event.
+
+event_queue = queue.Queue(maxsize=RTM_QUEUE_SIZE)
+
+events_received = metrics.Counter('rtm_events_received', 'Bot events read from slack')
+events_handled = metrics.Counter('rtm_events_handled', 'Bot events dispatched')
+events_dropped = metrics.Counter('rtm_events_dropped', 'Bot events dropped, queue full')
+handler_errors = metrics.Counter('rtm_handler_errors', 'Bot events that raised an error')
+queue_depth = metrics.Gauge('rtm_queue_depth', 'Bot events waiting to be dispatched')
+queue_wait = metrics.Latency('rtm_queue_wait_seconds', 'Time events spend in the queue')
+event_latency = metrics.Latency('rtm_event_latency_seconds',
+	'Time from reading an event to finishing its command')
+
+_stop = threading.Event()
+_threads = []
+
+
+def enqueue_event(event):
+	# timestamp the event so the end-to-end latency can be measured
+	try:
+		# wait briefly rather than drop the event, the dispatcher may be catching up
+		event_queue.put((time.time(), event), timeout=1)
+	except queue.Full:
+		events_dropped.inc()
+		logging.error('RTM event queue full, dropped event: %s', event)
+		return False
+
+	events_received.inc()
+	queue_depth.set(event_queue.qsize())
+	return True
+
+
+def read_loop():
+	# reads the slack RTM firehose and queues every event for the bot
+	while not _stop.is_set():
+		try:
+			events = slackutils.filter_slack_events(slack_client.rtm_read())
+		except Exception:
+			logging.exception('Slack RTM read failed, reconnecting')
+			_stop.wait(RTM_RECONNECT_DELAY)
+			if not slack_client.rtm_connect():
+				logging.error('Slack RTM reconnect failed')
+			continue
+
+		for event in events:
+			enqueue_event(event)
+
+		if not events:
+			_stop.wait(RTM_IDLE_SLEEP)
+
+
+def dispatch_loop():
+	# drains the event queue, handling events in the order they were received
+	import jobs
+
+	while not _stop.is_set():
+		try:
+			received_at, event = event_queue.get(timeout=1)
+		except queue.Empty:
+			continue
+
+		queue_depth.set(event_queue.qsize())
+		queue_wait.time_since(received_at)
+		try:
+			with db.app.app_context():
+				jobs.handle_slack_event(event)
+		except Exception:
+			handler_errors.inc()
+			logging.exception('Failed to handle slack event: %s', event)
+		finally:
+			event_queue.task_done()
+
+		events_handled.inc()
+		event_latency.time_since(received_at)
+
+
+def start():
+	# start the reader and dispatcher threads, the RTM connection must be open
+	_stop.clear()
+	for name, target in (('rtm-read', read_loop), ('rtm-dispatch', dispatch_loop)):
+		t = threading.Thread(target=target, name=name)
+		t.daemon = True
+		t.start()
+		_threads.append(t)
+
+
+def stop():
+	_stop.set()
+	for t in _threads:
+		t.join(timeout=2)
+	del _threads[:]
@@ -3,14 +3,18 @@ import dtutils
 import logging
 from app import slack_client
 from config import BOT_ID
+from config import SLACK_MESSAGE_MAX_CHARS
 
 MESSAGE_EVENT_TYPE = 'message'
 USER_CHG_EVENT_TYPE = 'user_change'
 
-def format_slack_date(dt):
+def format_slack_date(dt, ts=None):
 	# create a correctly formated date, ready for sending to slack
+	# ts is the timestamp of dt, if the caller already has it
+	if ts == None:
+		ts = dtutils.to_timestamp(dt)
 	s = dt.strftime('%b %d, %Y')
-	return '<!date^%d^{date_long_pretty}|%s>' % (dtutils.to_timestamp(dt), s)
+	return '<!date^%d^{date_long_pretty}|%s>' % (ts, s)
 
 
 def format_slack_time(day_ts, tod_in_mins):
@@ -19,9 +23,35 @@ def format_slack_time(day_ts, tod_in_mins):
 		(day_ts + tod_in_mins * 60, tod_in_mins / 60, tod_in_mins % 60)
 
 
+def split_message(text, max_chars=SLACK_MESSAGE_MAX_CHARS):
+	# splits text into messages of at most max_chars, at line breaks where possible
+	messages = []
+	message = ''
+	for line in text.split('\n'):
+		while len(line) > max_chars:
+			if message:
+				messages.append(message)
+				message = ''
+			messages.append(line[:max_chars])
+			line = line[max_chars:]
+		if message and len(message) + 1 + len(line) > max_chars:
+			messages.append(message)
+			message = line
+		elif message:
+			message += '\n' + line
+		else:
+			message = line
+	if message or not messages:
+		messages.append(message)
+	return messages
+
+
 def filter_slack_events(slack_rtm_events):
 	# the slack Real Time Messaging API is firehose of events
 	# this function looks for messages directed at the bot, based on its id
+	# and user changes
+	# every matching event is returned, in the order it was received
+	matched = []
 	event_list = slack_rtm_events
 	if event_list and len(event_list) > 0:
 		logging.info('Received slack RTM event(s): %s', event_list)
@@ -30,12 +60,28 @@ def filter_slack_events(slack_rtm_events):
 			if event and 'type' in event:
 				# message events which include the bot
 				if event['type'] == MESSAGE_EVENT_TYPE and 'text' in event \
-					and event['text'].find(BOT_ID) != -1:
-					return {'type':MESSAGE_EVENT_TYPE, 
+					and 'user' in event and event['text'].find(BOT_ID) != -1:
+					matched.append({'type':MESSAGE_EVENT_TYPE,
 						'channel':event['channel'],
 						'user':event['user'],
-						'message':event['text']}
+						'message':event['text']})
+				# profile changes, used to keep the user directory up to date
+				elif event['type'] == USER_CHG_EVENT_TYPE and 'user' in event:
+					matched.append({'type':USER_CHG_EVENT_TYPE,
+						'user':event['user']})
+
+	return matched
+
+
+def parse_slack_user(user):
+	# selected fields of a slack user object, or None for deleted users and bots
+	if user.get('deleted') == False and user.get('is_bot') == False:
+		profile = user.get('profile', {})
+		return {'id':user['id'], 'name':user['name'],
+			'real_name':profile.get('real_name'), 'image_48':profile.get('image_48')}
 
+	logging.info('user: %s; deleted: %s; is_bot: %s' % \
+		(user.get('id'), user.get('deleted'), user.get('is_bot')))
 	return None
 
 
@@ -43,13 +89,29 @@ def get_slack_user(id):
 	# fetches selected user.info data from slack
 	result = slack_client.api_call("users.info", user=id)
 	if result['ok']:
-		user = result['user']
-		if user['deleted'] == False and user['is_bot'] == False:
-			profile = user['profile']
-			return {'id':user['id'], 'name':user['name'],
-				'real_name':profile['real_name'], 'image_48':profile['image_48']}
-		
-		logging.info('user: %s; deleted: %s; is_bot: %s' % \
-			(id, user['deleted'], user['is_bot']))
+		return parse_slack_user(result['user'])
 	
-	return None
\ No newline at end of file
+	return None
+
+
+def list_slack_users(page_size=200):
+	# fetches every user from slack, a page at a time
+	# yields the selected user data of users that are not deleted or bots
+	cursor = None
+	while True:
+		if cursor:
+			result = slack_client.api_call("users.list", limit=page_size, cursor=cursor)
+		else:
+			result = slack_client.api_call("users.list", limit=page_size)
+		if not result.get('ok'):
+			logging.error('users.list failed: %s', result.get('error'))
+			return
+
+		for member in result.get('members', []):
+			user = parse_slack_user(member)
+			if user:
+				yield user
+
+		cursor = result.get('response_metadata', {}).get('next_cursor')
+		if not cursor:
+			return
@@ -0,0 +1,192 @@
+import base64
+import gzip
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+import time
+from config import ASSET_MAX_AGE
+from config import basedir
+from flask import abort, request, send_from_directory, url_for
+from markupsafe import Markup
+
+# the static files the room displays load, served in production as fingerprinted
+# copies, e.g. vendor/jquery.min.js as /assets/vendor/jquery.min.<hash>.js, which
+# browsers cache for ASSET_MAX_AGE, as the url changes whenever the file does
+# build writes the copies, and gzipped copies of the text ones, to BUILD_DIR with a
+# manifest of the original names. Without a build the files are served by flask's
+# static route, and the vendored libraries from their CDN until vendor_static.py has
+# copied them to VENDOR_DIR
+
+STATIC_DIR = os.path.join(basedir, 'app', 'static')
+BUILD_DIR = os.path.join(STATIC_DIR, 'build')
+VENDOR_DIR = os.path.join(STATIC_DIR, 'vendor')
+MANIFEST = 'manifest.json'
+
+# hex digits of the content hash in a fingerprinted name
+FINGERPRINT_LENGTH = 12
+
+# the extensions of the files that are precompressed
+COMPRESSIBLE = ('.css', '.js', '.json', '.map', '.svg', '.txt', '.html')
+
+# the third party libraries, in the static dir, with their CDN url and subresource integrity
+VENDOR_ASSETS = (
+	('vendor/bootstrap.min.css',
+		'https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css',
+		'sha384-BVYiiSIFeK1dGmJRAkycuHAHRg32OmUcww7on3RYdg4Va+PmSTsz/K68vbdEjh4u'),
+	('vendor/bootstrap-theme.min.css',
+		'https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap-theme.min.css',
+		'sha384-rHyoN1iRsVXV4nD0JutlnGaslCJuC7uwjduW9SVrLvRYooPp2bWYgmgJQIXwl/Sp'),
+	('vendor/jquery.min.js',
+		'https://code.jquery.com/jquery-1.12.4.min.js',
+		'sha256-ZosEbRLbNQzLpnKIkEdrPv7lOy9C27hHQ+Xp8a4MxAQ='),
+	('vendor/bootstrap.min.js',
+		'https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/js/bootstrap.min.js',
+		'sha384-Tc5IQib027qvyjSMfHjOMaLkfuWVxZxUPnCJA7l2mCWNIpG9mGCD8wGNIcPD7Txa'),
+)
+
+VENDOR_CDN = dict((filename, (url, integrity)) for filename, url, integrity in VENDOR_ASSETS)
+
+# original name -> fingerprinted name, empty unless load has been called
+manifest = {}
+# the fingerprinted names that have a gzipped copy
+gzipped = set()
+
+
+def integrity_of(data, integrity):
+	# whether data matches a subresource integrity value, e.g. sha384-<base64 digest>
+	algorithm, digest = integrity.split('-', 1)
+	return base64.b64encode(hashlib.new(algorithm, data).digest()).decode('ascii') == digest
+
+
+def fingerprinted_name(filename, data):
+	base, ext = os.path.splitext(filename)
+	return '%s.%s%s' % (base, hashlib.sha1(data).hexdigest()[:FINGERPRINT_LENGTH], ext)
+
+
+def write_file(path, data):
+	# written to a temporary file and renamed, so a partly written asset is never served
+	directory = os.path.dirname(path)
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'wb') as f:
+		f.write(data)
+	os.rename(tmp_path, path)
+
+
+def gzip_bytes(data, level=9):
+	# no name or time in the header, so a build is reproducible
+	buf = io.BytesIO()
+	gz = gzip.GzipFile(filename='', mode='wb', fileobj=buf, compresslevel=level, mtime=0)
+	try:
+		gz.write(data)
+	finally:
+		gz.close()
+	return buf.getvalue()
+
+
+def static_files(static_dir, build_dir):
+	# the names, relative to static_dir and with / separators, of the files to build
+	for root, dirs, files in os.walk(static_dir):
+		dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != build_dir)
+		for name in sorted(files):
+			if name.startswith('.') or name.endswith('.tmp'):
+				continue
+			path = os.path.relpath(os.path.join(root, name), static_dir)
+			yield path.replace(os.sep, '/')
+
+
+def build(static_dir=STATIC_DIR, build_dir=BUILD_DIR):
+	# writes the fingerprinted and gzipped copies of the static files and the manifest,
+	# and removes the copies of files that have since changed or been removed
+	# only the new copies are written, so it's cheap to run on every start
+	built = {}
+	compressed = []
+	keep = set([MANIFEST])
+	for filename in static_files(static_dir, build_dir):
+		with open(os.path.join(static_dir, filename), 'rb') as f:
+			data = f.read()
+		name = fingerprinted_name(filename, data)
+		built[filename] = name
+		keep.add(name)
+		path = os.path.join(build_dir, name)
+		if not os.path.exists(path):
+			write_file(path, data)
+		if os.path.splitext(filename)[1] in COMPRESSIBLE:
+			if not os.path.exists(path + '.gz'):
+				compressed_data = gzip_bytes(data)
+				if len(compressed_data) >= len(data):
+					continue
+				write_file(path + '.gz', compressed_data)
+			compressed.append(name)
+			keep.add(name + '.gz')
+
+	write_file(os.path.join(build_dir, MANIFEST), json.dumps({'assets':built,
+		'gzipped':sorted(compressed)}, indent=1, sort_keys=True).encode('utf-8'))
+
+	for root, dirs, files in os.walk(build_dir):
+		for name in files:
+			path = os.path.join(root, name)
+			if os.path.relpath(path, build_dir).replace(os.sep, '/') not in keep:
+				os.remove(path)
+	logging.info('Built %d static asset(s), %d gzipped, in %s', len(built), len(compressed),
+		build_dir)
+
+
+def load(build_dir=BUILD_DIR):
+	# reads the manifest, after which the templates use the fingerprinted urls
+	with open(os.path.join(build_dir, MANIFEST)) as f:
+		data = json.load(f)
+	manifest.clear()
+	manifest.update(data['assets'])
+	gzipped.clear()
+	gzipped.update(data['gzipped'])
+
+
+def missing_vendor_assets():
+	# the vendored libraries that haven't been copied to VENDOR_DIR
+	return [filename for filename, url, integrity in VENDOR_ASSETS
+		if not os.path.exists(os.path.join(STATIC_DIR, filename))]
+
+
+def from_cdn(filename):
+	# whether a vendored library is loaded from its CDN, as it hasn't been vendored
+	return filename not in manifest and filename in VENDOR_CDN and \
+		not os.path.exists(os.path.join(STATIC_DIR, filename))
+
+
+def asset_url(filename):
+	# the url of a static file, for the templates
+	if filename in manifest:
+		return url_for('asset', filename=manifest[filename])
+	if from_cdn(filename):
+		return VENDOR_CDN[filename][0]
+	return url_for('static', filename=filename)
+
+
+def asset_attrs(filename):
+	# the extra attributes of the tag loading a static file, the integrity of a CDN copy
+	if from_cdn(filename):
+		return Markup(' integrity="%s" crossorigin="anonymous"' % (VENDOR_CDN[filename][1]))
+	return ''
+
+
+def send_asset(name):
+	# a response for a fingerprinted name, gzipped if there's a copy and the client
+	# accepts it, that can be cached until ASSET_MAX_AGE
+	if name not in manifest.values():
+		abort(404)
+	mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+	if name in gzipped and 'gzip' in request.accept_encodings:
+		response = send_from_directory(BUILD_DIR, name + '.gz', mimetype=mimetype)
+		response.headers['Content-Encoding'] = 'gzip'
+	else:
+		response = send_from_directory(BUILD_DIR, name, mimetype=mimetype)
+	if name in gzipped:
+		response.vary.add('Accept-Encoding')
+	response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % (ASSET_MAX_AGE)
+	response.expires = int(time.time() + ASSET_MAX_AGE)
+	return response
@@ -0,0 +1,181 @@
+import logging
+import metrics
+import sqlite3
+import threading
+import time
+from app import db
+from config import SQLITE_STORAGE_MODE
+from config import SQLITE_CACHE_SIZE_KB
+from config import SQLITE_MMAP_SIZE
+from config import RETENTION_BATCH_SIZE
+from config import RETENTION_BATCH_PAUSE_SECS
+from contextlib import contextmanager
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+
+# sqlite storage, tuned for the flash/sd card storage of the LinkIt
+# 'flash' mode uses WAL journaling and relaxed fsyncs, 'default' leaves sqlite as is
+# a unit of work groups the changes made by a command into a single commit
+
+DEFAULT_MODE = 'default'
+FLASH_MODE = 'flash'
+
+commits = metrics.Counter('db_commits', 'Db commits')
+rollbacks = metrics.Counter('db_rollbacks', 'Db rollbacks')
+commit_latency = metrics.Latency('db_commit_seconds', 'Time taken by db commits')
+
+_local = threading.local()
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+	# applied to every new sqlite connection
+	if SQLITE_STORAGE_MODE != FLASH_MODE or \
+		not isinstance(dbapi_connection, sqlite3.Connection):
+		return
+
+	cursor = dbapi_connection.cursor()
+	# readers don't block the writer and each commit is an append to the wal
+	cursor.execute('PRAGMA journal_mode=WAL')
+	# in WAL mode, NORMAL only fsyncs at checkpoints, the db stays consistent
+	cursor.execute('PRAGMA synchronous=NORMAL')
+	# negative values are in KiB
+	cursor.execute('PRAGMA cache_size=-%d' % (SQLITE_CACHE_SIZE_KB))
+	cursor.execute('PRAGMA mmap_size=%d' % (SQLITE_MMAP_SIZE))
+	cursor.execute('PRAGMA temp_store=MEMORY')
+	cursor.close()
+
+
+def _depth():
+	return getattr(_local, 'depth', 0)
+
+
+def _callbacks():
+	if not hasattr(_local, 'callbacks'):
+		_local.callbacks = []
+	return _local.callbacks
+
+
+def _commit():
+	start = time.time()
+	db.session.commit()
+	commit_latency.time_since(start)
+	commits.inc()
+
+
+def commit():
+	# commits the session, unless there's a unit of work in progress, in which
+	# case the changes are only flushed, e.g. so new rows have an id
+	if _depth() > 0:
+		db.session.flush()
+		_local.pending = True
+	else:
+		_commit()
+		run_callbacks()
+
+
+def on_commit(callback):
+	# calls callback once the current changes have been committed
+	# e.g. to update in-memory state, which must not see uncommitted changes
+	if _depth() > 0:
+		_callbacks().append(callback)
+	else:
+		callback()
+
+
+def run_callbacks():
+	callbacks = _callbacks()
+	while callbacks:
+		callback = callbacks.pop(0)
+		try:
+			callback()
+		except Exception:
+			logging.exception('Commit callback failed')
+
+
+def pause_between_batches():
+	# gives other threads a chance to take the write lock, between batches
+	time.sleep(RETENTION_BATCH_PAUSE_SECS)
+
+
+def batch_delete_statement(table, where, batch_size=RETENTION_BATCH_SIZE):
+	return text('DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s WHERE %s LIMIT %d)' \
+		% (table, table, where, batch_size))
+
+
+def delete_in_batches(table, where, params=None, batch_size=RETENTION_BATCH_SIZE):
+	# deletes the rows of table that match the where clause, batch_size rows per commit
+	# so the write lock is never held for long, returns the number of rows deleted
+	# must not be called within a unit of work
+	statement = batch_delete_statement(table, where, batch_size)
+	total = 0
+	while True:
+		count = db.session.execute(statement, params or {}).rowcount
+		commit()
+		total += count
+		if count < batch_size:
+			return total
+		pause_between_batches()
+
+
+@contextmanager
+def unit_of_work():
+	# everything committed within the block is committed once, at the end
+	# nested blocks join the outermost one
+	if _depth() == 0:
+		_local.pending = False
+	_local.depth = _depth() + 1
+	try:
+		yield
+	except Exception:
+		_local.depth -= 1
+		if _local.depth == 0:
+			db.session.rollback()
+			rollbacks.inc()
+			del _callbacks()[:]
+		raise
+
+	_local.depth -= 1
+	if _local.depth == 0:
+		if _local.pending:
+			try:
+				_commit()
+			except Exception:
+				# nothing was committed, so the callbacks mustn't run
+				db.session.rollback()
+				rollbacks.inc()
+				del _callbacks()[:]
+				raise
+		run_callbacks()
+
+
+def maintenance():
+	# reclaims free pages and refreshes the query planner statistics
+	# must be called within an app context
+	with db.engine.connect() as conn:
+		auto_vacuum = conn.execute(text('PRAGMA auto_vacuum')).scalar()
+	if SQLITE_STORAGE_MODE == FLASH_MODE and auto_vacuum != 2:
+		# auto_vacuum can only be changed by a full VACUUM, outside a transaction
+		logging.info('Enabling incremental vacuum')
+		raw = sqlite3.connect(db.engine.url.database, isolation_level=None)
+		try:
+			raw.execute('PRAGMA auto_vacuum=INCREMENTAL')
+			raw.execute('VACUUM')
+		finally:
+			raw.close()
+		auto_vacuum = 2
+
+	if auto_vacuum == 2:
+		# executescript steps the pragma to completion, executing it only frees one page
+		raw = sqlite3.connect(db.engine.url.database, isolation_level=None)
+		try:
+			freelist = raw.execute('PRAGMA freelist_count').fetchone()[0]
+			raw.executescript('PRAGMA incremental_vacuum')
+			remaining = raw.execute('PRAGMA freelist_count').fetchone()[0]
+		finally:
+			raw.close()
+		logging.info('Incremental vacuum, %d free page(s) reclaimed, %d before, %d after',
+			freelist - remaining, freelist, remaining)
+
+	with db.engine.begin() as conn:
+		conn.execute(text('ANALYZE'))
@@ -0,0 +1,128 @@
+import logging
+import storage
+import threading
+import time
+from app import db, models
+from collections import OrderedDict
+from config import DEFAULT_ROOM
+from config import SUGGESTION_STORE
+from config import SUGGESTION_TTL
+from config import SUGGESTION_MAX_USERS
+
+# booking suggestions only live until the user confirms one with the book command
+# so by default they're kept in memory, rather than written to flash storage
+
+MEMORY_STORE = 'memory'
+SQLITE_STORE = 'sqlite'
+
+
+class Suggestion:
+	# an unconfirmed booking, has the same fields as models.UnconfirmedBooking
+	def __init__(self, start_date, start_time, duration, booker_sid, booker_ref,
+		attendees=None, room=DEFAULT_ROOM):
+		self.start_date = start_date
+		self.start_time = start_time
+		self.duration = duration
+		self.booker_sid = booker_sid
+		self.booker_ref = booker_ref
+		self.attendees = attendees
+		self.room = room
+
+	def __repr__(self):
+		return '<Suggestion %s %r %d %d %s %d>' % (self.room, self.start_date,
+			self.start_time, self.duration, self.booker_sid, self.booker_ref)
+
+
+class MemorySuggestionStore:
+	# suggestions per booker, expire after ttl seconds
+	# the least recently used booker is evicted once there are max_users
+	def __init__(self, ttl=SUGGESTION_TTL, max_users=SUGGESTION_MAX_USERS):
+		self.ttl = ttl
+		self.max_users = max_users
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+	def replace(self, booker_sid, suggestions):
+		# replaces any previous suggestions for the booker
+		with self.lock:
+			self.entries.pop(booker_sid, None)
+			if suggestions:
+				self.entries[booker_sid] = (time.time() + self.ttl,
+					dict((s.booker_ref, s) for s in suggestions))
+				while len(self.entries) > self.max_users:
+					evicted, _ = self.entries.popitem(last=False)
+					logging.debug('Evicted booking suggestions for %s', evicted)
+
+	def get(self, booker_sid, booker_ref):
+		with self.lock:
+			entry = self.entries.get(booker_sid)
+			if entry == None:
+				return None
+			expires_at, suggestions = entry
+			if expires_at < time.time():
+				del self.entries[booker_sid]
+				return None
+			# most recently used last
+			del self.entries[booker_sid]
+			self.entries[booker_sid] = entry
+			return suggestions.get(booker_ref)
+
+	def remove(self, booker_sid, commit=True):
+		# within a unit of work, e.g. confirming a booking, they're only removed once
+		# it has committed, so they can still be booked if it fails
+		storage.on_commit(lambda: self._remove(booker_sid))
+
+	def _remove(self, booker_sid):
+		with self.lock:
+			self.entries.pop(booker_sid, None)
+
+	def cleanup(self, before_date):
+		# removes expired suggestions, and any for days before before_date
+		now = time.time()
+		with self.lock:
+			for booker_sid, (expires_at, suggestions) in list(self.entries.items()):
+				if expires_at < now or \
+					all(s.start_date < before_date for s in suggestions.values()):
+					del self.entries[booker_sid]
+
+
+class SQLiteSuggestionStore:
+	# suggestions in the UnconfirmedBooking table, written in a single transaction
+	def replace(self, booker_sid, suggestions):
+		models.UnconfirmedBooking.query. \
+			filter(models.UnconfirmedBooking.booker_sid == booker_sid).delete()
+		for s in suggestions:
+			db.session.add(models.UnconfirmedBooking(start_date=s.start_date,
+				start_time=s.start_time, duration=s.duration, booker_sid=s.booker_sid,
+				booker_ref=s.booker_ref, attendees=s.attendees, room=s.room))
+		storage.commit()
+
+	def get(self, booker_sid, booker_ref):
+		return models.UnconfirmedBooking.query.filter( \
+			models.UnconfirmedBooking.booker_sid == booker_sid,
+			models.UnconfirmedBooking.booker_ref == booker_ref).first()
+
+	def remove(self, booker_sid, commit=True):
+		# commit=False lets the caller include the delete in its own transaction
+		models.UnconfirmedBooking.query. \
+			filter(models.UnconfirmedBooking.booker_sid == booker_sid).delete()
+		if commit:
+			storage.commit()
+
+	def cleanup(self, before_date):
+		# commits in batches, so it must not be called within a unit of work
+		# sqlite stores dates as iso strings
+		storage.delete_in_batches(models.UnconfirmedBooking.__table__.name,
+			'start_date < :before_date', {'before_date':before_date.isoformat()})
+
+
+def create_store(name):
+	if name == SQLITE_STORE:
+		return SQLiteSuggestionStore()
+	elif name == MEMORY_STORE:
+		return MemorySuggestionStore()
+
+	raise ValueError('Unknown suggestion store: %s' % (name))
+
+
+store = create_store(SUGGESTION_STORE)
@@ -0,0 +1,68 @@
+# copies jquery and bootstrap, see static_assets.VENDOR_ASSETS, into app/static/vendor,
+# so the room displays don't load them from their CDNs, and builds the fingerprinted
+# assets. Each file is checked against its subresource integrity before it's written
+#
+# usage: python vendor_static.py [--from DIR]
+#   --from copies the files from DIR, e.g. a copy made on a machine with internet
+#   access, instead of downloading them. DIR holds them by their base name, e.g.
+#   DIR/jquery.min.js
+import argparse
+import logging
+import os
+import static_assets
+import sys
+
+try:
+	from urllib2 import urlopen
+except ImportError:
+	from urllib.request import urlopen
+
+DOWNLOAD_TIMEOUT = 30
+
+
+def fetch(filename, url, source_dir):
+	if source_dir != None:
+		with open(os.path.join(source_dir, os.path.basename(filename)), 'rb') as f:
+			return f.read()
+	response = urlopen(url, timeout=DOWNLOAD_TIMEOUT)
+	try:
+		return response.read()
+	finally:
+		response.close()
+
+
+def vendor(source_dir=None):
+	# returns the names of the files that couldn't be vendored
+	failed = []
+	for filename, url, integrity in static_assets.VENDOR_ASSETS:
+		try:
+			data = fetch(filename, url, source_dir)
+		except (IOError, OSError) as e:
+			logging.error('Failed to fetch %s: %s', url, e)
+			failed.append(filename)
+			continue
+		if not static_assets.integrity_of(data, integrity):
+			logging.error("%s doesn't match its integrity %s", url, integrity)
+			failed.append(filename)
+			continue
+		static_assets.write_file(os.path.join(static_assets.STATIC_DIR, filename), data)
+		logging.info('Vendored %s', filename)
+	return failed
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Vendors the static libraries of the room displays')
+	parser.add_argument('--from', dest='source_dir',
+		help='copy the files from this directory instead of downloading them')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+	failed = vendor(args.source_dir)
+	static_assets.build()
+	if failed:
+		logging.error('Not vendored, still loaded from their CDN: %s', ', '.join(failed))
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()